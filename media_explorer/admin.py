@@ -3,24 +3,12 @@ from django.http import HttpResponse
 from django.contrib import admin
 from django.conf import settings
 from django.contrib.auth.models import User
-from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage, element_post_save
-from django.db.models import signals
+from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage, RenditionJob, Upload
 
 class ElementAdmin(admin.ModelAdmin):
     search_fields = ["name","description", "credit"]
     list_display = ('id','name',)
-    list_filter = ('type',)
-
-    def save_model(self, request, obj, form, change):
-        if "manual_embed_code" in form.cleaned_data \
-                and form.cleaned_data["manual_embed_code"]:
-            #Disconnect signal if we are manually entering embed code
-            signals.post_save.disconnect(element_post_save, sender=Element)
-            obj.save()
-            #Reconnect after save is done
-            signals.post_save.connect(element_post_save, sender=Element)
-        else:
-            obj.save()
+    list_filter = ('type','status')
 
     def get_form(self, request, obj=None, **kwargs):
         self.exclude = ("type",)
@@ -38,10 +26,23 @@ class GalleryElementAdmin(admin.ModelAdmin):
 
 class ResizedImageAdmin(admin.ModelAdmin):
     search_fields = ["file_name"]
-    list_display = ('id','file_name','image','size','image_width','image_height','html_img')
+    list_display = ('id','file_name','image','size','format','image_width','image_height','html_img')
     #list_filter = ('image',)
 
+class RenditionJobAdmin(admin.ModelAdmin):
+    list_display = ('id','element','status','attempts','run_after','locked_by','updated_at')
+    list_filter = ('status',)
+    raw_id_fields = ('element',)
+
+class UploadAdmin(admin.ModelAdmin):
+    search_fields = ["file_name"]
+    list_display = ('id','file_name','status','offset','size','element','updated_at')
+    list_filter = ('status',)
+    raw_id_fields = ('element','user')
+
 admin.site.register(Element, ElementAdmin)
 admin.site.register(Gallery, GalleryAdmin)
 admin.site.register(GalleryElement, GalleryElementAdmin)
 admin.site.register(ResizedImage, ResizedImageAdmin)
+admin.site.register(RenditionJob, RenditionJobAdmin)
+admin.site.register(Upload, UploadAdmin)
@@ -0,0 +1,153 @@
+import hashlib, json, math, random, traceback
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import F, Count, Sum
+from media_explorer.search import search_terms
+
+def total_keys(model_name, type=None):
+    """
+    The MediaCount keys an Element (of a type) or a Gallery counts in
+    """
+    if type:
+        return [model_name, "%s:%s" % (model_name, type)]
+    return [model_name]
+
+def increment(keys, delta):
+    """
+    Add delta to a random shard of the counters (in the current transaction, so a rollback undoes it)
+    Concurrent inserts update different rows instead of waiting for each other's commit on a single row.
+    A counter that does not exist yet is left alone (see rebuild_counts)
+    """
+    from media_explorer.models import MediaCount
+    shards = getattr(settings,"DME_COUNT_SHARDS",8)
+    for key in keys:
+        if not MediaCount.objects.filter(key=key, shard=random.randrange(shards)).update(count=F("count") + delta):
+            #The counter was made with fewer shards (DME_COUNT_SHARDS was raised) - shard 0 always exists
+            MediaCount.objects.filter(key=key, shard=0).update(count=F("count") + delta)
+
+def create_counter(key, count):
+    """
+    Create the DME_COUNT_SHARDS shards of a counter - shard 0 holds count
+    """
+    from media_explorer.models import MediaCount
+    MediaCount.objects.bulk_create([MediaCount(key=key, shard=shard, count=count if shard == 0 else 0)
+                                        for shard in range(getattr(settings,"DME_COUNT_SHARDS",8))])
+
+def read_counter(key):
+    """
+    The sum of the shards of a counter - None when it does not exist
+    """
+    from media_explorer.models import MediaCount
+    total = MediaCount.objects.filter(key=key).aggregate(count=Sum("count"), shards=Count("id"))
+    if not total["shards"]:
+        return None
+    return total["count"]
+
+def get_total(key, queryset):
+    """
+    The counter of key - queryset.count() when it does not exist.
+    The counters are only made by rebuild_counts: an insert between a count and the creation
+    of the counter could not be added to it.
+    """
+    total = read_counter(key)
+    if total is not None:
+        return total
+    return queryset.count()
+
+def rebuild_counts():
+    """
+    Count the elements (per type) and the galleries again (update_counts command and after migrate)
+    The counter rows are locked while counting: an insert that has not committed yet waits to update its
+    shard until the new numbers are written, so it is never missed.
+    Returns {key: count}
+    """
+    from media_explorer.models import Element, Gallery, MediaCount
+    keys = total_keys("Element") + [total_keys("Element", type)[-1] for type, label in Element.TYPE_CHOICES] + total_keys("Gallery")
+
+    with transaction.atomic():
+        list(MediaCount.objects.select_for_update().filter(key__in=keys).order_by("key","shard").values_list("id", flat=True))
+
+        counts = dict((key, 0) for key in keys)
+        for row in Element.objects.values("type").annotate(count=Count("id")).order_by():
+            counts["Element:%s" % row["type"]] = row["count"]
+            counts["Element"] += row["count"]
+        counts["Gallery"] = Gallery.objects.count()
+
+        for key, count in counts.items():
+            if MediaCount.objects.filter(key=key, shard=0).update(count=count):
+                MediaCount.objects.filter(key=key).exclude(shard=0).update(count=0)
+            else:
+                create_counter(key, count)
+    return counts
+
+def estimated_count(queryset):
+    """
+    The planner's row estimate of queryset (PostgreSQL only - None elsewhere)
+    """
+    if connection.vendor != "postgresql":
+        return None
+    try:
+        sql, params = queryset.query.sql_with_params()
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+        plan = cursor.fetchone()[0]
+        if not isinstance(plan, list):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    except:
+        print traceback.format_exc()
+        return None
+
+def filtered_count(queryset, cache_key):
+    """
+    (count, approximate) of a filtered queryset, cached for DME_COUNT_CACHE_TTL seconds.
+    When the planner expects more than DME_COUNT_APPROXIMATE_THRESHOLD rows its estimate is used instead of a COUNT(*)
+    """
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    rtn = None
+    threshold = getattr(settings,"DME_COUNT_APPROXIMATE_THRESHOLD",None)
+    if threshold:
+        estimate = estimated_count(queryset)
+        if estimate is not None and estimate > threshold:
+            rtn = (estimate, True)
+    if rtn is None:
+        rtn = (queryset.count(), False)
+
+    cache.set(cache_key, rtn, getattr(settings,"DME_COUNT_CACHE_TTL",30))
+    return rtn
+
+def count_entries(queryset, params):
+    """
+    (count, approximate) of a queryset made by helpers.filter_elements or helpers.filter_galleries
+    Totals (no filter) come from the MediaCount counters, filtered counts from the cache
+    """
+    model = queryset.model
+    model_name = model.__name__
+    type = params.get('type', None) if model_name == "Element" else None
+    filter = params.get('filter', None)
+
+    types = [choice[0] for choice in getattr(model, "TYPE_CHOICES", [])]
+    if not search_terms(filter) and (not type or type in types):
+        return get_total(total_keys(model_name, type)[-1], queryset), False
+
+    key = "|".join([model_name, type or "", filter or "", getattr(settings,"DME_SEARCH_BACKEND","") or ""])
+    return filtered_count(queryset, "dme-count-" + hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+def explorer_stats(queryset, params):
+    """
+    The page size, number of entries and number of pages of the explorer
+    "approximate" is set when total_entries is the planner's estimate
+    """
+    data = {}
+    data["page_size"] = settings.DME_PAGE_SIZE
+    data["total_entries"], approximate = count_entries(queryset, params)
+    data["total_pages"] = int(math.ceil(float(data["total_entries"])/data["page_size"]))
+    if approximate:
+        data["approximate"] = True
+    return data
+
+#EOF
@@ -0,0 +1,205 @@
+import atexit, sys, threading, time, traceback
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections
+from django.db.models import get_model
+from django.utils.six.moves import queue
+
+def commit_hooks():
+    """
+    Check that callbacks can be run after the commit: transaction.on_commit (Django 1.9)
+    or connection.on_commit (django-transaction-hooks on Django 1.7 and 1.8)
+    """
+    return hasattr(transaction, "on_commit") or hasattr(connection, "on_commit")
+
+def on_commit(func):
+    """
+    Run func after the current transaction commits - right away outside a transaction
+    or when there are no commit hooks (see commit_hooks)
+    """
+    if not connection.in_atomic_block or not commit_hooks():
+        func()
+    elif hasattr(transaction, "on_commit"):
+        transaction.on_commit(func)
+    else:
+        connection.on_commit(func)
+
+def _registered(func):
+    for savepoints, registered in getattr(connection, "run_on_commit", None) or []:
+        if registered == func:
+            return True
+    return False
+
+class FileDeleter(object):
+    """
+    Deletes the files of deleted rows once the transaction commits.
+    The files are deleted by a pool of background threads (DME_DELETE_ASYNC) in batches, retrying the failures.
+    Right before a batch is deleted it is checked against the database with one query per field
+    (a file may be shared with a duplicate or written again by a new rendition meanwhile).
+    Outside a transaction, or without commit hooks (see commit_hooks), the files are queued right away.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        #Retries waiting for their delay
+        self.timers = set()
+
+    def delete(self, storage, name, references=None):
+        """
+        Delete name from storage unless a row still refers to it after the commit.
+        references is a list of (model name, field, value) e.g. [("ResizedImage","image_url",url)]
+        """
+        item = (storage, name, references or [])
+        if not connection.in_atomic_block or not commit_hooks():
+            self.flush([item])
+            return
+
+        batch = getattr(self.local, "batch", None)
+        #A new batch for each transaction and savepoint (the callback of a rolled back one is dropped)
+        savepoints = list(connection.savepoint_ids)
+        if batch is None or batch.savepoints != savepoints or not _registered(batch.flush):
+            batch = self.local.batch = _Batch(self, savepoints)
+            on_commit(batch.flush)
+        batch.items.append(item)
+
+    def flush(self, items):
+        """
+        Queue the files of items (see process)
+        """
+        if not items:
+            return
+
+        if getattr(settings,"DME_DELETE_ASYNC",True):
+            self.start()
+            for storage, name, references in items:
+                self.queue.put((storage, name, references, 0))
+        else:
+            self.process([(storage, name, references, 0) for storage, name, references in items], retry=False)
+
+    def unreferenced(self, items):
+        """
+        The items whose file no row refers to
+        """
+        referenced = set()
+        checks = {}
+        for storage, name, references, attempts in items:
+            for model, field, value in references:
+                checks.setdefault((model, field), set()).add(value)
+        for (model, field), values in checks.items():
+            queryset = get_model("media_explorer", model).objects.filter(**{field + "__in": list(values)})
+            referenced.update([(model, field, value) for value in queryset.values_list(field, flat=True)])
+
+        return [item for item in items if not [reference for reference in item[2] if reference in referenced]]
+
+    def start(self):
+        with self.lock:
+            while len(self.threads) < getattr(settings,"DME_DELETE_WORKERS",2):
+                thread = threading.Thread(target=self.run)
+                thread.daemon = True
+                thread.start()
+                self.threads.append(thread)
+
+    def run(self):
+        batch_size = getattr(settings,"DME_DELETE_BATCH_SIZE",100)
+        while True:
+            items = [self.queue.get()]
+            while len(items) < batch_size:
+                try:
+                    items.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.process(items)
+            except:
+                sys.stderr.write(traceback.format_exc())
+            finally:
+                close_old_connections()
+                for item in items:
+                    self.queue.task_done()
+
+    def process(self, items, retry=True):
+        """
+        Delete a batch of files that are not referenced any more - with storage.delete_many when the storage has it
+        Failed files are queued again after DME_DELETE_RETRY_DELAY seconds (doubled after each attempt)
+        or tried again right away when retry is False (synchronous deletes)
+        """
+        storages = {}
+        for storage, name, references, attempts in self.unreferenced(items):
+            storages.setdefault(id(storage), (storage, []))[1].append((name, references, attempts))
+
+        max_attempts = getattr(settings,"DME_DELETE_RETRIES",3) + 1
+        for storage, names in storages.values():
+            failed = []
+            try:
+                if hasattr(storage, "delete_many"):
+                    storage.delete_many([name for name, references, attempts in names])
+                else:
+                    for name, references, attempts in names:
+                        try:
+                            storage.delete(name)
+                        except Exception as e:
+                            failed.append((name, references, attempts, traceback.format_exc()))
+            except Exception as e:
+                error = traceback.format_exc()
+                failed = [(name, references, attempts, error) for name, references, attempts in names]
+
+            for name, references, attempts, error in failed:
+                attempts += 1
+                if attempts >= max_attempts:
+                    sys.stderr.write("Could not delete %s after %s attempts\n%s" % (name, attempts, error))
+                elif retry:
+                    self.retry((storage, name, references, attempts), getattr(settings,"DME_DELETE_RETRY_DELAY",5)*2**(attempts - 1))
+                else:
+                    self.process([(storage, name, references, attempts)], retry=False)
+
+    def retry(self, item, delay):
+        def put():
+            self.queue.put(item)
+            with self.lock:
+                self.timers.discard(timer)
+
+        timer = threading.Timer(delay, put)
+        timer.daemon = True
+        with self.lock:
+            self.timers.add(timer)
+        timer.start()
+
+    def wait(self, timeout=None):
+        """
+        Wait until the queued files and the retries are deleted (or given up)
+        Returns False when timeout seconds passed first
+        """
+        started = time.time()
+        while True:
+            with self.lock:
+                pending = self.queue.unfinished_tasks + len(self.timers)
+            if not pending:
+                return True
+            if timeout is not None and time.time() - started >= timeout:
+                return False
+            time.sleep(0.05)
+
+class _Batch(object):
+
+    def __init__(self, deleter, savepoints):
+        self.deleter = deleter
+        self.savepoints = savepoints
+        self.items = []
+
+    def flush(self):
+        if getattr(self.deleter.local, "batch", None) is self:
+            self.deleter.local.batch = None
+        self.deleter.flush(self.items)
+
+file_deleter = FileDeleter()
+
+def _wait_at_exit():
+    #The workers are daemon threads - do not drop the files still queued when the process ends
+    if not file_deleter.wait(getattr(settings,"DME_DELETE_EXIT_TIMEOUT",60)):
+        sys.stderr.write("Files were still being deleted at exit\n")
+
+atexit.register(_wait_at_exit)
+
+#EOF
@@ -1,15 +1,28 @@
 from django.http import Http404
-import traceback
-from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage
+import re, traceback
+from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage, Upload
+from media_explorer.helpers import file_content_hash, find_duplicate, share_renditions, check_image_file, filter_elements, filter_galleries
+from media_explorer.similarity import image_phash, similarity_index
+from media_explorer.pagination import cursor_page
+from media_explorer.counts import explorer_stats
+from media_explorer.search import get_search_backend
+from media_explorer.uploads import start_upload, save_chunk, assemble_upload, delete_chunks
 from rest_framework import generics, serializers, viewsets
 from rest_framework import views, response, status, parsers
 from django.conf import settings
-from django.db.models import Q
+from django.db import transaction
+from django.db.models import F
+
+try:
+	from PIL import Image
+except ImportError:
+	import Image
 
 class ElementSerializer(serializers.ModelSerializer):
     class Meta:
         model = Element
-        fields = ('id','name','file_name','type','credit','description','thumbnail_image_url','image_url','video_url','video_embed','created_at')
+        fields = ('id','name','file_name','type','status','credit','description','thumbnail_image_url','image_url','phash','placeholder','dominant_color','video_url','video_embed','created_at')
+        read_only_fields = ('phash','placeholder','dominant_color')
 
     def update(self, instance, validated_data):
         for field in validated_data:
@@ -18,6 +31,58 @@ class ElementSerializer(serializers.ModelSerializer):
         instance.save()
         return instance
 
+def save_image_element(serializer, image, thumbnail_image=None):
+    """
+    Save a new image element from a valid ElementSerializer
+    An image with the same content as an existing one is handled as set by DME_DEDUPE
+    """
+    content_hash = file_content_hash(image)
+    duplicate = find_duplicate(content_hash)
+    if duplicate and getattr(settings,"DME_DEDUPE",None) == "reuse":
+        return duplicate
+
+    #The element is written once with everything it needs
+    fields = {}
+    fields["content_hash"] = content_hash
+    if duplicate:
+        #Point to the original we already have so it is not resized again
+        fields["image"] = duplicate.image.name
+        fields["original_file_name"] = duplicate.file_name
+    else:
+        fields["image"] = image
+
+    if thumbnail_image:
+        fields["thumbnail_image"] = thumbnail_image
+
+    with transaction.atomic():
+        element = serializer.save(**fields)
+        if duplicate:
+            share_renditions(element, duplicate)
+
+    if duplicate:
+        element = Element.objects.get(id=element.id)
+
+    return element
+
+def cursor_response(request, queryset, serializer_class):
+    """
+    A keyset page of queryset: {"results":[...], "next":cursor, "previous":cursor}
+    Pass cursor= (empty) for the first page and the next or previous cursor after that
+    counts=1 adds the explorer stats (see counts.explorer_stats)
+    """
+    try:
+        page = cursor_page(queryset,
+            sort=request.QUERY_PARAMS.get('sort', "created_at"),
+            direction=request.QUERY_PARAMS.get('direction', "desc"),
+            cursor=request.QUERY_PARAMS.get('cursor', None))
+    except ValueError as e:
+        return response.Response(str(e), status=status.HTTP_400_BAD_REQUEST)
+
+    page["results"] = serializer_class(page["results"], many=True).data
+    if request.QUERY_PARAMS.get('counts', None):
+        page.update(explorer_stats(queryset, request.QUERY_PARAMS))
+    return response.Response(page)
+
 class ElementList(views.APIView):
     """
     List all Elements or create a new element
@@ -25,41 +90,18 @@ class ElementList(views.APIView):
     queryset = Element.objects.none()
 
     def get_queryset(self):
-        #NOTE: Code below must match ElementStatsView.get
-        #TODO - move to helper so you don't maintain same code twice
-        query = None
-        and_query = None
-        or_query = None
-        type = self.request.QUERY_PARAMS.get('type', None)
+        #NOTE: ElementStatsView counts the same elements (see helpers.filter_elements)
         filter = self.request.QUERY_PARAMS.get('filter', None)
         sort = self.request.QUERY_PARAMS.get('sort', "created_at")
         direction = self.request.QUERY_PARAMS.get('direction', "desc")
         page = int(self.request.QUERY_PARAMS.get('page', 1))
         limit = settings.DME_PAGE_SIZE
 
-        try:
-            if type:
-                and_query = Q(type=type)
-        except Exception as e:
-            pass
+        queryset = filter_elements(self.request.QUERY_PARAMS)
 
-        if filter:
-            try:
-                filter_list = filter.split(" ")
-                or_query = Q(name__icontains=filter_list[0]) | Q(description__icontains=filter_list[0]) | Q(credit__icontains=filter_list[0])
-                for term in filter_list[1:]:
-                    or_query.add((Q(name__icontains=term) | Q(description__icontains=term) | Q(credit__icontains=term)), or_query.connector)
-            except Exception as e:
-                pass
-
-        if and_query:
-            query = and_query
-
-        if or_query:
-            if query:
-                query.add(or_query,Q.AND)
-            else:
-                query = or_query
+        if "cursor" in self.request.QUERY_PARAMS:
+            #Keyset pagination - the caller slices the page (see cursor_page)
+            return queryset
 
         offset = (page-1)*limit
         next_offset = limit + offset
@@ -68,18 +110,25 @@ class ElementList(views.APIView):
         if direction.lower() == "asc":
             order_by = sort
 
-        if query:
-            queryset = Element.objects.order_by(order_by).filter(query)[offset:next_offset]
+        if sort == "relevance":
+            queryset = get_search_backend().rank(queryset, filter or "")
         else:
-            queryset = Element.objects.order_by(order_by).all()[offset:next_offset]
+            queryset = queryset.order_by(order_by)
 
-        return queryset
+        return queryset[offset:next_offset]
 
     def get(self, request, format=None):
         #Don't use self.queryset - it's cached
         #elements = self.queryset
         elements = self.get_queryset()
+        if "cursor" in request.QUERY_PARAMS:
+            return cursor_response(request, elements, ElementSerializer)
         serializer = ElementSerializer(elements, many=True)
+        if request.QUERY_PARAMS.get('counts', None):
+            #The explorer stats with the page - one request instead of two
+            data = explorer_stats(filter_elements(request.QUERY_PARAMS), request.QUERY_PARAMS)
+            data["results"] = serializer.data
+            return response.Response(data)
         return response.Response(serializer.data)
 
     def post(self, request, format=None):
@@ -94,24 +143,85 @@ class ElementList(views.APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
+        if "image" in request.FILES:
+            rtn = check_image_file(request.FILES["image"])
+            if not rtn["success"]:
+                return response.Response(rtn["message"], status=status.HTTP_400_BAD_REQUEST)
+
         serializer = ElementSerializer(data=request.DATA)
         if serializer.is_valid():
-            serializer.save()
-            element = Element.objects.get(id=serializer.data["id"])
-            if request.FILES:
-                if "image" in request.FILES:
-                    element.image = request.FILES['image']
-
+            if "image" in request.FILES:
+                element = save_image_element(serializer, request.FILES["image"], request.FILES.get("thumbnail_image"))
+            else:
+                fields = {}
                 if "thumbnail_image" in request.FILES:
-                    element.thumbnail_image = request.FILES['thumbnail_image']
-
-                element.save()
+                    fields["thumbnail_image"] = request.FILES['thumbnail_image']
+                with transaction.atomic():
+                    element = serializer.save(**fields)
 
             serializer = ElementSerializer(element)
             return response.Response(serializer.data)
 
         return response.Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+class SimilarElementList(views.APIView):
+    """
+    List the images that look like an image (near-duplicates)
+    GET with element_id or phash - or POST an image (before uploading it)
+    distance is the largest number of different hash bits (DME_PHASH_DISTANCE by default)
+    """
+    queryset = Element.objects.none()
+
+    def get_distance(self, request):
+        try:
+            return min(int(request.QUERY_PARAMS.get("distance", getattr(settings,"DME_PHASH_DISTANCE",6))), 64)
+        except ValueError:
+            return getattr(settings,"DME_PHASH_DISTANCE",6)
+
+    def similar(self, phash, distance, exclude_id=None):
+        data = []
+        for element, element_distance in similarity_index.search(phash, distance):
+            if element.id == exclude_id:
+                continue
+            item = ElementSerializer(element).data
+            item["distance"] = element_distance
+            data.append(item)
+        return response.Response(data)
+
+    def get(self, request, format=None):
+        phash = request.QUERY_PARAMS.get("phash", None)
+        element_id = request.QUERY_PARAMS.get("element_id", None)
+        exclude_id = None
+
+        if element_id:
+            try:
+                element = Element.objects.get(id=element_id)
+            except (Element.DoesNotExist, ValueError):
+                raise Http404
+            phash = element.phash
+            exclude_id = element.id
+
+        if not phash or not re.match(r"^[0-9a-fA-F]{16}$", phash):
+            return response.Response("Provide an element_id of an image or a 16 character phash", status=status.HTTP_400_BAD_REQUEST)
+
+        return self.similar(phash.lower(), self.get_distance(request), exclude_id)
+
+    def post(self, request, format=None):
+        if "image" not in request.FILES:
+            return response.Response("Provide an image", status=status.HTTP_400_BAD_REQUEST)
+
+        image = request.FILES["image"]
+        rtn = check_image_file(image)
+        if not rtn["success"]:
+            return response.Response(rtn["message"], status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            phash = image_phash(Image.open(image))
+        except Exception as e:
+            return response.Response("The file is not an image that can be read", status=status.HTTP_400_BAD_REQUEST)
+
+        return self.similar(phash, self.get_distance(request))
+
 class ElementDetail(views.APIView):
     """
     Retrieve, update or delete an element instance
@@ -134,19 +244,23 @@ class ElementDetail(views.APIView):
         try:
 
             element = self.get_object(pk)
+            if "image" in request.FILES:
+                rtn = check_image_file(request.FILES["image"])
+                if not rtn["success"]:
+                    return response.Response(rtn["message"], status=status.HTTP_400_BAD_REQUEST)
+
             serializer = ElementSerializer(element, data=request.DATA)
             if serializer.is_valid():
-                serializer.save()
-
-                element = Element.objects.get(id=serializer.data["id"])
-                if request.FILES:
-                    if "image" in request.FILES:
-                        element.image = request.FILES['image']
+                fields = {}
+                if "image" in request.FILES:
+                    fields["content_hash"] = file_content_hash(request.FILES['image'])
+                    fields["image"] = request.FILES['image']
 
-                    if "thumbnail_image" in request.FILES:
-                        element.thumbnail_image = request.FILES['thumbnail_image']
+                if "thumbnail_image" in request.FILES:
+                    fields["thumbnail_image"] = request.FILES['thumbnail_image']
 
-                    element.save()
+                with transaction.atomic():
+                    element = serializer.save(**fields)
 
                 serializer = ElementSerializer(element)
                 return response.Response(serializer.data)
@@ -161,10 +275,182 @@ class ElementDetail(views.APIView):
         element.delete()
         return response.Response(status=status.HTTP_204_NO_CONTENT)
 
+class UploadSerializer(serializers.ModelSerializer):
+    chunk_size = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Upload
+        fields = ('token','file_name','size','offset','status','element','chunk_size','created_at')
+
+    def get_chunk_size(self, obj):
+        return getattr(settings,"DME_UPLOAD_CHUNK_SIZE",5*1024*1024)
+
+class UploadList(views.APIView):
+    """
+    Start a chunked upload
+    POST file_name and size (in bytes) - plus name, credit and description for the new element
+    or element_id to replace the image of an existing element
+    """
+    queryset = Element.objects.none()
+
+    def post(self, request, format=None):
+        try:
+            size = int(request.DATA.get("size", 0))
+        except (TypeError, ValueError):
+            size = 0
+
+        if not request.DATA.get("file_name") or size <= 0:
+            return response.Response(
+                "Provide a file_name and a size",
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        max_size = getattr(settings,"DME_UPLOAD_MAX_SIZE",None)
+        if max_size and size > max_size:
+            return response.Response(
+                "Uploads can not be larger than %s bytes" % max_size,
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        element = None
+        if request.DATA.get("element_id"):
+            try:
+                element = Element.objects.get(id=request.DATA["element_id"],type="image")
+            except (Element.DoesNotExist, ValueError):
+                raise Http404
+
+        upload = start_upload(request.DATA["file_name"], size,
+            user=request.user if request.user.is_authenticated() else None,
+            element=element,
+            name=request.DATA.get("name"),
+            credit=request.DATA.get("credit"),
+            description=request.DATA.get("description"),
+        )
+        serializer = UploadSerializer(upload)
+        return response.Response(serializer.data, status=status.HTTP_201_CREATED)
+
+class UploadDetail(views.APIView):
+    """
+    Get the offset of a chunked upload (to resume it) or cancel it
+    """
+    queryset = Element.objects.none()
+
+    def get_object(self, token):
+        try:
+            return Upload.objects.get(token=token)
+        except Upload.DoesNotExist:
+            raise Http404
+
+    def get(self, request, token, format=None):
+        serializer = UploadSerializer(self.get_object(token))
+        return response.Response(serializer.data)
+
+    def delete(self, request, token, format=None):
+        upload = self.get_object(token)
+        delete_chunks(upload)
+        upload.delete()
+        return response.Response(status=status.HTTP_204_NO_CONTENT)
+
+class UploadChunk(UploadDetail):
+    """
+    POST a chunk (multipart "chunk" file) and the offset it starts at
+    Chunks are sent in order - the response has the offset of the next chunk
+    """
+
+    def post(self, request, token, format=None):
+        upload = self.get_object(token)
+        if "chunk" not in request.FILES:
+            return response.Response("Provide a chunk", status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            offset = int(request.DATA.get("offset", 0))
+        except (TypeError, ValueError):
+            return response.Response("Invalid offset", status=status.HTTP_400_BAD_REQUEST)
+
+        rtn = save_chunk(upload, offset, request.FILES["chunk"])
+        data = {"token":upload.token,"offset":rtn["offset"],"size":upload.size}
+        if not rtn["success"]:
+            data["message"] = rtn["message"]
+            return response.Response(data, status=status.HTTP_409_CONFLICT)
+        return response.Response(data)
+
+class UploadFinish(UploadDetail):
+    """
+    Join the chunks and create the element (or replace the image of the upload element)
+    """
+
+    def post(self, request, token, format=None):
+        upload = self.get_object(token)
+
+        #Claim the upload so a retried finish does not build the file and the element twice
+        claimed = Upload.objects.filter(id=upload.id,status="uploading",offset=F("size")).update(status="finishing")
+        if not claimed:
+            upload = self.get_object(token)
+            if upload.status == "complete":
+                serializer = ElementSerializer(upload.element)
+                return response.Response(serializer.data)
+            if upload.status == "finishing":
+                return response.Response(
+                    {"token":upload.token,"message":"The upload is being finished"},
+                    status=status.HTTP_409_CONFLICT
+                )
+            return response.Response(
+                {"token":upload.token,"offset":upload.offset,"size":upload.size,"message":"The upload is not complete"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            element = self.finish(upload)
+        except:
+            #Let the client try again
+            Upload.objects.filter(id=upload.id,status="finishing").update(status="uploading")
+            raise
+
+        if not isinstance(element, Element):
+            Upload.objects.filter(id=upload.id,status="finishing").update(status="uploading")
+            return element
+
+        delete_chunks(upload)
+        Upload.objects.filter(id=upload.id).update(status="complete",element=element)
+
+        serializer = ElementSerializer(Element.objects.get(id=element.id))
+        return response.Response(serializer.data)
+
+    def finish(self, upload):
+        """
+        Join the chunks and save the element - returns the element or an error response
+        """
+        try:
+            image = assemble_upload(upload)
+        except ValueError as e:
+            return response.Response(e.__str__(), status=status.HTTP_400_BAD_REQUEST)
+
+        rtn = check_image_file(image)
+        if not rtn["success"]:
+            image.close()
+            return response.Response(rtn["message"], status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            if upload.element:
+                element = upload.element
+                element.content_hash = file_content_hash(image)
+                element.image = image
+                with transaction.atomic():
+                    element.save()
+            else:
+                serializer = ElementSerializer(data={"name":upload.name,"credit":upload.credit,"description":upload.description})
+                if not serializer.is_valid():
+                    return response.Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+                element = save_image_element(serializer, image)
+        finally:
+            image.close()
+
+        return element
+
 class ResizedImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ResizedImage
-        fields = ('id','image','file_name','size','image_url','image_width','image_height','created_at')
+        fields = ('id','image','file_name','size','format','image_url','image_width','image_height','created_at')
 
 class ResizedImageList(views.APIView):
     """
@@ -174,15 +460,27 @@ class ResizedImageList(views.APIView):
 
     def get_queryset(self):
         element_id = self.request.QUERY_PARAMS.get('element_id', None)
+        image_format = self.request.QUERY_PARAMS.get('image_format', None)
         queryset = ResizedImage.objects.none()
         if element_id is not None:
-            queryset = ResizedImage.objects.filter(image_id=element_id)
+            queryset = ResizedImage.objects.filter(image_id=element_id).order_by("id")
+            if image_format:
+                queryset = queryset.filter(format=image_format)
         return queryset
 
     def get(self, request, format=None):
         #Don't use self.queryset - it's cached
         #elements = self.queryset
         images = self.get_queryset()
+        if not self.request.QUERY_PARAMS.get('image_format', None):
+            #Only list the original format of each size (the first one created)
+            sizes = set()
+            original_images = []
+            for image in images:
+                if image.size not in sizes:
+                    sizes.add(image.size)
+                    original_images.append(image)
+            images = original_images
         serializer = ResizedImageSerializer(images, many=True)
         return response.Response(serializer.data)
 
@@ -204,7 +502,8 @@ class GallerySerializer(serializers.ModelSerializer):
     elements = GalleryElementSerializer(source='galleryelement_set', many=True, required=False, read_only=True)
     class Meta:
         model = Gallery
-        fields = ('id','name','description','thumbnail_image_url','elements','created_at')
+        fields = ('id','name','description','thumbnail_image_url','cover_element','elements','created_at')
+        read_only_fields = ('cover_element',)
 
     def validate_name(self, value):
         """
@@ -221,40 +520,18 @@ class GalleryList(views.APIView):
     queryset = Gallery.objects.all()
 
     def get_queryset(self, id=None):
-        #NOTE: Code below must match GalleryStatsView.get
-        #TODO - move to helper so you don't maintain same code twice
-        query = None
-        and_query = None
-        or_query = None
+        #NOTE: GalleryStatsView counts the same galleries (see helpers.filter_galleries)
         filter = self.request.QUERY_PARAMS.get('filter', None)
         sort = self.request.QUERY_PARAMS.get('sort', "created_at")
         direction = self.request.QUERY_PARAMS.get('direction', "desc")
         page = int(self.request.QUERY_PARAMS.get('page', 1))
         limit = settings.DME_PAGE_SIZE
 
-        try:
-            if id:
-                and_query = Q(id=id)
-        except Exception as e:
-            pass
+        queryset = filter_galleries(self.request.QUERY_PARAMS, id)
 
-        if filter:
-            try:
-                filter_list = filter.split(" ")
-                or_query = Q(name__icontains=filter_list[0]) | Q(description__icontains=filter_list[0])
-                for term in filter_list[1:]:
-                    or_query.add((Q(name__icontains=term) | Q(description__icontains=term)), or_query.connector)
-            except Exception as e:
-                pass
-
-        if and_query:
-            query = and_query
-
-        if or_query:
-            if query:
-                query.add(or_query,Q.AND)
-            else:
-                query = or_query
+        if "cursor" in self.request.QUERY_PARAMS and not id:
+            #Keyset pagination - the caller slices the page (see cursor_page)
+            return queryset
 
         offset = (page-1)*limit
         next_offset = limit + offset
@@ -263,18 +540,25 @@ class GalleryList(views.APIView):
         if direction.lower() == "asc":
             order_by = sort
 
-        if query:
-            queryset = Gallery.objects.order_by(order_by).filter(query)[offset:next_offset]
+        if sort == "relevance":
+            queryset = get_search_backend().rank(queryset, filter or "")
         else:
-            queryset = Gallery.objects.order_by(order_by).all()[offset:next_offset]
+            queryset = queryset.order_by(order_by)
 
-        return queryset
+        return queryset[offset:next_offset]
 
     def get(self, request, format=None):
         #Don't use self.queryset - it's cached
         #elements = self.queryset
         elements = self.get_queryset()
+        if "cursor" in request.QUERY_PARAMS:
+            return cursor_response(request, elements, GallerySerializer)
         serializer = GallerySerializer(elements, many=True)
+        if request.QUERY_PARAMS.get('counts', None):
+            #The explorer stats with the page - one request instead of two
+            data = explorer_stats(filter_galleries(request.QUERY_PARAMS), request.QUERY_PARAMS)
+            data["results"] = serializer.data
+            return response.Response(data)
         return response.Response(serializer.data)
 
     def post(self, request, format=None):
@@ -316,9 +600,7 @@ class GalleryList(views.APIView):
                         sort_by += 1
                     count += 1
 
-                #Save the gallery again so the thumbnail_image_url is set
-                gallery.save()
-
+                #The cover (thumbnail_image_url) was set by the GalleryElement signals
                 serializer = GallerySerializer(self.get_queryset(gallery.id), many=True)
 
             return response.Response(serializer.data)
@@ -389,10 +671,8 @@ class GalleryDetail(views.APIView):
                         sort_by += 1
                     count += 1
 
-                #Save the gallery again so the thumbnail_image_url is set
-                gallery.save()
-
-                serializer = GallerySerializer(gallery)
+                #The cover (thumbnail_image_url) was set by the GalleryElement signals
+                serializer = GallerySerializer(Gallery.objects.get(id=gallery.id))
 
             return response.Response(serializer.data)
 
@@ -1,9 +1,12 @@
-import json
+import os, json
+from django.conf import settings
 from django.db import models
 from django.core.exceptions import ValidationError
 from django.utils.translation import ugettext_lazy as _
 from media_explorer.models import Element, Gallery
 from media_explorer.forms import MediaFormField, RichTextFormField
+from media_explorer.helpers import file_content_hash, find_duplicate, share_renditions, check_image_file
+from media_explorer.deletions import file_deleter
 
 from django.db.models import signals, FileField
 from django.forms import forms
@@ -264,6 +267,12 @@ class MediaImageField(FileField):
                 file._size > self.max_upload_size:
             raise forms.ValidationError(_('Please keep filesize under %s. Current filesize %s') % (filesizeformat(self.max_upload_size), filesizeformat(file._size)))
 
+        #Only the image header is read - large images are refused before they are decoded
+        if content_type:
+            rtn = check_image_file(file)
+            if not rtn["success"]:
+                raise forms.ValidationError(rtn["message"])
+
         return data
 
     def contribute_to_class(self, cls, name, **kwargs):
@@ -277,12 +286,37 @@ class MediaImageField(FileField):
         """
         if self.new_upload and \
                 type(instance.__dict__[self.name]) in [str,unicode]:
+            field_file = getattr(instance, self.name)
+            content_hash = None
+            try:
+                content_hash = file_content_hash(field_file)
+            except Exception as e:
+                pass
+
+            duplicate = find_duplicate(content_hash)
+            if duplicate and getattr(settings,"DME_DEDUPE",None) == "reuse":
+                #Point the model to the image we already have and delete the new copy
+                #NOTE: we use update() here so the post_save signal does not run again
+                if field_file.name != duplicate.image.name:
+                    type(instance)._default_manager.filter(pk=instance.pk).update(**{self.attname: duplicate.image.name})
+                    instance.__dict__[self.attname] = duplicate.image.name
+                    file_deleter.delete(field_file.storage, field_file.name,
+                            [("Element","image",field_file.name),("Element","thumbnail_image",field_file.name)])
+                return
+
             data = {}
             data["image"] = instance.__dict__[self.name]
+            data["content_hash"] = content_hash
             element = Element()
             element.__dict__.update(data)
+            if duplicate:
+                #Do not resize the same image again
+                element.original_file_name = os.path.basename(field_file.name)
             element.save()
 
+            if duplicate:
+                share_renditions(element, duplicate)
+
     #def on_post_delete_callback(self, instance, force=False, *args, **kwargs):
     #    """
     #    TODO
@@ -1,12 +1,352 @@
-import os, re
+import os, re, math, time, hashlib, posixpath, tempfile
+import multiprocessing
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
 from django.db.models import get_model
+from .storage import get_storage, storage_name
 
 try:
-	from PIL import Image, ImageOps
+	from PIL import Image, ImageOps, ImageChops, ImageStat
 except ImportError:
 	import Image
 	import ImageOps
+	import ImageChops
+	import ImageStat
+
+#AVIF support for Pillow versions that do not have it built in
+try:
+	import pillow_avif
+except ImportError:
+	pass
+
+def file_content_hash(file):
+    """
+    SHA-256 of a Django File (or UploadedFile) read in chunks
+    """
+    sha = hashlib.sha256()
+    for chunk in file.chunks():
+        sha.update(chunk)
+    file.seek(0)
+    return sha.hexdigest()
+
+def decoded_size(image):
+    """
+    Bytes needed to hold the decoded image (read from the header - the image is not decoded)
+    """
+    if image.mode in ["I","F"]:
+        bytes_per_band = 4
+    elif image.mode.startswith("I;16"):
+        bytes_per_band = 2
+    else:
+        bytes_per_band = 1
+    return image.size[0]*image.size[1]*len(image.getbands())*bytes_per_band
+
+#Reduced scales the JPEG decoder can decode at (see Image.draft)
+_DRAFT_SCALES = [1, 1/2.0, 1/4.0, 1/8.0]
+
+def check_image_budget(image):
+    """
+    Check an opened (not yet decoded) image against DME_MAX_IMAGE_PIXELS and DME_MAX_DECODE_MEMORY.
+    rtn["scale"] is the largest decode scale that fits the memory budget - less than 1 when
+    a large JPEG has to be decoded at a reduced scale. Other formats have to be decoded
+    in full so they are rejected when they do not fit.
+    """
+    rtn = {}
+    rtn["success"] = False
+    rtn["message"] = ""
+    rtn["scale"] = 1
+
+    width, height = image.size
+    max_pixels = getattr(settings,"DME_MAX_IMAGE_PIXELS",None)
+    if max_pixels and width*height > max_pixels:
+        rtn["message"] = "The image is %sx%s (%.1f megapixels). Images can not be larger than %.1f megapixels." % (
+            width, height, width*height/1000000.0, max_pixels/1000000.0)
+        return rtn
+
+    max_memory = getattr(settings,"DME_MAX_DECODE_MEMORY",None)
+    memory = decoded_size(image)
+    if max_memory and memory > max_memory:
+        scales = [scale for scale in _DRAFT_SCALES if memory*scale*scale <= max_memory]
+        if image.format != "JPEG" or not scales:
+            rtn["message"] = "The image is %sx%s. Decoding it needs %.0f MB, more than the %.0f MB allowed." % (
+                width, height, memory/1048576.0, max_memory/1048576.0)
+            return rtn
+        rtn["scale"] = scales[0]
+
+    rtn["success"] = True
+    return rtn
+
+def check_image_file(file):
+    """
+    Same as check_image_budget for a Django File (e.g. an upload) - only the header is read
+    """
+    rtn = {"success":False,"message":"","scale":1}
+    try:
+        file.seek(0)
+        image = Image.open(file)
+        rtn = check_image_budget(image)
+    except getattr(Image, "DecompressionBombError", ()) as e:
+        #Pillow refuses images over twice its own MAX_IMAGE_PIXELS
+        rtn["message"] = "The image is too large to be decoded safely."
+    except (IOError, SyntaxError) as e:
+        #Pillow can not read it (IOError) or the file is broken (SyntaxError)
+        rtn["message"] = "The file is not an image that can be read."
+    file.seek(0)
+    return rtn
+
+#EXIF orientation tag
+_ORIENTATION = 0x0112
+
+def exif_orientation(image):
+    """
+    EXIF orientation (1-8) of an opened image - 1 when it has none
+    """
+    try:
+        if hasattr(image, "getexif"):
+            exif = image.getexif()
+        else:
+            exif = image._getexif()
+        return int((exif or {}).get(_ORIENTATION, 1))
+    except Exception as e:
+        return 1
+
+def displayed_size(width, height, orientation):
+    """
+    (width, height) of an image as it is shown: orientations 5 to 8 are turned a quarter, so they are swapped
+    """
+    if orientation in (5, 6, 7, 8):
+        return height, width
+    return width, height
+
+def probe_image(file):
+    """
+    Read the format, dimensions and EXIF orientation (1-8) of an image from its header
+    The image is not decoded. file is any open file object (it is not closed).
+    NOTE: width and height are the stored pixels - see displayed_size for the size on screen
+    """
+    rtn = {}
+    rtn["success"] = False
+    rtn["message"] = ""
+    rtn["format"] = None
+    rtn["width"] = 0
+    rtn["height"] = 0
+    rtn["orientation"] = 1
+
+    try:
+        image = Image.open(file)
+        rtn["format"] = (image.format or "").lower()
+        rtn["width"], rtn["height"] = image.size
+        rtn["orientation"] = exif_orientation(image)
+    except Exception as e:
+        rtn["message"] = e.__str__()
+        return rtn
+
+    rtn["success"] = True
+    return rtn
+
+def probe_stored_image(storage, name):
+    """
+    Same as probe_image for a file in a storage
+    """
+    try:
+        file = storage.open(name, "rb")
+    except Exception as e:
+        return {"success":False,"message":e.__str__(),"format":None,"width":0,"height":0,"orientation":1}
+    try:
+        return probe_image(file)
+    finally:
+        file.close()
+
+def stored_image_phash(storage, name):
+    """
+    Perceptual hash of an image in a storage (None when it can not be read or is over the memory budget)
+    """
+    from .similarity import image_phash, DCT_SIZE
+    try:
+        file = storage.open(name, "rb")
+    except Exception as e:
+        return None
+    try:
+        image = Image.open(file)
+        if image.format != "JPEG" and not check_image_budget(image)["success"]:
+            return None
+        if image.format == "JPEG" and exif_orientation(image) != 1:
+            #Turned upright (as the rendition job hashes it) at the smallest DCT scale
+            image.draft("L", (DCT_SIZE, DCT_SIZE))
+        return image_phash(_upright(image))
+    except Exception as e:
+        return None
+    finally:
+        file.close()
+
+def can_save_format(format):
+    """
+    Check that Pillow can write an image format (e.g. webp, avif)
+    """
+    Image.init()
+    return format.upper() in Image.SAVE
+
+def encoding_profile(size_class):
+    """
+    The encoding options of a size class (DME_RESIZE_PROFILES "default" updated with the size class ones)
+    """
+    profiles = getattr(settings,"DME_RESIZE_PROFILES",{})
+    profile = dict(profiles.get("default", {}))
+    profile.update(profiles.get(size_class, {}))
+    return profile
+
+def accepted_types(accept):
+    """
+    {media type: q} of an HTTP Accept header e.g. "image/webp,image/*;q=0.8" -> {"image/webp":1.0,"image/*":0.8}
+    """
+    types = {}
+    for part in (accept or "").lower().split(","):
+        params = [param.strip() for param in part.split(";")]
+        if not params[0]:
+            continue
+        q = 1.0
+        for param in params[1:]:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        types[params[0]] = q
+    return types
+
+def pick_resized_image(resized_images, accept=None):
+    """
+    Pick the best format of one rendition size for an HTTP Accept header.
+    Only the formats the header names (with q > 0) are picked - image/* does not say a browser decodes webp or avif.
+    resized_images should be ordered by id - the first one has the format of the original
+    """
+    resized_images = list(resized_images)
+    if not resized_images:
+        return None
+
+    types = accepted_types(accept)
+    for format in getattr(settings,"DME_RESIZE_FORMAT_PREFERENCE",["avif","webp"]):
+        if types.get("image/" + format, 0) > 0:
+            for ri in resized_images:
+                if ri.format == format:
+                    return ri
+
+    return resized_images[0]
+
+def find_duplicate(content_hash):
+    """
+    Return the first ready image with the same content (when DME_DEDUPE is set)
+    """
+    if not content_hash or not getattr(settings,"DME_DEDUPE",None):
+        return None
+
+    Element = get_model("media_explorer","Element")
+    return Element.objects.filter(content_hash=content_hash,type="image",status="ready") \
+            .exclude(image="").exclude(image__isnull=True).order_by("id").first()
+
+def share_renditions(element, duplicate):
+    """
+    Give the element copies of the duplicate's ResizedImage rows and thumbnail
+    so nothing has to be resized again - the files themselves are shared
+    """
+    Element = get_model("media_explorer","Element")
+    ResizedImage = get_model("media_explorer","ResizedImage")
+
+    copies = []
+    for ri in ResizedImage.objects.filter(image=duplicate).order_by("id"):
+        ri.id = None
+        ri.image = element
+        copies.append(ri)
+    ResizedImage.objects.bulk_create(copies)
+
+    Element.objects.filter(id=element.id).update(
+        thumbnail_image=duplicate.thumbnail_image.name or "",
+        thumbnail_image_url=duplicate.thumbnail_image_url,
+        image_width=duplicate.image_width,
+        image_height=duplicate.image_height,
+        phash=duplicate.phash,
+        placeholder=duplicate.placeholder,
+        dominant_color=duplicate.dominant_color,
+        status=duplicate.status,
+    )
+
+def filter_elements(params):
+    """
+    The elements matching the explorer parameters (type and filter)
+    Shared by the element list and the element stats so they always agree
+    """
+    Element = get_model("media_explorer","Element")
+    queryset = Element.objects.all()
+
+    type = params.get('type', None)
+    if type:
+        queryset = queryset.filter(type=type)
+
+    #Every term of the filter must match (see media_explorer.search)
+    filter = params.get('filter', None)
+    if filter:
+        from .search import get_search_backend
+        queryset = get_search_backend().filter(queryset, filter)
+
+    return queryset
+
+def filter_galleries(params, id=None):
+    """
+    The galleries matching the explorer parameters (filter)
+    Shared by the gallery list and the gallery stats so they always agree
+    """
+    Gallery = get_model("media_explorer","Gallery")
+    queryset = Gallery.objects.all()
+
+    if id:
+        queryset = queryset.filter(id=id)
+
+    filter = params.get('filter', None)
+    if filter:
+        from .search import get_search_backend
+        queryset = get_search_backend().filter(queryset, filter)
+
+    return queryset
+
+class SingleFlight(object):
+    """
+    Lets a single caller (thread, process or server) at a time do the work for a key.
+    Other callers wait until it is done - they should then check whether
+    the work still needs to be done.
+    NOTE: this relies on cache.add being atomic so use a shared cache (memcached, redis, db)
+    when you run more than one process.
+    """
+
+    def __init__(self, key, timeout=None, poll=0.1):
+        self.key = "dme-single-flight-" + key
+        self.timeout = timeout or getattr(settings,"DME_SINGLE_FLIGHT_TIMEOUT",60)
+        self.poll = poll
+
+    def __enter__(self):
+        waited = 0
+        self.acquired = cache.add(self.key, 1, self.timeout)
+        while not self.acquired:
+            #Stop waiting if the lock was not released (the cache timeout frees it eventually)
+            if waited >= self.timeout:
+                break
+            time.sleep(self.poll)
+            waited += self.poll
+            self.acquired = cache.add(self.key, 1, self.timeout)
+        return self
+
+    def __exit__(self, *args):
+        if self.acquired:
+            cache.delete(self.key)
+
+#reducing_gap was added to Image.resize in Pillow 7.0
+try:
+    Image.new("L", (2, 2)).resize((1, 1), Image.ANTIALIAS, reducing_gap=2.0)
+    _HAS_REDUCING_GAP = True
+except TypeError:
+    _HAS_REDUCING_GAP = False
 
 class ImageHelper(object):
 
@@ -15,35 +355,109 @@ class ImageHelper(object):
         rtn["success"] = False
         rtn["message"] = ""
         rtn["thumbnail_image_url"] = None
+        #Worked out from the decoded image (see render_renditions)
+        rtn["phash"] = None
+        rtn["placeholder"] = None
+        rtn["dominant_color"] = None
 
-        url = instance.image_url
-        full_path = settings.PROJECT_ROOT + "/" + url.strip("/")
-
-        try:
-            if os.path.exists(full_path):
-                image = Image.open(full_path)
-            else:
-                rtn["message"] = "File path does not exist"
-                return rtn
-        except Exception as e:
-            rtn["message"] = e.__str__()
+        rtn_open = self._open(instance)
+        if not rtn_open["success"]:
+            rtn["message"] = rtn_open["message"]
             return rtn
+        image = rtn_open["image"]
 
-        image_width, image_height = image.size
-        instance.image_width = image_width
-        instance.image_height = image_height
-        instance.save()
+        #The dimensions, the plan and the renditions are the image as shown (see _upright)
+        image_width, image_height = displayed_size(image.size[0], image.size[1], exif_orientation(image))
+        if (instance.image_width, instance.image_height) != (image_width, image_height):
+            instance.image_width = image_width
+            instance.image_height = image_height
+            #update() so the element post_save signal does not run again
+            type(instance).objects.filter(id=instance.id).update(image_width=image_width, image_height=image_height)
 
         if not settings.DME_RESIZE:
+            #The image is only decoded at the small scale the placeholder and the hash need
+            if image.format == "JPEG" or check_image_budget(image)["success"]:
+                if exif_orientation(image) != 1:
+                    #Turned upright at a scale that still covers the placeholder and the hash
+                    self._draft(image, 64/float(min(image.size)))
+                    image = _upright(image)
+                rtn.update(self._placeholder(image))
+                rtn.update(self._phash(image))
             rtn["message"] = "The image was not resized since settings.DME_RESIZE is set to False"
             return rtn
 
-        #create DME_RESIZE_DIRECTORY directory
-        resize_dir = settings.PROJECT_ROOT + "/"
-        resize_dir += settings.MEDIA_URL.strip("/") +  "/"
-        resize_dir += settings.DME_RESIZE_DIRECTORY.strip("/")
-        if not os.path.exists(resize_dir): os.makedirs(resize_dir)
-        new_dir = "/" + settings.MEDIA_URL.strip("/") +  "/" + settings.DME_RESIZE_DIRECTORY.strip("/") + "/"
+        plan = self.plan(image_width, image_height, instance.image_url, image.format)
+
+        renditions = [plan["orig_c"]] + plan["renditions"] + [plan["thumbnail"]]
+        if not getattr(settings,"DME_RESIZE_EAGER",True):
+            #The other sizes are created the first time they are requested (see RenditionView)
+            renditions = [plan["orig_c"]] + [r for r in plan["renditions"] if r["size"] == "orig_c"] + [plan["thumbnail"]]
+
+        described = {}
+        results = self._create(image, plan, renditions, described)
+        rtn.update(described)
+
+        #We will work from the aspect-ratio cropped out version
+        if not results[0]["success"]:
+            return results[0]
+
+        for rendition, rtn_resize in zip(renditions, results):
+            if rendition is plan["thumbnail"] and rtn_resize["success"]:
+                rtn["thumbnail_image_url"] = rtn_resize.get("image_url") or rendition["image_url"]
+
+        self._record(instance, image.format, renditions, results, plan["thumbnail"])
+
+        rtn["success"] = True
+        return rtn
+
+    def render_size(self, instance, size):
+        """
+        Create a single rendition of the image (see RenditionView)
+        """
+        rtn = {}
+        rtn["success"] = False
+        rtn["message"] = ""
+        rtn["resized_image"] = None
+
+        rtn_open = self._open(instance)
+        if not rtn_open["success"]:
+            rtn["message"] = rtn_open["message"]
+            return rtn
+        image = rtn_open["image"]
+
+        image_width, image_height = displayed_size(image.size[0], image.size[1], exif_orientation(image))
+        plan = self.plan(image_width, image_height, instance.image_url, image.format)
+        renditions = [r for r in [plan["orig_c"]] + plan["renditions"] if r["size"] == size]
+        if not renditions:
+            rtn["message"] = "Size %s is not available for this image" % size
+            return rtn
+
+        results = self._create(image, plan, renditions)
+        if not results[0]["success"]:
+            rtn["message"] = results[0]["message"]
+            return rtn
+
+        rtn["resized_image"] = self._record(instance, image.format, renditions, results)[0]
+        rtn["success"] = True
+        return rtn
+
+    def planned_sizes(self, instance):
+        """
+        The sizes that can be created for an image without opening the file
+        """
+        if not instance.image_url or not instance.image_width or not instance.image_height:
+            return []
+        plan = self.plan(instance.image_width, instance.image_height, instance.image_url)
+        return [r["size"] for r in [plan["orig_c"]] + plan["renditions"]]
+
+    def plan(self, image_width, image_height, url, format=None):
+        """
+        Work out every rendition of an image from its dimensions
+        """
+        plan = {}
+
+        #Storage directory of the resized images
+        new_dir = settings.DME_RESIZE_DIRECTORY.strip("/") + "/"
 
         #Clean file name
         file_name = os.path.basename(url)
@@ -58,11 +472,10 @@ class ImageHelper(object):
             file_name = ".".join(file_name_array)
 
         if extension.lower() not in ["png","jpg","gif","bmp","jpeg","tiff"]:
-            extension = image.format.lower()
+            extension = (format or "jpeg").lower()
 
         extension = extension.lower()
 
-        url_orig_cropped = new_dir + file_name + "_orig_c." + extension
         orig_cropped_height = image_height
         orig_cropped_width = image_width
 
@@ -97,23 +510,8 @@ class ImageHelper(object):
             #Square
             pass
 
-        rtn_crop = self._crop_and_resize(image, orig_cropped_width, orig_cropped_height, url_orig_cropped)
-        if not rtn_crop["success"]:
-            return rtn_crop
-
-        ResizedImage = get_model("media_explorer","ResizedImage")
-
-        #We will work from the aspect-ratio cropped out version
-        ri = ResizedImage()
-        ri.image = instance
-        ri.file_name = file_name + "_orig_c." + extension
-        ri.image_url = url_orig_cropped
-        ri.image_height = orig_cropped_height
-        ri.image_width = orig_cropped_width
-        ri.size = "orig_c"
-        ri.save()
-
-        image_cropped = Image.open(settings.PROJECT_ROOT + url_orig_cropped)
+        plan["size"] = (image_width, image_height)
+        plan["crop"] = (orig_cropped_width, orig_cropped_height)
 
         ar_d = 0
         ar_n = 0
@@ -128,7 +526,22 @@ class ImageHelper(object):
         else:
             image_orientation = "square"
 
-		#Handle horizontal and vertical images
+        #orig_c is capped so large originals do not have to be fully decoded for it
+        orig_c_width = orig_cropped_width
+        orig_c_height = orig_cropped_height
+        orig_c_max_width = getattr(settings,"DME_RESIZE_ORIG_C_MAX_WIDTH",None)
+        if orig_c_max_width is None:
+            orig_c_max_width = self._largest_width(image_orientation)
+        if orig_c_max_width and orig_c_width > orig_c_max_width:
+            orig_c_height = int(orig_c_height*orig_c_max_width/float(orig_c_width))
+            orig_c_width = orig_c_max_width
+
+        plan["orig_c"] = self._rendition("orig_c", "cropped", "orig_c", orig_c_width, orig_c_height, new_dir, file_name + "_orig_c." + extension)
+
+        #List of renditions to create - they are recorded in this order
+        renditions = []
+
+        #Handle horizontal and vertical images
         if image_orientation in ["horizontal","vertical"]:
             for size_width in settings.DME_RESIZE_WIDTHS[image_orientation]:
 
@@ -137,38 +550,17 @@ class ImageHelper(object):
 
                 if (orig_cropped_width >= size_width) and (orig_cropped_height >= size_height):
                     new_file_name = file_name + "_" + size + "." + extension
-                    new_url = new_dir + new_file_name
-                    rtn_resize = self._crop_and_resize(image_cropped, size_width, size_height, new_url)
-                    if rtn_resize["success"]:
-                        ri = ResizedImage()
-                        ri.image = instance
-                        ri.file_name = new_file_name
-                        ri.image_url = new_url
-                        ri.image_height = size_height
-                        ri.image_width = size_width
-                        ri.size = size
-                        ri.save()
+                    renditions.append(self._rendition(image_orientation, "cropped", size, size_width, size_height, new_dir, new_file_name))
 
                     if size_width in settings.DME_RESIZE_WIDTHS["retina_2x"]:
                         retina_size_width = 2*size_width
                         retina_size_height = int(retina_size_width*ar_d/ar_n)
-                        retina_size = str(retina_size_width) + "x" + str(retina_size_height)
 
                         if (orig_cropped_width >= retina_size_width) and (orig_cropped_height >= retina_size_height):
                             new_file_name = file_name + "_" + size + "@2x." + extension
-                            new_url = new_dir + new_file_name
-                            rtn_resize = self._crop_and_resize(image_cropped, retina_size_width, retina_size_height, new_url)
-                            if rtn_resize["success"]:
-                                ri = ResizedImage()
-                                ri.image = instance
-                                ri.file_name = new_file_name
-                                ri.image_url = new_url
-                                ri.image_height = retina_size_height
-                                ri.image_width = retina_size_width
-                                ri.size = size + "@2x"
-                                ri.save()
-
-		#Handle non-cropped images (vertical, horizontal, square)
+                            renditions.append(self._rendition("retina_2x", "cropped", size + "@2x", retina_size_width, retina_size_height, new_dir, new_file_name))
+
+        #Handle non-cropped images (vertical, horizontal, square)
         for size_width in settings.DME_RESIZE_WIDTHS["non_cropped"]:
             size_height = int(image_height/float(image_width)*size_width)
             size = str(size_width) + "nc"
@@ -178,31 +570,14 @@ class ImageHelper(object):
 
             if (image_width >= size_width) and (image_height >= size_height):
                 new_file_name = file_name + "_" + size + "." + extension
-                new_url = new_dir + new_file_name
-                rtn_resize = self._crop_and_resize(image, size_width, size_height, new_url)
-                if rtn_resize["success"]:
-                    ri = ResizedImage()
-                    ri.image = instance
-                    ri.file_name = new_file_name
-                    ri.image_url = new_url
-                    ri.image_height = size_height
-                    ri.image_width = size_width
-                    ri.size = size
-                    ri.save()
-
+                renditions.append(self._rendition("non_cropped", "original", size, size_width, size_height, new_dir, new_file_name))
 
             if (image_width >= retina_size_width) and (image_height >= retina_size_height):
                 new_file_name = file_name + "_" + size + "@2x." + extension
-                new_url = new_dir + new_file_name
-                rtn_resize = self._crop_and_resize(image, retina_size_width, retina_size_height, new_url)
-                if rtn_resize["success"]:
-                    ri.image = instance
-                    ri.file_name = new_file_name
-                    ri.image_url = new_url
-                    ri.image_height = retina_size_height
-                    ri.image_width = retina_size_width
-                    ri.size = size + "@2x"
-                    ri.save()
+                renditions.append(self._rendition("retina_2x", "original", size + "@2x", retina_size_width, retina_size_height, new_dir, new_file_name))
+
+        #Extra formats are created right after the rendition they are made from
+        plan["renditions"] = self._add_formats([plan["orig_c"]] + renditions, extension)[1:]
 
         #Now process thumbnail_image_url
         size_width = settings.DME_RESIZE_WIDTHS["thumbnail"]
@@ -210,22 +585,42 @@ class ImageHelper(object):
         size = str(size_width) + "x" + str(size_height) + ".thumbnail"
 
         new_file_name = file_name + "_" + size + "." + extension
-        new_url = new_dir + new_file_name
-        rtn_resize = self._crop_and_resize(image, size_width, size_height, new_url)
-        if rtn_resize["success"]:
-            rtn["thumbnail_image_url"] = new_url
+        plan["thumbnail"] = self._rendition("thumbnail", "original", size, size_width, size_height, new_dir, new_file_name)
 
-        rtn["success"] = True
-        return rtn
+        return plan
 
+    def _largest_width(self, image_orientation):
+        """
+        Width of the largest configured size (retina included) of an orientation - of any size for square images
+        """
+        widths = settings.DME_RESIZE_WIDTHS
+        orientations = [image_orientation] if image_orientation in ["horizontal","vertical"] else ["horizontal","vertical","non_cropped"]
+        largest = 0
+        for orientation in orientations:
+            for size_width in widths.get(orientation, []):
+                largest = max(largest, 2*size_width if size_width in widths.get("retina_2x", []) else size_width)
+        return largest
 
-    def _crop_and_resize(self, image, width, height, new_path):
+    def _open(self, instance):
         rtn = {}
         rtn["success"] = False
         rtn["message"] = ""
+        rtn["image"] = None
+
+        if instance.image:
+            storage = instance.image.storage
+            name = instance.image.name
+        else:
+            storage = get_storage()
+            name = storage_name(instance.image_url, storage)
+
         try:
-            imagefit = ImageOps.fit(image, (width, height), Image.ANTIALIAS)
-            imagefit.save(settings.PROJECT_ROOT + new_path, image.format, quality=100)
+            if storage.exists(name):
+                #The file stays open until the image is decoded
+                rtn["image"] = Image.open(storage.open(name, "rb"))
+            else:
+                rtn["message"] = "File path does not exist"
+                return rtn
         except Exception as e:
             rtn["message"] = e.__str__()
             return rtn
@@ -233,17 +628,520 @@ class ImageHelper(object):
         rtn["success"] = True
         return rtn
 
-    def _resize(self, image, width, height, new_path):
+    def _create(self, image, plan, renditions, described=None):
+        """
+        Create the rendition files from the (not yet decoded) original, turned upright (see _upright)
+        The perceptual hash of the decoded original and the placeholder (from the thumbnail)
+        are added to described (when it is given)
+        """
+        image_width, image_height = plan["size"]
+        orig_cropped_width, orig_cropped_height = plan["crop"]
+
+        budget = check_image_budget(image)
+        if not budget["success"]:
+            return [{"success":False,"message":budget["message"]} for rendition in renditions]
+
+        #Decode no more of the original than the largest rendition of each source needs
+        scale = 0
+        for rendition in renditions:
+            if rendition["source"] == "cropped":
+                scale = max(scale, rendition["image_width"]/float(orig_cropped_width))
+            else:
+                scale = max(scale, rendition["image_width"]/float(image_width))
+
+        format = image.format
+        if scale > budget["scale"]:
+            #The full size does not fit in DME_MAX_DECODE_MEMORY - the largest renditions are left out
+            self._draft(image, budget["scale"], force=True)
+            image = _upright(image)
+            self._fit_budget(renditions, image.size[0]/float(image_width), plan)
+        else:
+            self._draft(image, scale)
+            image = _upright(image)
+
+        if described is not None:
+            #Decode at the scale chosen for the renditions before the hash asks for a smaller one
+            image.load()
+            described.update(self._phash(image))
+
+        sources = {"original": image}
+
+        #Keep the cropped version in memory - the cropped renditions are made from it
+        if [r for r in renditions if r["source"] == "cropped"]:
+            try:
+                decoded_scale = image.size[0]/float(image_width)
+                sources["cropped"] = _fit(image, int(round(orig_cropped_width*decoded_scale)), int(round(orig_cropped_height*decoded_scale)))
+            except Exception as e:
+                return [{"success":False,"message":e.__str__()} for rendition in renditions]
+
+        return self._render(sources, format, renditions, described)
+
+    def _phash(self, image):
+        """
+        {"phash": ...} of an opened image (see similarity.image_phash) - None when it can not be read
+        """
+        from .similarity import image_phash
         rtn = {}
-        rtn["success"] = False
-        rtn["message"] = ""
+        if getattr(settings,"DME_PHASH",True):
+            try:
+                rtn["phash"] = image_phash(image)
+            except Exception as e:
+                rtn["phash"] = None
+        return rtn
+
+    def _placeholder(self, image):
+        """
+        {"placeholder": ..., "dominant_color": ...} of a small image (see placeholders.image_placeholder)
+        """
+        from .placeholders import image_placeholder
+        rtn = {}
+        if getattr(settings,"DME_PLACEHOLDER",True):
+            try:
+                rtn = image_placeholder(image)
+            except Exception as e:
+                pass
+        return rtn
+
+    def _record(self, instance, format, renditions, results, thumbnail=None):
+        ResizedImage = get_model("media_explorer","ResizedImage")
+
+        resized_images = []
+        for rendition, rtn_resize in zip(renditions, results):
+            if not rtn_resize["success"] or rendition is thumbnail:
+                continue
+
+            ri = ResizedImage()
+            ri.image = instance
+            ri.file_name = rendition["file_name"]
+            ri.image_url = rtn_resize.get("image_url") or rendition["image_url"]
+            ri.image_height = rendition["image_height"]
+            ri.image_width = rendition["image_width"]
+            ri.size = rendition["size"]
+            ri.format = (rendition["format"] or format or "").lower()
+            ri.save()
+            resized_images.append(ri)
+
+        return resized_images
+
+    def _rendition(self, size_class, source, size, width, height, new_dir, new_file_name):
+        rendition = {}
+        rendition["size_class"] = size_class
+        rendition["source"] = source
+        rendition["format"] = None
+        rendition["size"] = size
+        rendition["file_name"] = new_file_name
+        rendition["name"] = new_dir + new_file_name
+        rendition["image_url"] = get_storage().url(rendition["name"])
+        rendition["image_width"] = width
+        rendition["image_height"] = height
+        return rendition
+
+    def _add_formats(self, renditions, extension):
+        """
+        Add a rendition for each extra format (DME_RESIZE_FORMATS) of each size
+        """
+        formats = getattr(settings,"DME_RESIZE_FORMATS",{})
+        primary_format = "jpeg" if extension == "jpg" else extension
+
+        rtn = []
+        for rendition in renditions:
+            rtn.append(rendition)
+            for format in formats.get(rendition["size_class"], formats.get("default", [])):
+                format = format.lower()
+                if format == primary_format or not can_save_format(format):
+                    continue
+                new_file_name = os.path.splitext(rendition["file_name"])[0] + "." + format
+                extra = dict(rendition)
+                extra["format"] = format
+                extra["file_name"] = new_file_name
+                extra["name"] = posixpath.join(posixpath.dirname(rendition["name"]), new_file_name)
+                extra["image_url"] = get_storage().url(extra["name"])
+                rtn.append(extra)
+
+        return rtn
+
+    def _render(self, sources, format, renditions, described=None):
+        """
+        Create the rendition files and return a result for each rendition (in the same order).
+        The renditions are split into chains that do not depend on each other: one per source and size class
+        (orig_c, horizontal, vertical, retina_2x and non_cropped with the thumbnail, see _chain_key).
+        With DME_RESIZE_POOL_SIZE > 1 each chain is made in a thread or process pool
+        (DME_RESIZE_POOL = "thread" or "process") - see _render_chain for the work done in a chain.
+        A source is closed once the chains made from it are done.
+        The placeholder is made from the thumbnail and added to described (when it is given).
+        """
+        max_factor = float(getattr(settings,"DME_RESIZE_CASCADE_MAX_FACTOR",2))
+
+        chains = []
+        keys = {}
+        for i, rendition in enumerate(renditions):
+            key = (rendition["source"], _chain_key(rendition))
+            if key not in keys:
+                keys[key] = len(chains)
+                chains.append((rendition["source"], []))
+            chains[keys[key]][1].append(i)
+
+        pool = None
+        pool_size = getattr(settings,"DME_RESIZE_POOL_SIZE",1)
+        if pool_size > 1 and len(chains) > 1:
+            if getattr(settings,"DME_RESIZE_POOL","thread") == "process":
+                pool = multiprocessing.Pool(pool_size)
+            else:
+                pool = ThreadPool(pool_size)
+            #The chains read the sources at the same time - decode them first
+            for source in sources.values():
+                source.load()
+
+        results = [None] * len(renditions)
+        try:
+            done = []
+            for n, (source, indexes) in enumerate(chains):
+                args = (sources[source], format, [renditions[i] for i in indexes], max_factor, described is not None)
+                if pool:
+                    done.append((indexes, pool.apply_async(_render_chain, args)))
+                    continue
+                done.append((indexes, _render_chain(*args)))
+                if not [key for key, later in chains[n + 1:] if key == source]:
+                    sources[source].close()
+
+            for indexes, chain_results in done:
+                if pool:
+                    chain_results = chain_results.get()
+                for i, result in zip(indexes, chain_results):
+                    if described is not None and "described" in result:
+                        described.update(result.pop("described"))
+                    results[i] = result
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+                for source in sources.values():
+                    source.close()
+
+        return results
+
+    def _render_chain(self, source, format, renditions, max_factor, placeholder=False):
+        """
+        Create a chain of renditions from the same source and return a result for each rendition (in the same order).
+        Renditions are made largest first and each one is resampled from the smallest image of the chain
+        already in memory (the source, a larger rendition or an intermediate step) - never reducing by
+        more than max_factor at once. The images made are closed as soon as no rendition left needs them
+        (the source is left open). With placeholder the placeholder of the thumbnail is added to its result
+        under "described".
+        """
+        images = [source]
+        results = [None] * len(renditions)
+        order = sorted(range(len(renditions)), key=lambda i: -renditions[i]["image_width"])
+
+        #Sizes still to make
+        remaining = [(r["image_width"], r["image_height"]) for r in renditions if not r.get("skip")]
+
+        try:
+            for i in order:
+                rendition = renditions[i]
+                if rendition.get("skip"):
+                    results[i] = {"success":False,"message":rendition["skip"]}
+                    continue
+
+                width = rendition["image_width"]
+                height = rendition["image_height"]
+                remaining.remove((width, height))
+
+                resized = None
+                try:
+                    resized = _fit(self._cascade_source(images, width, height, max_factor), width, height)
+                    images.append(resized)
+                except Exception as e:
+                    results[i] = {"success":False,"message":e.__str__()}
+                    continue
+                finally:
+                    self._release(images, remaining, [source, resized])
+
+                results[i] = _save_rendition(resized, rendition["name"], rendition["format"] or format, encoding_profile(rendition["size_class"]))
+                if placeholder and rendition["size_class"] == "thumbnail":
+                    results[i]["described"] = self._placeholder(resized)
+                if not [im for im in images if im is resized]:
+                    resized.close()
+        finally:
+            for im in images:
+                if im is not source:
+                    im.close()
+
+        return results
+
+    def _fit_budget(self, renditions, decoded_scale, plan):
+        """
+        Change the renditions (in place) to what can be made from an original decoded at decoded_scale:
+        orig_c is made smaller and the renditions larger than the decoded source are skipped
+        (their result is a failure so they are not recorded)
+        """
+        image_width, image_height = plan["size"]
+        orig_cropped_width, orig_cropped_height = plan["crop"]
+
+        for rendition in renditions:
+            if rendition["source"] == "cropped":
+                max_width = int(orig_cropped_width*decoded_scale)
+            else:
+                max_width = int(image_width*decoded_scale)
+
+            if rendition["image_width"] > max_width:
+                if rendition["size"] == "orig_c":
+                    rendition["image_height"] = int(rendition["image_height"]*max_width/float(rendition["image_width"]))
+                    rendition["image_width"] = max_width
+                else:
+                    rendition["skip"] = "Size %s does not fit in DME_MAX_DECODE_MEMORY" % rendition["size"]
+
+    def _draft(self, image, scale, force=False):
+        """
+        Ask the JPEG decoder for a reduced-scale (DCT scaling) decode
+        that is still at least scale times the size of the original
+        """
+        if scale >= 1 or image.format != "JPEG" \
+                or not (force or getattr(settings,"DME_RESIZE_DRAFT",True)):
+            return
+
+        image.draft(image.mode, (int(math.ceil(image.size[0]*scale)), int(math.ceil(image.size[1]*scale))))
+
+    def _smallest_cover(self, images, width, height):
+        """
+        The smallest image that covers width x height (the largest one when none does)
+        """
+        candidates = [im for im in images if im.size[0] >= width and im.size[1] >= height]
+        if not candidates:
+            candidates = images
+        return min(candidates, key=lambda im: im.size[0]*im.size[1])
+
+    def _release(self, images, sizes, keep=()):
+        """
+        Remove from images the ones no size left will be made from and free them (except those in keep)
+        """
+        needed = [self._smallest_cover(images, width, height) for width, height in sizes] if images else []
+        for im in list(images):
+            if not [n for n in needed if n is im]:
+                images.remove(im)
+                if not [k for k in keep if k is im]:
+                    im.close()
+
+    def _cascade_source(self, images, width, height, max_factor):
+        """
+        Return the smallest image that covers width x height
+        adding intermediate steps to images when it is more than max_factor larger
+        (unless Pillow can do the large reductions itself with reducing_gap)
+        """
+        source = self._smallest_cover(images, width, height)
+
+        if _reducing_gap():
+            return source
+
+        reduction = min(source.size[0]/float(width), source.size[1]/float(height))
+        while reduction > max_factor:
+            scale = max(1/max_factor, max_factor/reduction)
+            step_width = int(math.ceil(source.size[0]*scale))
+            step_height = int(math.ceil(source.size[1]*scale))
+            source = source.resize((step_width, step_height), Image.ANTIALIAS)
+            images.append(source)
+            reduction = min(source.size[0]/float(width), source.size[1]/float(height))
+
+        return source
+
+    def _crop_and_resize(self, image, width, height, new_path):
+        return _crop_and_resize(image, width, height, new_path, image.format)
+
+    def _resize(self, image, width, height, new_path):
         try:
-            resized = image.resize((width,height),Image.ANTIALIAS).save(settings.PROJECT_ROOT + new_path)
+            resized = image.resize((width,height),Image.ANTIALIAS)
         except Exception as e:
-            rtn["message"] = e.__str__()
-            return rtn
+            return {"success":False,"message":e.__str__()}
 
-        rtn["success"] = True
+        return _save_rendition(resized, storage_name(new_path), image.format, encoding_profile("default"))
+
+def _chain_key(rendition):
+    #The thumbnail is made in the chain of the other non-cropped sizes of the original
+    if rendition["size_class"] == "thumbnail":
+        return "non_cropped"
+    return rendition["size_class"]
+
+def _render_chain(source, format, renditions, max_factor, placeholder=False):
+    #A module function so it can be sent to a process pool
+    return ImageHelper()._render_chain(source, format, renditions, max_factor, placeholder)
+
+def _reducing_gap():
+    if not _HAS_REDUCING_GAP:
+        return None
+    return getattr(settings,"DME_RESIZE_REDUCING_GAP",3.0)
+
+def _upright(image):
+    """
+    The image turned as its EXIF orientation says, without the orientation tag (so it is not turned twice).
+    The original is decoded (at its draft scale) and closed. Images without an orientation are returned as they are.
+    """
+    if exif_orientation(image) == 1 or not hasattr(ImageOps, "exif_transpose"):
+        return image
+    upright = ImageOps.exif_transpose(image)
+    image.close()
+    return upright
+
+def _fit(image, width, height):
+    """
+    Same as ImageOps.fit (centered) but skips the resample when only a crop is needed
+    and uses reducing_gap resampling when Pillow supports it
+    """
+    image_width, image_height = image.size
+    if float(image_width)/image_height >= float(width)/height:
+        crop_width = int(round(float(width)/height*image_height))
+        crop_height = image_height
+    else:
+        crop_width = image_width
+        crop_height = int(round(float(height)/width*image_width))
+
+    crop_left = (image_width - crop_width)//2
+    crop_top = (image_height - crop_height)//2
+    box = (crop_left, crop_top, crop_left + crop_width, crop_top + crop_height)
+
+    if (crop_width, crop_height) == (width, height):
+        if box == (0, 0) + image.size:
+            return image.copy()
+        return image.crop(box)
+
+    reducing_gap = _reducing_gap()
+    if reducing_gap:
+        return image.resize((width, height), Image.ANTIALIAS, box=box, reducing_gap=reducing_gap)
+
+    if box != (0, 0) + image.size:
+        image = image.crop(box)
+    return image.resize((width, height), Image.ANTIALIAS)
+
+#JPEG chroma subsampling names accepted in DME_RESIZE_PROFILES
+_SUBSAMPLING = {"4:4:4": 0, "4:2:2": 1, "4:2:0": 2}
+
+def _save_options(image, format, profile):
+    """
+    Keyword arguments of Image.save for an encoding profile (see DME_RESIZE_PROFILES)
+    """
+    options = {}
+    if format in ["JPEG","WEBP","AVIF"]:
+        options["quality"] = profile.get("quality", 85)
+
+    if format == "JPEG":
+        options["progressive"] = profile.get("progressive", True)
+        options["optimize"] = profile.get("optimize", True)
+        subsampling = profile.get("subsampling")
+        if subsampling is not None:
+            options["subsampling"] = _SUBSAMPLING.get(subsampling, subsampling)
+    elif format == "WEBP":
+        if profile.get("optimize", True):
+            options["method"] = 6
+    elif format in ["PNG","GIF"]:
+        options["optimize"] = profile.get("optimize", True)
+
+    #The colour profile is always kept so the colours do not change
+    if image.info.get("icc_profile"):
+        options["icc_profile"] = image.info["icc_profile"]
+
+    if profile.get("strip_metadata", True):
+        options["exif"] = b""
+        if format == "JPEG":
+            options["comment"] = b""
+    elif image.info.get("exif"):
+        options["exif"] = image.info["exif"]
+
+    return options
+
+def _encode(image, format, options):
+    buf = BytesIO()
+    image.save(buf, format, **options)
+    return buf
+
+def _psnr(image, buf):
+    """
+    Peak signal-to-noise ratio (dB) of an encoded image compared to the image it was encoded from
+    """
+    buf.seek(0)
+    decoded = Image.open(buf).convert("RGB")
+    stat = ImageStat.Stat(ImageChops.difference(image.convert("RGB"), decoded))
+    mse = sum(stat.sum2)/float(image.size[0]*image.size[1]*len(stat.sum2))
+    if not mse:
+        return float("inf")
+    return 10*math.log10(255**2/mse)
+
+def _search_quality(image, format, options, profile):
+    """
+    Binary search the quality between profile["min_quality"] and the profile quality:
+    the lowest quality whose PSNR is at least profile["min_psnr"] and
+    no higher than the highest quality that fits in profile["max_bytes"]
+    """
+    low = min(profile.get("min_quality", 40), options["quality"])
+    quality = options["quality"]
+
+    def encoded(q):
+        return _encode(image, format, dict(options, quality=q))
+
+    min_psnr = profile.get("min_psnr")
+    if min_psnr:
+        lo, hi = low, quality
+        while lo < hi:
+            mid = (lo + hi)//2
+            if _psnr(image, encoded(mid)) >= min_psnr:
+                hi = mid
+            else:
+                lo = mid + 1
+        quality = hi
+
+    max_bytes = profile.get("max_bytes")
+    if max_bytes and len(encoded(quality).getvalue()) > max_bytes:
+        lo, hi = low, quality - 1
+        while lo < hi:
+            mid = (lo + hi + 1)//2
+            if len(encoded(mid).getvalue()) <= max_bytes:
+                lo = mid
+            else:
+                hi = mid - 1
+        quality = lo
+
+    return quality
+
+def _save_rendition(image, name, format, profile=None):
+    """
+    Encode the image and write it to the storage (see DME_STORAGE) under name.
+    The image is encoded to a temporary file (in memory up to DME_STORAGE_SPOOL_SIZE bytes)
+    that the storage reads in chunks.
+    """
+    rtn = {}
+    rtn["success"] = False
+    rtn["message"] = ""
+    rtn["image_url"] = None
+    try:
+        format = format.upper()
+        profile = profile or {}
+        if format in ["WEBP","AVIF"] and image.mode not in ["RGB","RGBA"]:
+            image = image.convert("RGBA" if image.mode in ["LA","P","PA"] else "RGB")
+
+        options = _save_options(image, format, profile)
+        if "quality" in options and (profile.get("max_bytes") or profile.get("min_psnr")):
+            options["quality"] = _search_quality(image, format, options, profile)
+
+        storage = get_storage()
+        with tempfile.SpooledTemporaryFile(max_size=getattr(settings,"DME_STORAGE_SPOOL_SIZE",10*1024*1024)) as tmp:
+            image.save(tmp, format, **options)
+            tmp.seek(0)
+            #Renditions have fixed names - replace the previous version
+            if storage.exists(name):
+                storage.delete(name)
+            name = storage.save(name, File(tmp, name=name))
+        rtn["image_url"] = storage.url(name)
+    except Exception as e:
+        rtn["message"] = e.__str__()
         return rtn
 
+    rtn["success"] = True
+    return rtn
+
+def _crop_and_resize(image, width, height, new_path, format):
+    try:
+        imagefit = _fit(image, width, height)
+    except Exception as e:
+        return {"success":False,"message":e.__str__()}
+
+    return _save_rendition(imagefit, storage_name(new_path), format, encoding_profile("default"))
+
 #EOF
@@ -0,0 +1,114 @@
+import traceback
+from datetime import timedelta
+from django.conf import settings
+from django.db.models import Q, F
+from django.utils import timezone
+from media_explorer.models import Element, ResizedImage, RenditionJob, update_cover_thumbnails
+
+def enqueue_renditions(element):
+    """
+    Queue a rendition job for the element unless one is already waiting.
+    A running job does not count: it may have opened the image this one replaces.
+    """
+    if RenditionJob.objects.filter(element=element,status="pending").exists():
+        return None
+
+    job = RenditionJob()
+    job.element = element
+    job.max_attempts = getattr(settings,"DME_RENDITION_JOB_MAX_ATTEMPTS",3)
+    job.run_after = timezone.now()
+    job.save()
+    return job
+
+def claim_job(worker_id, batch_size=10):
+    """
+    Claim the next job that is due.
+    The claim is a conditional UPDATE so only one worker (on any node) can win a job.
+    Running jobs whose lock is older than DME_RENDITION_JOB_TIMEOUT are claimed again.
+    """
+    now = timezone.now()
+    stale = now - timedelta(seconds=getattr(settings,"DME_RENDITION_JOB_TIMEOUT",600))
+    claimable = Q(status="pending",run_after__lte=now) | Q(status="running",locked_at__lt=stale)
+
+    job_ids = RenditionJob.objects.filter(claimable).order_by("run_after","id").values_list("id",flat=True)[:batch_size]
+    for job_id in list(job_ids):
+        claimed = RenditionJob.objects.filter(claimable,id=job_id).update(
+            status="running",
+            locked_by=worker_id,
+            locked_at=now,
+            attempts=F("attempts")+1,
+        )
+        if claimed:
+            return RenditionJob.objects.select_related("element").get(id=job_id)
+
+    return None
+
+def render_renditions(element):
+    """
+    Create the resized images for the element and point its thumbnail to the resized version.
+    The ResizedImage rows the element had before are replaced once the new ones exist
+    (files with the same name are kept, sizes that are no longer configured are removed).
+    NOTE: we use update() here so the element post_save signal does not run again
+    """
+    from media_explorer.helpers import ImageHelper
+    old_ids = list(ResizedImage.objects.filter(image=element).values_list("id",flat=True))
+
+    helper = ImageHelper()
+    rtn = helper.resize(element)
+
+    #The hash and the placeholder are worked out here from the decoded image instead of in the request (see Element.prepare_image)
+    described = dict((key, rtn[key]) for key in ["phash","placeholder","dominant_color"] if rtn.get(key))
+    if described:
+        Element.objects.filter(id=element.id).update(updated_at=timezone.now(), **described)
+        for key, value in described.items():
+            setattr(element, key, value)
+
+    if rtn["success"]:
+        ResizedImage.objects.filter(id__in=old_ids).delete()
+        if rtn["thumbnail_image_url"]:
+            Element.objects.filter(id=element.id).update(
+                thumbnail_image="",
+                thumbnail_image_url=rtn["thumbnail_image_url"],
+            )
+            element.thumbnail_image_url = rtn["thumbnail_image_url"]
+            update_cover_thumbnails(element)
+    return rtn
+
+def process_job(job):
+    """
+    Run a claimed job and record the outcome.
+    Failed jobs are retried with an exponential delay until max_attempts is reached.
+    """
+    try:
+        rtn = render_renditions(job.element)
+    except Exception as e:
+        rtn = {"success":False,"message":traceback.format_exc()}
+
+    fields = {}
+    fields["locked_by"] = None
+    fields["locked_at"] = None
+
+    #A job queued for a newer image while this one ran decides the element status
+    queued = RenditionJob.objects.filter(element_id=job.element_id,status="pending").exclude(id=job.id).exists()
+
+    if rtn["success"]:
+        fields["status"] = "done"
+        fields["last_error"] = None
+        if not queued:
+            Element.objects.filter(id=job.element_id).update(status="ready")
+    elif job.attempts >= job.max_attempts:
+        fields["status"] = "failed"
+        fields["last_error"] = rtn["message"]
+        if not queued:
+            Element.objects.filter(id=job.element_id).update(status="failed")
+    else:
+        delay = getattr(settings,"DME_RENDITION_JOB_RETRY_DELAY",60) * 2**(job.attempts-1)
+        fields["status"] = "pending"
+        fields["last_error"] = rtn["message"]
+        fields["run_after"] = timezone.now() + timedelta(seconds=delay)
+
+    #Only record the outcome if another worker has not taken over the job
+    RenditionJob.objects.filter(id=job.id,locked_by=job.locked_by).update(**fields)
+    return rtn
+
+#EOF
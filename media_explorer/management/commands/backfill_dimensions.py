@@ -0,0 +1,112 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Q
+from media_explorer.models import Element
+from media_explorer.helpers import probe_stored_image, displayed_size
+from media_explorer.storage import get_storage, storage_name
+
+#Case and When were added in Django 1.8
+try:
+    from django.db.models import Case, When, Value, IntegerField
+except ImportError:
+    Case = None
+
+def probe_element(element):
+    if element.image:
+        probe = probe_stored_image(element.image.storage, element.image.name)
+    else:
+        storage = get_storage()
+        probe = probe_stored_image(storage, storage_name(element.image_url, storage))
+    return element.id, probe
+
+class Command(BaseCommand):
+    """
+    Fill image_width and image_height of the image elements that do not have them
+    (e.g. uploaded with DME_RESIZE = False or before the dimensions were saved).
+    Only the image headers are read and each chunk is saved with a single UPDATE.
+    The dimensions are the ones shown after the EXIF orientation (--all fixes the elements saved before that).
+    """
+
+    help = "Fill the missing dimensions of image elements from the image headers"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="Number of elements read and updated at a time"),
+        make_option("--workers",
+            type="int",
+            dest="workers",
+            default=4,
+            help="Number of image headers read at the same time"),
+        make_option("--all",
+            action="store_true",
+            dest="all",
+            default=False,
+            help="Check all image elements, not only the ones without dimensions"),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Element.objects.filter(type="image").exclude(image_url="").exclude(image_url__isnull=True)
+        if not options["all"]:
+            queryset = queryset.filter(Q(image_width=0) | Q(image_width__isnull=True) | Q(image_height=0) | Q(image_height__isnull=True))
+
+        pool = ThreadPool(max(options["workers"], 1))
+        started = time.time()
+        last_id = 0
+        checked = 0
+        updated = 0
+        failed = 0
+
+        try:
+            while True:
+                elements = list(queryset.filter(id__gt=last_id).order_by("id").only("id","image","image_url","image_width","image_height")[:options["chunk_size"]])
+                if not elements:
+                    break
+                last_id = elements[-1].id
+                checked += len(elements)
+
+                current = dict((element.id, (element.image_width, element.image_height)) for element in elements)
+                dimensions = {}
+                for element_id, probe in pool.imap(probe_element, elements):
+                    if not probe["success"]:
+                        failed += 1
+                        self.stderr.write("Failed element %s: %s" % (element_id, probe["message"]))
+                    else:
+                        size = displayed_size(probe["width"], probe["height"], probe["orientation"])
+                        if current[element_id] != size:
+                            dimensions[element_id] = size
+
+                self.update(dimensions)
+                updated += len(dimensions)
+
+                elapsed = time.time() - started
+                self.stdout.write("%s checked, %s updated, %s failed (%.1f elements/s)" % (
+                    checked, updated, failed, checked/elapsed if elapsed else 0))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write("Done: %s updated, %s failed" % (updated, failed))
+
+    def update(self, dimensions):
+        """
+        Save the dimensions of a chunk - update() so the element signals do not run
+        """
+        if not dimensions:
+            return
+
+        if Case is None:
+            with transaction.atomic():
+                for element_id, (width, height) in dimensions.items():
+                    Element.objects.filter(id=element_id).update(image_width=width, image_height=height)
+            return
+
+        Element.objects.filter(id__in=list(dimensions)).update(
+            image_width=Case(*[When(id=element_id, then=Value(width)) for element_id, (width, height) in dimensions.items()], output_field=IntegerField()),
+            image_height=Case(*[When(id=element_id, then=Value(height)) for element_id, (width, height) in dimensions.items()], output_field=IntegerField()),
+        )
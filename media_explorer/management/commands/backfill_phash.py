@@ -0,0 +1,69 @@
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from media_explorer.models import Element
+from media_explorer.helpers import stored_image_phash
+from media_explorer.storage import get_storage, storage_name
+
+def element_phash(element):
+    if element.image:
+        return element.id, stored_image_phash(element.image.storage, element.image.name)
+    storage = get_storage()
+    return element.id, stored_image_phash(storage, storage_name(element.image_url, storage))
+
+class Command(BaseCommand):
+    """
+    Compute the perceptual hash of the image elements that do not have one
+    JPEG images are decoded at 1/8 scale so this is much faster than a resize
+    """
+
+    help = "Compute the missing perceptual hashes of image elements"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="Number of elements read at a time"),
+        make_option("--workers",
+            type="int",
+            dest="workers",
+            default=4,
+            help="Number of images hashed at the same time"),
+    )
+
+    def handle(self, *args, **options):
+        queryset = Element.objects.filter(type="image",phash__isnull=True).exclude(image_url="").exclude(image_url__isnull=True)
+
+        pool = ThreadPool(max(options["workers"], 1))
+        started = time.time()
+        last_id = 0
+        checked = 0
+        updated = 0
+
+        try:
+            while True:
+                elements = list(queryset.filter(id__gt=last_id).order_by("id").only("id","image","image_url")[:options["chunk_size"]])
+                if not elements:
+                    break
+                last_id = elements[-1].id
+                checked += len(elements)
+
+                for element_id, phash in pool.imap(element_phash, elements):
+                    if phash:
+                        #update() so the element signals do not run - updated_at is set for the similarity index
+                        Element.objects.filter(id=element_id).update(phash=phash, updated_at=timezone.now())
+                        updated += 1
+                    else:
+                        self.stderr.write("Could not hash element %s" % element_id)
+
+                elapsed = time.time() - started
+                self.stdout.write("%s checked, %s hashed (%.1f elements/s)" % (
+                    checked, updated, checked/elapsed if elapsed else 0))
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write("Done: %s hashed" % updated)
@@ -0,0 +1,102 @@
+import time
+from datetime import timedelta
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from media_explorer.models import Element, ResizedImage
+from media_explorer.orphans import compare_files
+from media_explorer.deletions import file_deleter
+from media_explorer.storage import get_storage
+
+class Command(BaseCommand):
+    """
+    Compare the original and resized image directories with the Element, Gallery and ResizedImage rows.
+    Orphans (files no row refers to) are deleted and ResizedImage rows whose file is missing are deleted
+    (rebuild_renditions --only-missing creates them again). Elements whose files are missing are only reported.
+    Both sides are sorted on disk and merged so memory use does not grow with the number of files.
+    """
+
+    help = "Delete orphaned image files and report missing ones"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--dry-run",
+            action="store_true",
+            dest="dry_run",
+            default=False,
+            help="Only report, do not delete anything"),
+        make_option("--min-age",
+            type="int",
+            dest="min_age",
+            default=60*60,
+            help="Do not delete orphans modified in the last MIN_AGE seconds (they may belong to a resize in progress)"),
+        make_option("--run-size",
+            type="int",
+            dest="run_size",
+            default=100000,
+            help="Number of names sorted in memory at a time"),
+    )
+
+    def handle(self, *args, **options):
+        self.dry_run = options["dry_run"]
+        self.verbosity = int(options.get("verbosity", 1))
+        self.newer_than = timezone.now() - timedelta(seconds=options["min_age"])
+
+        image_field = Element._meta.get_field("image")
+        directories = [
+            (image_field.storage, image_field.upload_to),
+            (get_storage(), settings.DME_RESIZE_DIRECTORY),
+        ]
+
+        for storage, directory in directories:
+            started = time.time()
+            #Rows created after this may have been written after their directory was listed
+            self.created_before = min(self.newer_than, timezone.now())
+            self.counts = dict((key, 0) for key in ["files","orphans","deleted","recent","missing","missing_elements"])
+            for name, stored, references in compare_files(storage, directory, options["run_size"]):
+                if stored:
+                    self.counts["files"] += 1
+                if stored and not references:
+                    self.orphan(storage, name)
+                elif not stored:
+                    self.missing(storage, name, references)
+
+            self.stdout.write("%s: %s files, %s orphans (%s deleted, %s too recent), %s missing files (%s of elements) in %.1fs%s" % (
+                directory.strip("/"), self.counts["files"], self.counts["orphans"], self.counts["deleted"], self.counts["recent"],
+                self.counts["missing"], self.counts["missing_elements"], time.time() - started, " (dry run)" if self.dry_run else ""))
+
+        file_deleter.wait()
+
+    def orphan(self, storage, name):
+        self.counts["orphans"] += 1
+        if self.verbosity > 1:
+            self.stdout.write("Orphan: %s" % name)
+        if self.dry_run:
+            return
+
+        try:
+            modified = storage.modified_time(name)
+            if settings.USE_TZ and timezone.is_naive(modified):
+                modified = timezone.make_aware(modified, timezone.get_default_timezone())
+            if modified > self.newer_than:
+                self.counts["recent"] += 1
+                return
+            storage.delete(name)
+            self.counts["deleted"] += 1
+        except Exception as e:
+            self.stderr.write("Could not delete %s: %s" % (name, e))
+
+    def missing(self, storage, name, references):
+        self.counts["missing"] += 1
+        resized_image_ids = [id for model, id in references if model == "ResizedImage"]
+        if len(resized_image_ids) < len(references):
+            self.counts["missing_elements"] += 1
+            self.stderr.write("Missing: %s (%s)" % (name, ", ".join(["%s %s" % reference for reference in references])))
+        elif self.verbosity > 1:
+            self.stdout.write("Missing: %s" % name)
+
+        if resized_image_ids and not self.dry_run:
+            #The directory was listed before the rows were read: a rendition written meanwhile is not missing
+            if storage.exists(name):
+                return
+            ResizedImage.objects.filter(id__in=resized_image_ids).exclude(created_at__gt=self.created_before).delete()
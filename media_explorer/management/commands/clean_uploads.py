@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from media_explorer.uploads import expired_uploads, delete_chunks
+from media_explorer.deletions import file_deleter
+
+class Command(BaseCommand):
+    """
+    Delete the chunked uploads that were not finished within DME_UPLOAD_EXPIRY seconds
+    """
+
+    help = "Delete expired chunked uploads and their chunks"
+
+    def handle(self, *args, **options):
+        deleted = 0
+        for upload in expired_uploads().iterator():
+            delete_chunks(upload)
+            upload.delete()
+            deleted += 1
+
+        file_deleter.wait()
+        self.stdout.write("%s upload(s) deleted" % deleted)
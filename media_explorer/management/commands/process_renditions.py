@@ -0,0 +1,63 @@
+import os, time, socket
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from media_explorer.jobs import claim_job, process_job
+from media_explorer.deletions import file_deleter
+
+class Command(BaseCommand):
+    """
+    Worker that creates the resized images queued by element_post_save
+    Run as many of these as you like (on as many nodes as you like)
+    """
+
+    help = "Process queued rendition jobs"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--once",
+            action="store_true",
+            dest="once",
+            default=False,
+            help="Exit when there are no more jobs to process"),
+        make_option("--sleep",
+            type="float",
+            dest="sleep",
+            default=5,
+            help="Seconds to wait before polling an empty queue again"),
+        make_option("--max-jobs",
+            type="int",
+            dest="max_jobs",
+            default=0,
+            help="Exit after processing this many jobs (0 means no limit)"),
+        make_option("--worker-id",
+            dest="worker_id",
+            default=None,
+            help="Name recorded on the jobs claimed by this worker"),
+    )
+
+    def handle(self, *args, **options):
+        worker_id = options["worker_id"] or "%s:%s" % (socket.gethostname(), os.getpid())
+        processed = 0
+
+        while True:
+            close_old_connections()
+
+            job = claim_job(worker_id)
+            if not job:
+                if options["once"]:
+                    break
+                time.sleep(options["sleep"])
+                continue
+
+            rtn = process_job(job)
+            processed += 1
+            if rtn["success"]:
+                self.stdout.write("Processed element %s" % job.element_id)
+            else:
+                self.stderr.write("Failed element %s (attempt %s): %s" % (job.element_id, job.attempts, rtn["message"]))
+
+            if options["max_jobs"] and processed >= options["max_jobs"]:
+                break
+
+        file_deleter.wait()
+        self.stdout.write("%s job(s) processed" % processed)
@@ -0,0 +1,212 @@
+import os, time, traceback, multiprocessing
+from optparse import make_option
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, close_old_connections
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from media_explorer.models import Element, ResizedImage
+from media_explorer.jobs import enqueue_renditions, render_renditions
+from media_explorer.deletions import file_deleter
+
+def rebuild_element(element_id):
+    """
+    Rebuild the resized images of one element
+    Module level so it can run in a multiprocessing pool
+    """
+    close_old_connections()
+    try:
+        element = Element.objects.get(id=element_id)
+        rtn = render_renditions(element)
+        if rtn["success"]:
+            Element.objects.filter(id=element_id).update(status="ready")
+        return (element_id, rtn["success"], rtn["message"])
+    except Exception as e:
+        return (element_id, False, traceback.format_exc())
+    finally:
+        #Pool processes exit without running atexit - delete the replaced files now
+        if multiprocessing.current_process().name != "MainProcess":
+            file_deleter.wait()
+
+class Command(BaseCommand):
+    """
+    Rebuild the resized images of the library (e.g. after changing DME_RESIZE_WIDTHS)
+    Elements are read in chunks of ids so memory use does not grow with the library,
+    and the last finished chunk is written to --checkpoint so an interrupted run can be resumed.
+    """
+
+    help = "Rebuild the resized images of the elements"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--from-id",
+            type="int",
+            dest="from_id",
+            default=None,
+            help="Only elements with this id or higher"),
+        make_option("--to-id",
+            type="int",
+            dest="to_id",
+            default=None,
+            help="Only elements with this id or lower"),
+        make_option("--type",
+            dest="type",
+            default="image",
+            help="Only elements of this type (default: image)"),
+        make_option("--created-after",
+            dest="created_after",
+            default=None,
+            help="Only elements created on or after this date (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)"),
+        make_option("--created-before",
+            dest="created_before",
+            default=None,
+            help="Only elements created before this date (YYYY-MM-DD or YYYY-MM-DD HH:MM:SS)"),
+        make_option("--only-missing",
+            action="store_true",
+            dest="only_missing",
+            default=False,
+            help="Only elements that do not have all the configured sizes"),
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="Number of elements read from the database at a time"),
+        make_option("--workers",
+            type="int",
+            dest="workers",
+            default=1,
+            help="Number of processes rebuilding at the same time"),
+        make_option("--checkpoint",
+            dest="checkpoint",
+            default=None,
+            help="File recording the last finished id - the run resumes from it if it exists"),
+        make_option("--queue",
+            action="store_true",
+            dest="queue",
+            default=False,
+            help="Queue rendition jobs for the process_renditions workers instead of rebuilding here"),
+    )
+
+    def handle(self, *args, **options):
+        queryset = self.get_queryset(options)
+
+        last_id = self.read_checkpoint(options["checkpoint"])
+        if last_id:
+            self.stdout.write("Resuming after element %s" % last_id)
+            queryset = queryset.filter(id__gt=last_id)
+
+        total = queryset.count()
+        self.stdout.write("%s element(s) to check" % total)
+
+        pool = None
+        if options["workers"] > 1 and not options["queue"]:
+            #Each process opens its own database connection
+            connection.close()
+            pool = multiprocessing.Pool(options["workers"])
+
+        started = time.time()
+        checked = 0
+        rebuilt = 0
+        failed = 0
+
+        try:
+            while True:
+                chunk = list(queryset.filter(id__gt=last_id or 0).order_by("id").values_list("id",flat=True)[:options["chunk_size"]])
+                if not chunk:
+                    break
+                checked += len(chunk)
+
+                ids = self.missing(chunk) if options["only_missing"] else chunk
+
+                if options["queue"]:
+                    #Like an upload the elements are processing until the worker is done (see Element.prepare_image)
+                    Element.objects.filter(id__in=ids).update(status="processing")
+                    for element in Element.objects.filter(id__in=ids):
+                        enqueue_renditions(element)
+                    rebuilt += len(ids)
+                else:
+                    results = pool.imap_unordered(rebuild_element, ids) if pool else (rebuild_element(element_id) for element_id in ids)
+                    for element_id, success, message in results:
+                        if success:
+                            rebuilt += 1
+                        else:
+                            failed += 1
+                            self.stderr.write("Failed element %s: %s" % (element_id, message))
+
+                last_id = chunk[-1]
+                self.write_checkpoint(options["checkpoint"], last_id)
+
+                elapsed = time.time() - started
+                self.stdout.write("%s/%s checked, %s %s, %s failed (%.1f elements/s)" % (
+                    checked, total, rebuilt, "queued" if options["queue"] else "rebuilt", failed,
+                    checked/elapsed if elapsed else 0))
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        file_deleter.wait()
+        self.stdout.write("Done: %s %s, %s failed in %.1fs" % (
+            rebuilt, "queued" if options["queue"] else "rebuilt", failed, time.time() - started))
+
+    def get_queryset(self, options):
+        queryset = Element.objects.exclude(image_url="").exclude(image_url__isnull=True)
+
+        if options["type"]:
+            queryset = queryset.filter(type=options["type"])
+        if options["from_id"] is not None:
+            queryset = queryset.filter(id__gte=options["from_id"])
+        if options["to_id"] is not None:
+            queryset = queryset.filter(id__lte=options["to_id"])
+        if options["created_after"]:
+            queryset = queryset.filter(created_at__gte=self.parse_date(options["created_after"]))
+        if options["created_before"]:
+            queryset = queryset.filter(created_at__lt=self.parse_date(options["created_before"]))
+
+        return queryset
+
+    def parse_date(self, value):
+        date = parse_datetime(value)
+        if date is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError("Invalid date: %s" % value)
+            date = timezone.datetime(day.year, day.month, day.day)
+        if settings.USE_TZ and timezone.is_naive(date):
+            date = timezone.make_aware(date, timezone.get_current_timezone())
+        return date
+
+    def missing(self, ids):
+        """
+        The ids that do not have a ResizedImage for each of their planned sizes
+        """
+        from media_explorer.helpers import ImageHelper
+        helper = ImageHelper()
+
+        sizes = {}
+        for image_id, size in ResizedImage.objects.filter(image__in=ids).values_list("image_id","size"):
+            sizes.setdefault(image_id, set()).add(size)
+
+        rtn = []
+        for element in Element.objects.filter(id__in=ids).only("id","image_url","image_width","image_height").order_by("id"):
+            planned = helper.planned_sizes(element)
+            if planned and not getattr(settings,"DME_RESIZE_EAGER",True):
+                #The other sizes are created on demand
+                planned = ["orig_c"]
+            if not planned or not set(planned) <= sizes.get(element.id, set()):
+                rtn.append(element.id)
+        return rtn
+
+    def read_checkpoint(self, path):
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as fp:
+            value = fp.read().strip()
+        return int(value) if value else None
+
+    def write_checkpoint(self, path, last_id):
+        if not path:
+            return
+        #Write then rename so an interruption never leaves a half written file
+        with open(path + ".tmp", "w") as fp:
+            fp.write(str(last_id))
+        os.rename(path + ".tmp", path)
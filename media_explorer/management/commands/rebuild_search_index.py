@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from media_explorer.models import Element, Gallery
+from media_explorer.search import get_search_backend
+
+class Command(BaseCommand):
+    """
+    Build the search index of the DME_SEARCH_BACKEND from scratch
+    (the SearchTerm table of the default backend, the GIN index of the PostgreSQL backend).
+    The index is kept up to date by the Element and Gallery signals after that.
+    """
+
+    help = "Build the search index of the elements and galleries"
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        for model in [Element, Gallery]:
+            backend.rebuild(model)
+            self.stdout.write("%s: %s indexed" % (model._meta.verbose_name_plural, model.objects.count()))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from media_explorer.counts import rebuild_counts
+
+class Command(BaseCommand):
+    """
+    Count the elements (per type) and the galleries again
+    The counters are kept up to date by the Element and Gallery signals but not by
+    queryset.update(type=...) or rows written outside Django.
+    """
+
+    help = "Count the elements and galleries again for the explorer stats"
+
+    def handle(self, *args, **options):
+        for key, count in sorted(rebuild_counts().items()):
+            self.stdout.write("%s: %s" % (key, count))
@@ -0,0 +1,33 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand
+from media_explorer.models import Gallery, update_gallery_covers
+
+class Command(BaseCommand):
+    """
+    Set the cover element and thumbnail of every gallery
+    (for the galleries created before Gallery.cover_element was added)
+    The covers are kept up to date by the GalleryElement signals after that.
+    """
+
+    help = "Set the cover element and thumbnail of the galleries"
+
+    option_list = BaseCommand.option_list + (
+        make_option("--chunk-size",
+            type="int",
+            dest="chunk_size",
+            default=500,
+            help="Number of galleries updated at a time"),
+    )
+
+    def handle(self, *args, **options):
+        last_id = 0
+        checked = 0
+        while True:
+            gallery_ids = list(Gallery.objects.filter(id__gt=last_id).order_by("id").values_list("id",flat=True)[:options["chunk_size"]])
+            if not gallery_ids:
+                break
+            last_id = gallery_ids[-1]
+            update_gallery_covers(gallery_ids)
+            checked += len(gallery_ids)
+
+        self.stdout.write("%s galleries checked" % checked)
@@ -1,9 +1,9 @@
-import os
+import os, time
 from django.db import models
 import traceback
 from django.utils.translation import ugettext_lazy as _
 from django.contrib.auth.models import User
-from django.db.models import signals
+from django.db.models import signals, Q
 from django.conf import settings
 
 class Element(models.Model):
@@ -13,6 +13,7 @@ class Element(models.Model):
     """
 
     TYPE_CHOICES = (('image','Image'),('video','Video'))
+    STATUS_CHOICES = (('ready','Ready'),('processing','Processing'),('failed','Failed'))
 
     name = models.CharField(max_length=150,blank=True,null=True)
     file_name = models.CharField(max_length=150,blank=True,null=True)
@@ -23,6 +24,10 @@ class Element(models.Model):
     image_url = models.CharField(max_length=255,blank=True,null=True)
     image_width = models.IntegerField(blank=True,null=True,default='0')
     image_height = models.IntegerField(blank=True,null=True,default='0')
+    content_hash = models.CharField(max_length=64,blank=True,null=True,db_index=True)
+    phash = models.CharField(_("Perceptual hash"),max_length=16,blank=True,null=True,db_index=True)
+    placeholder = models.TextField(_("Placeholder image"),blank=True,null=True)
+    dominant_color = models.CharField(_("Dominant color"),max_length=7,blank=True,null=True)
     video_url = models.CharField(max_length=255,blank=True,null=True)
     video_embed = models.TextField(blank=True,null=True)
     manual_embed_code = models.BooleanField(_("Manually enter video embed code"), default=False)
@@ -31,24 +36,53 @@ class Element(models.Model):
     thumbnail_image_width = models.IntegerField(blank=True,null=True,default='0')
     thumbnail_image_height = models.IntegerField(blank=True,null=True,default='0')
     type = models.CharField(_("Type"), max_length=10, default="image",choices=TYPE_CHOICES)
+    status = models.CharField(_("Status"), max_length=10, default="ready",choices=STATUS_CHOICES)
     created_at = models.DateTimeField(blank=True,null=True,auto_now_add=True)
     updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
 
     class Meta:
         verbose_name_plural = "Elements"
+        #Keyset pagination (see media_explorer.pagination)
+        index_together = [("created_at","id")]
 
     def __unicode__(self):
         return u"%s" % (self.name)
 
     def save(self, *args, **kwargs):
-        if not self.name:
-            if self.type == "image":
-                self.name = self.file_name
-            elif self.type == "video":
-                self.name = self.video_url
+        #Everything derived from the image or the video is worked out first
+        #so the element is written with a single INSERT/UPDATE
+        self.prepare()
         super(Element, self).save(*args, **kwargs)
 
-    def save(self, *args, **kwargs):
+    def prepare(self):
+        """
+        Set the fields derived from the image or the video URL: type, names, URLs,
+        dimensions, content hash, placeholder, oEmbed data and thumbnail.
+        A new image is marked for resizing (see element_post_save).
+        """
+        for field in [self.image, self.thumbnail_image]:
+            if field and not field._committed:
+                #Store the uploaded file now instead of during the write (see FileField.pre_save)
+                field.save(field.name, field, save=False)
+
+        if self.video_url or self.video_embed:
+            self.type = "video"
+
+        self._resize = None
+        self._oembed_lookup = None
+        if self.image:
+            self.image_url = self.image.url
+            self.file_name = os.path.basename(str(self.image_url))
+
+            #Show the original until the resized thumbnail exists
+            if self.file_name != self.original_file_name or not self.thumbnail_image_url:
+                self.thumbnail_image = self.image
+
+            if self.file_name != self.original_file_name:
+                self.prepare_image()
+
+        if self.thumbnail_image:
+            self.thumbnail_image_url = self.thumbnail_image.url
 
         if not self.name:
             if self.type == "image":
@@ -56,21 +90,52 @@ class Element(models.Model):
             elif self.type == "video":
                 self.name = self.video_url
 
-        super(Element, self).save(*args, **kwargs)
-
-        save_again = False
-
-        #Init thumbnail_image
-        if self.type == "image" \
-                and self.image \
-                and not self.thumbnail_image:
-            self.image_url = self.image.url
-            self.thumbnail_image = self.image
-            self.thumbnail_image_url = self.image.url
-            save_again = True
-
-        if save_again:
-            super(Element, self).save(*args, **kwargs)
+        if self.video_url and not self.manual_embed_code:
+            self.prepare_video()
+
+        #If there is still no thumbnail image then use the default
+        if self.type == "video" and not self.thumbnail_image_url:
+            self.thumbnail_image_url = settings.DME_VIDEO_THUMBNAIL_DEFAULT_URL
+
+    def prepare_image(self):
+        from .helpers import probe_stored_image, displayed_size
+
+        #Read the dimensions of a new image from its header (without decoding it) - as shown, after the EXIF orientation
+        probe = probe_stored_image(self.image.storage, self.image.name)
+        if probe["success"]:
+            self.image_width, self.image_height = displayed_size(probe["width"], probe["height"], probe["orientation"])
+
+        #The perceptual hash and the placeholder of the new image are worked out when it is decoded for the renditions (see render_renditions)
+        self.phash = None
+        self.placeholder = None
+        self.dominant_color = None
+
+        #The resized images are created once the element is written
+        self.original_file_name = self.file_name
+        if settings.DME_RESIZE and getattr(settings,"DME_RESIZE_ASYNC",True):
+            #Let the process_renditions worker create the resized images
+            self.status = "processing"
+            self._resize = "async"
+        else:
+            self._resize = "sync"
+
+    def prepare_video(self):
+        from .oembed import oembed_resolver, apply_oembed
+
+        if getattr(settings,"DME_OEMBED_ASYNC",True):
+            #The save never waits for the providers: a URL that is not cached (or is stale) is looked up
+            #in the background once the element is written and update_video_elements fills in the embed code
+            entry = oembed_resolver.cached(self.video_url)
+            oembed = entry["data"] if entry else None
+            if entry is None or entry["expires_at"] < time.time():
+                self._oembed_lookup = self.video_url
+        else:
+            #A new URL is looked up during the save (DME_OEMBED_TIMEOUT seconds at most)
+            changed = self.video_url != getattr(self, "_loaded_video_url", None) or not self.video_embed
+            oembed = oembed_resolver.get(self.video_url, block=changed)
+        if oembed:
+            apply_oembed(self, oembed)
+        self._loaded_video_url = self.video_url
 
 class Gallery(models.Model):
     """
@@ -82,16 +147,32 @@ class Gallery(models.Model):
     description = models.TextField(blank=True,null=True)
     thumbnail_image = models.ImageField(blank=True,null=True,max_length=255,upload_to="images/")
     thumbnail_image_url = models.CharField(max_length=255,blank=True,null=True)
+    #The first element - thumbnail_image_url is its thumbnail (see update_gallery_covers)
+    cover_element = models.ForeignKey(Element,blank=True,null=True,related_name="covered_galleries",on_delete=models.SET_NULL)
     elements = models.ManyToManyField(Element, through="GalleryElement")
     created_at = models.DateTimeField(blank=True,null=True,auto_now_add=True)
     updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
 
     class Meta:
         verbose_name_plural = "Galleries"
+        #Keyset pagination (see media_explorer.pagination)
+        index_together = [("created_at","id")]
 
     def __unicode__(self):
         return u"%s" % (self.name)
 
+    def save(self, *args, **kwargs):
+        #The cover is kept up to date by the GalleryElement signals (see update_gallery_covers)
+        #so it is not written from a gallery that was loaded before its elements changed
+        #A new gallery may have an explicit pk (e.g. fixtures) - there is no row to update yet
+        if not self.pk or self._state.adding:
+            if not self.cover_element_id:
+                self.thumbnail_image_url = settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL
+        elif not args and not kwargs:
+            kwargs["update_fields"] = [field.name for field in self._meta.concrete_fields
+                                        if not field.primary_key and field.name not in ["cover_element","thumbnail_image_url"]]
+        super(Gallery, self).save(*args, **kwargs)
+
 class GalleryElement(models.Model):
     """
     The Gallery Element model will contain list of elements
@@ -118,9 +199,10 @@ class ResizedImage(models.Model):
     image = models.ForeignKey(Element)
     file_name = models.CharField(max_length=150,blank=True,null=True)
     size = models.CharField(max_length=25,blank=True,null=True)
-    image_url = models.CharField(max_length=255,blank=True,null=True)
+    image_url = models.CharField(max_length=255,blank=True,null=True,db_index=True)
     image_width = models.IntegerField(blank=True,null=True,default='0')
     image_height = models.IntegerField(blank=True,null=True,default='0')
+    format = models.CharField(max_length=10,blank=True,null=True)
     created_at = models.DateTimeField(blank=True,null=True,auto_now_add=True)
     updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
 
@@ -136,144 +218,291 @@ class ResizedImage(models.Model):
 
     html_img.allow_tags = True
 
+class RenditionJob(models.Model):
+    """
+    The RenditionJob is a queued request to create the ResizedImage versions of Element.image
+    It is picked up by the process_renditions management command
+    """
+
+    STATUS_CHOICES = (('pending','Pending'),('running','Running'),('done','Done'),('failed','Failed'))
+
+    element = models.ForeignKey(Element)
+    status = models.CharField(max_length=10, default="pending",choices=STATUS_CHOICES,db_index=True)
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=3)
+    run_after = models.DateTimeField(blank=True,null=True,db_index=True)
+    locked_by = models.CharField(max_length=150,blank=True,null=True)
+    locked_at = models.DateTimeField(blank=True,null=True)
+    last_error = models.TextField(blank=True,null=True)
+    created_at = models.DateTimeField(blank=True,null=True,auto_now_add=True)
+    updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
+
+    class Meta:
+        verbose_name = "Rendition job"
+        verbose_name_plural = "Rendition jobs"
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.element_id, self.status)
+
+class Upload(models.Model):
+    """
+    The Upload is a chunked (resumable) upload of an Element image
+    The chunks are kept in the storage until the upload is finished
+    """
+
+    STATUS_CHOICES = (('uploading','Uploading'),('finishing','Finishing'),('complete','Complete'))
+
+    token = models.CharField(max_length=32,unique=True)
+    user = models.ForeignKey(User,blank=True,null=True)
+    file_name = models.CharField(max_length=150)
+    size = models.BigIntegerField(default=0)
+    offset = models.BigIntegerField(default=0)
+    status = models.CharField(max_length=10, default="uploading",choices=STATUS_CHOICES,db_index=True)
+    #The element whose image is replaced - or the element created when the upload is finished
+    element = models.ForeignKey(Element,blank=True,null=True)
+    name = models.CharField(max_length=150,blank=True,null=True)
+    credit = models.CharField(max_length=255,blank=True,null=True)
+    description = models.TextField(blank=True,null=True)
+    created_at = models.DateTimeField(blank=True,null=True,auto_now_add=True)
+    updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
+
+    class Meta:
+        verbose_name = "Upload"
+        verbose_name_plural = "Uploads"
+
+    def __unicode__(self):
+        return u"%s (%s/%s)" % (self.file_name, self.offset, self.size)
+
+class SearchTerm(models.Model):
+    """
+    The SearchTerm is a word of an Element or a Gallery in the inverted index
+    of the default search backend (see media_explorer.search.IndexSearchBackend)
+    """
+
+    model_name = models.CharField(max_length=10)
+    object_id = models.IntegerField()
+    term = models.CharField(max_length=50)
+    weight = models.IntegerField(default=1)
+
+    class Meta:
+        verbose_name = "Search term"
+        verbose_name_plural = "Search terms"
+        index_together = [("model_name","term","object_id"),("model_name","object_id")]
+
+    def __unicode__(self):
+        return u"%s (%s %s)" % (self.term, self.model_name, self.object_id)
+
+class MediaCount(models.Model):
+    """
+    The MediaCount is a shard of the number of elements (of a type) or galleries shown by the explorer stats
+    The number is the sum of the shards of a key. They are kept up to date by the Element and Gallery signals (see media_explorer.counts)
+    """
+
+    key = models.CharField(max_length=50)
+    shard = models.IntegerField(default=0)
+    count = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(blank=True,null=True,auto_now=True)
+
+    class Meta:
+        verbose_name = "Media count"
+        verbose_name_plural = "Media counts"
+        unique_together = [("key","shard")]
+
+    def __unicode__(self):
+        return u"%s/%s (%s)" % (self.key, self.shard, self.count)
+
 def resizedimage_post_delete(sender, instance, **kwargs):
     """
     Deletes file from filesystem when corresponding `ResizedImage` object is deleted.
+    The file is deleted after the commit, unless it is shared with a duplicate element (see deletions.py)
     """
 
     try:
         if instance.image_url:
-            if os.path.isfile(settings.PROJECT_ROOT + instance.image_url):
-                os.remove(settings.PROJECT_ROOT + instance.image_url)
+            from .deletions import file_deleter
+            from .storage import get_storage, storage_name
+            storage = get_storage()
+            file_deleter.delete(storage, storage_name(instance.image_url, storage), [("ResizedImage","image_url",instance.image_url)])
     except:
         print traceback.format_exc()
 
 def element_post_delete(sender, instance, **kwargs):
     """
     Deletes file from filesystem when corresponding `Element` object is deleted.
+    The files are deleted after the commit, unless they are shared with a duplicate element (see deletions.py)
     """
+    from .deletions import file_deleter
 
     try:
-        if instance.image:
-            if os.path.isfile(instance.image.path):
-                os.remove(instance.image.path)
-    except:
-        print traceback.format_exc()
-
-    try:
-        if instance.thumbnail_image:
-            if os.path.isfile(instance.thumbnail_image.path):
-                os.remove(instance.thumbnail_image.path)
+        for field in [instance.image, instance.thumbnail_image]:
+            if field:
+                file_deleter.delete(field.storage, field.name, [("Element","image",field.name),("Element","thumbnail_image",field.name)])
     except:
         print traceback.format_exc()
 
     try:
         if instance.thumbnail_image_url:
-            if os.path.isfile(settings.PROJECT_ROOT + instance.thumbnail_image_url):
-                os.remove(settings.PROJECT_ROOT + instance.thumbnail_image_url)
+            from .storage import get_storage, storage_name
+            storage = get_storage()
+            file_deleter.delete(storage, storage_name(instance.thumbnail_image_url, storage),
+                [("Element","thumbnail_image_url",instance.thumbnail_image_url),("Element","image_url",instance.thumbnail_image_url)])
     except:
         print traceback.format_exc()
 
+def update_gallery_covers(gallery_ids):
+    """
+    Point the galleries to their first element (lowest sort_by) and copy its thumbnail URL
+    Only the galleries whose cover changed are written (with update() so no signal runs)
+    """
+    gallery_ids = set([id for id in gallery_ids if id])
+    if not gallery_ids:
+        return
+
+    covers = {}
+    rows = GalleryElement.objects.filter(gallery_id__in=gallery_ids).order_by("gallery_id","sort_by","id") \
+            .values_list("gallery_id","element_id","element__thumbnail_image_url")
+    for gallery_id, element_id, thumbnail_image_url in rows:
+        if gallery_id not in covers:
+            covers[gallery_id] = (element_id, thumbnail_image_url or settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL)
+
+    for gallery_id, cover_element_id, thumbnail_image_url in Gallery.objects.filter(id__in=gallery_ids).values_list("id","cover_element_id","thumbnail_image_url"):
+        cover = covers.get(gallery_id, (None, settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL))
+        if (cover_element_id, thumbnail_image_url) != cover:
+            Gallery.objects.filter(id=gallery_id).update(cover_element=cover[0], thumbnail_image_url=cover[1])
+
+def update_cover_thumbnails(element):
+    """
+    Copy the thumbnail URL of an element to the galleries it is the cover of
+    """
+    Gallery.objects.filter(cover_element_id=element.id) \
+            .exclude(thumbnail_image_url=element.thumbnail_image_url) \
+            .update(thumbnail_image_url=element.thumbnail_image_url or settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL)
+
+def galleryelement_post_init(sender, instance, **kwargs):
+    #Remember the gallery so the old one is updated when an element moves to another gallery
+    instance._loaded_gallery_id = instance.gallery_id
+
+def galleryelement_post_save(sender, instance, created, **kwargs):
     try:
-        #Check to see if this thumbanil is used by gallery - if so resave the gallery to reset thumbnail
-        for gallery in Gallery.objects.filter(thumbnail_image_url=instance.thumbnail_image_url):
-            gallery.save()
+        update_gallery_covers([instance.gallery_id, getattr(instance, "_loaded_gallery_id", None)])
+        instance._loaded_gallery_id = instance.gallery_id
     except:
         print traceback.format_exc()
 
-def gallery_post_save(sender, instance, created, **kwargs):
-    #Disconnect signal here so we don't recurse when we save
-    signals.post_save.disconnect(gallery_post_save, sender=Gallery)
-
-    #Grap the thumbnail URL from the first element - or use the default
-    has_thumbnail = False
+def galleryelement_post_delete(sender, instance, **kwargs):
     try:
-        #Get the first element and set the thumbnail
-        if GalleryElement.objects.filter(gallery=instance).exists():
-            ge = GalleryElement.objects.filter(gallery=instance).order_by("sort_by")[0]
-            if ge.element.thumbnail_image_url:
-                has_thumbnail = True
-                instance.thumbnail_image_url = ge.element.thumbnail_image_url
-                instance.save()
+        update_gallery_covers([instance.gallery_id])
     except:
         print traceback.format_exc()
 
-    if not has_thumbnail:
-        instance.thumbnail_image_url = settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL
-        instance.save()
-
-    #Reconnect signal
-    signals.post_save.connect(gallery_post_save, sender=Gallery)
-
+def element_post_init(sender, instance, **kwargs):
+    #Remember the video URL so it is only looked up again when it changes
+    instance._loaded_video_url = instance.video_url
+    #Remember the type so the counters are moved when it changes (None when it was deferred)
+    instance._loaded_type = instance.__dict__.get("type")
 
 def element_post_save(sender, instance, created, **kwargs):
+    """
+    Create the resized images of a new image - everything else was set by Element.prepare before the write
+    """
+    resize = getattr(instance, "_resize", None)
+    instance._resize = None
+    oembed_lookup = getattr(instance, "_oembed_lookup", None)
+    instance._oembed_lookup = None
 
-    #Disconnect signal here so we don't recurse when we save
-    signals.post_save.disconnect(element_post_save, sender=Element)
-
-    if instance.video_url or instance.video_embed:
-        instance.type = "video"
-
-    if instance.image:
-        instance.image_url = instance.image.url
-      	instance.file_name = os.path.basename(str(instance.image_url))
-      	if not instance.name:
-            instance.name = instance.file_name
-
-        instance.thumbnail_image = instance.image
-
-    if instance.thumbnail_image:
-        instance.thumbnail_image_url = instance.thumbnail_image.url
-
-    instance.save()
+    try:
+        if not created:
+            update_cover_thumbnails(instance)
+    except:
+        print traceback.format_exc()
 
-    if instance.video_url:
-        try:
-            import micawber
-            providers = micawber.bootstrap_basic()
-            oembed = providers.request(instance.video_url)
-            if "html" in oembed:
-                instance.video_embed = oembed["html"]
-
-                if not instance.thumbnail_image:
-                    if "thumbnail_url" in oembed:
-                        instance.thumbnail_image_url = oembed["thumbnail_url"]
-                    if "thumbnail_width" in oembed:
-                        instance.thumbnail_image_height = oembed["thumbnail_width"]
-                    if "thumbnail_height" in oembed:
-                        instance.thumbnail_image_height = oembed["thumbnail_height"]
-                
-        except Exception as e:
-            print traceback.format_exc()
+    #Look the video up once the element can be found by update_video_elements
+    try:
+        if oembed_lookup:
+            from .oembed import oembed_resolver
+            from .deletions import on_commit
+            on_commit(lambda: oembed_resolver.refresh(oembed_lookup))
+    except:
+        print traceback.format_exc()
 
     #Process images and thumbnails
     try:
-        if instance.image and instance.file_name != instance.original_file_name:
-            instance.original_file_name = instance.file_name
-            instance.save()
-            from .helpers import ImageHelper
-            helper = ImageHelper()
-            rtn = helper.resize(instance)
-            if rtn["success"]: 
+        if resize == "async":
+            from .jobs import enqueue_renditions
+            enqueue_renditions(instance)
+        elif resize == "sync":
+            from .jobs import render_renditions
+            rtn = render_renditions(instance)
+            if rtn["success"]:
                 if rtn["thumbnail_image_url"]:
                     instance.thumbnail_image = ""
                     instance.thumbnail_image_url = rtn["thumbnail_image_url"]
-                    instance.save()
             else:
                 print rtn["message"]
     except Exception as e:
         print traceback.format_exc()
 
-    #If there is still no thumbnail image then use the default
-    if instance.type == "video" and not instance.thumbnail_image_url:
-        instance.thumbnail_image_url = settings.DME_VIDEO_THUMBNAIL_DEFAULT_URL
+def counts_post_save(sender, instance, created, **kwargs):
+    try:
+        from .counts import increment, total_keys
+        model_name = instance._meta.concrete_model.__name__
+        type = getattr(instance, "type", None)
+        loaded_type = getattr(instance, "_loaded_type", None)
+        if created:
+            increment(total_keys(model_name, type), 1)
+        elif loaded_type and type != loaded_type:
+            increment(total_keys(model_name, loaded_type)[1:], -1)
+            increment(total_keys(model_name, type)[1:], 1)
+        instance._loaded_type = type
+    except:
+        print traceback.format_exc()
+
+def counts_post_delete(sender, instance, **kwargs):
+    try:
+        from .counts import increment, total_keys
+        increment(total_keys(instance._meta.concrete_model.__name__, getattr(instance, "type", None)), -1)
+    except:
+        print traceback.format_exc()
+
+def counts_post_migrate(sender, **kwargs):
+    """
+    Create the counters before the explorer is used (see counts.rebuild_counts)
+    """
+    if getattr(sender, "name", None) != "media_explorer":
+        return
+    try:
+        from .counts import rebuild_counts
+        rebuild_counts()
+    except:
+        print traceback.format_exc()
 
-    instance.save()
+def search_index_post_save(sender, instance, **kwargs):
+    try:
+        from .search import get_search_backend
+        get_search_backend().update(instance)
+    except:
+        print traceback.format_exc()
 
-    #Reconnect signal
-    signals.post_save.connect(element_post_save, sender=Element)
+def search_index_post_delete(sender, instance, **kwargs):
+    try:
+        from .search import get_search_backend
+        get_search_backend().remove(instance)
+    except:
+        print traceback.format_exc()
 
+signals.post_init.connect(element_post_init, sender=Element)
 signals.post_save.connect(element_post_save, sender=Element)
-signals.post_save.connect(gallery_post_save, sender=Gallery)
+signals.post_init.connect(galleryelement_post_init, sender=GalleryElement)
+signals.post_save.connect(galleryelement_post_save, sender=GalleryElement)
+signals.post_delete.connect(galleryelement_post_delete, sender=GalleryElement)
 signals.post_delete.connect(element_post_delete, sender=Element)
 signals.post_delete.connect(resizedimage_post_delete, sender=ResizedImage)
+signals.post_save.connect(search_index_post_save, sender=Element)
+signals.post_save.connect(search_index_post_save, sender=Gallery)
+signals.post_delete.connect(search_index_post_delete, sender=Element)
+signals.post_delete.connect(search_index_post_delete, sender=Gallery)
+signals.post_save.connect(counts_post_save, sender=Element)
+signals.post_save.connect(counts_post_save, sender=Gallery)
+signals.post_delete.connect(counts_post_delete, sender=Element)
+signals.post_delete.connect(counts_post_delete, sender=Gallery)
+signals.post_migrate.connect(counts_post_migrate)
@@ -0,0 +1,175 @@
+import hashlib, threading, time, traceback
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.module_loading import import_string
+from django.utils.html import escape
+import micawber
+from micawber.exceptions import ProviderException, ProviderNotFoundException, InvalidResponseException
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+def get_providers():
+    """
+    The oEmbed provider registry - built once per process.
+    settings.DME_OEMBED_PROVIDERS is the dotted path of a function that returns a micawber ProviderRegistry
+    (micawber.bootstrap_basic by default, media_explorer.oembed.stub_providers in tests)
+    The providers wait DME_OEMBED_TIMEOUT seconds at most.
+    """
+    path = getattr(settings,"DME_OEMBED_PROVIDERS",None) or "micawber.bootstrap_basic"
+    with _registries_lock:
+        if path not in _registries:
+            registry = import_string(path)()
+            for regex, provider in registry:
+                provider.socket_timeout = getattr(settings,"DME_OEMBED_TIMEOUT",3)
+            _registries[path] = registry
+        return _registries[path]
+
+class StubProvider(object):
+    """
+    Local provider that answers every URL without a network request - for tests and development
+    """
+
+    def request(self, url, **extra_params):
+        return {
+            "type": "video",
+            "url": url,
+            "title": url,
+            "html": '<iframe src="%s" frameborder="0" allowfullscreen></iframe>' % escape(url),
+            "thumbnail_url": getattr(settings,"DME_VIDEO_THUMBNAIL_DEFAULT_URL",""),
+            "thumbnail_width": 480,
+            "thumbnail_height": 360,
+        }
+
+def stub_providers():
+    """
+    DME_OEMBED_PROVIDERS = "media_explorer.oembed.stub_providers"
+    """
+    providers = micawber.ProviderRegistry()
+    providers.register(r"https?://\S+", StubProvider())
+    return providers
+
+class OEmbedResolver(object):
+    """
+    oEmbed responses cached by URL (in the Django cache so all the processes share them).
+    Responses are fresh for DME_OEMBED_CACHE_TTL seconds and failures for DME_OEMBED_NEGATIVE_TTL seconds.
+    A stale response is still returned while it is fetched again in a background thread
+    and the elements with that URL are updated when the new response arrives.
+    """
+
+    def key(self, url):
+        return "dme-oembed-" + hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def cached(self, url):
+        """
+        The cached {"data":..., "expires_at":...} of url - None when it was not looked up yet
+        """
+        return cache.get(self.key(url))
+
+    def get(self, url, block=True):
+        """
+        The oEmbed data of url (None when the providers can not embed it)
+        With block=False a URL that is not cached yet is fetched in the background and None is returned
+        """
+        entry = self.cached(url)
+        if entry is None:
+            if block:
+                return self.fetch(url)
+            self.refresh(url)
+            return None
+
+        if entry["expires_at"] < time.time():
+            self.refresh(url)
+        return entry["data"]
+
+    def fetch(self, url):
+        """
+        Request url from the providers and cache the response (or the failure)
+        """
+        try:
+            data = get_providers().request(url)
+            if "html" not in data:
+                data = None
+        except (ProviderException, ProviderNotFoundException, InvalidResponseException) as e:
+            data = None
+        except Exception as e:
+            print traceback.format_exc()
+            data = None
+
+        if data is None:
+            ttl = getattr(settings,"DME_OEMBED_NEGATIVE_TTL",60*10)
+        else:
+            ttl = getattr(settings,"DME_OEMBED_CACHE_TTL",60*60*24)
+
+        entry = {"data":data,"expires_at":time.time() + ttl}
+        #Stale responses are kept (and served) until they are fetched again
+        cache.set(self.key(url), entry, max(ttl, getattr(settings,"DME_OEMBED_CACHE_MAX_AGE",60*60*24*7)))
+        return data
+
+    def refresh(self, url):
+        """
+        Fetch url again in a background thread - unless another thread or process already is
+        """
+        lock = self.key(url) + "-refresh"
+        if not cache.add(lock, 1, getattr(settings,"DME_OEMBED_REFRESH_TIMEOUT",60)):
+            return
+
+        def run():
+            try:
+                data = self.fetch(url)
+                if data is not None:
+                    update_video_elements(url, data)
+            except:
+                print traceback.format_exc()
+            finally:
+                cache.delete(lock)
+
+        def run_in_thread():
+            try:
+                run()
+            finally:
+                connection.close()
+
+        if getattr(settings,"DME_OEMBED_ASYNC",True):
+            thread = threading.Thread(target=run_in_thread)
+            thread.daemon = True
+            thread.start()
+        else:
+            run()
+
+def apply_oembed(element, data):
+    """
+    Copy the embed code and the thumbnail of an oEmbed response to a video element
+    """
+    element.video_embed = data["html"]
+    if not element.thumbnail_image:
+        if "thumbnail_url" in data:
+            element.thumbnail_image_url = data["thumbnail_url"]
+        if "thumbnail_width" in data:
+            element.thumbnail_image_width = data["thumbnail_width"]
+        if "thumbnail_height" in data:
+            element.thumbnail_image_height = data["thumbnail_height"]
+
+def update_video_elements(url, data):
+    """
+    Update the elements of a video URL after a background refresh
+    NOTE: we use update() so the element signals do not run (and do not look the URL up again)
+    """
+    from media_explorer.models import Element, update_cover_thumbnails
+    for element in Element.objects.filter(video_url=url,manual_embed_code=False):
+        before = (element.video_embed, element.thumbnail_image_url, element.thumbnail_image_width, element.thumbnail_image_height)
+        apply_oembed(element, data)
+        after = (element.video_embed, element.thumbnail_image_url, element.thumbnail_image_width, element.thumbnail_image_height)
+        if before != after:
+            Element.objects.filter(id=element.id).update(
+                video_embed=element.video_embed,
+                thumbnail_image_url=element.thumbnail_image_url,
+                thumbnail_image_width=element.thumbnail_image_width,
+                thumbnail_image_height=element.thumbnail_image_height,
+            )
+            update_cover_thumbnails(element)
+
+oembed_resolver = OEmbedResolver()
+
+#EOF
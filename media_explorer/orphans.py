@@ -0,0 +1,139 @@
+import heapq, os, posixpath, tempfile
+from itertools import groupby
+from django.conf import settings
+from media_explorer.models import Element, Gallery, ResizedImage
+from media_explorer.storage import get_storage, storage_name
+
+#os.scandir (Python 3.5) or the scandir package stream a directory instead of listing it at once
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+def storage_files(storage, directory):
+    """
+    Yield the names of the files under directory (recursively)
+    Directories of a FileSystemStorage are streamed with scandir when it is available
+    """
+    directory = directory.strip("/")
+    path = None
+    if scandir is not None:
+        try:
+            path = storage.path(directory)
+        except NotImplementedError:
+            pass
+
+    if path is not None:
+        if not os.path.isdir(path):
+            return
+        for entry in scandir(path):
+            name = posixpath.join(directory, entry.name)
+            if entry.is_dir():
+                for sub_name in storage_files(storage, name):
+                    yield sub_name
+            else:
+                yield name
+        return
+
+    try:
+        directories, files = storage.listdir(directory)
+    except (OSError, IOError):
+        return
+    for file_name in files:
+        yield posixpath.join(directory, file_name)
+    for sub_directory in directories:
+        for name in storage_files(storage, posixpath.join(directory, sub_directory)):
+            yield name
+
+def external_sort(lines, run_size=100000):
+    """
+    Yield the unique unicode lines in order
+    Runs of run_size lines are sorted in memory and written to temporary files
+    which are then merged, so memory use does not grow with the number of lines
+    """
+    runs = []
+    try:
+        run = []
+        for line in lines:
+            run.append(line.encode("utf-8"))
+            if len(run) >= run_size:
+                runs.append(_write_run(run))
+                run = []
+        if run or not runs:
+            runs.append(_write_run(run))
+
+        previous = None
+        for line in heapq.merge(*runs):
+            if line != previous:
+                yield line.rstrip(b"\n").decode("utf-8")
+                previous = line
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+def _write_run(run):
+    run.sort()
+    run_file = tempfile.TemporaryFile()
+    for line in run:
+        run_file.write(line + b"\n")
+    run_file.seek(0)
+    return run_file
+
+def file_references(storage, chunk_size=1000):
+    """
+    Yield "name<TAB>model<TAB>id" for every file in storage the database refers to
+    (originals, thumbnails and resized images)
+    """
+    def field_names(model, fields):
+        last_id = 0
+        while True:
+            rows = list(model.objects.filter(id__gt=last_id).order_by("id").values_list("id", *fields)[:chunk_size])
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            for row in rows:
+                for field, value in zip(fields, row[1:]):
+                    if not value:
+                        continue
+                    if field.endswith("_url"):
+                        value = storage_name(value, storage)
+                    yield u"%s\t%s\t%s" % (value, model.__name__, row[0])
+
+    for line in field_names(Element, ["image","image_url","thumbnail_image","thumbnail_image_url"]):
+        yield line
+    for line in field_names(Gallery, ["thumbnail_image","thumbnail_image_url"]):
+        yield line
+    for line in field_names(ResizedImage, ["image_url"]):
+        yield line
+
+def compare_files(storage, directory, run_size=100000):
+    """
+    Merge the sorted files of directory with the sorted database references to them
+    Yield (name, stored, references) for each name that is stored or referenced (in name order)
+    where references is a list of (model name, id)
+    """
+    prefix = directory.strip("/") + "/"
+    stored = external_sort(storage_files(storage, directory), run_size)
+    referenced = external_sort((line for line in file_references(storage) if line.startswith(prefix)), run_size)
+    grouped = groupby((line.split(u"\t") for line in referenced), key=lambda fields: fields[0])
+
+    name = next(stored, None)
+    group = next(grouped, None)
+    while name is not None or group is not None:
+        if group is None or (name is not None and name < group[0]):
+            yield name, True, []
+            name = next(stored, None)
+            continue
+
+        references = [(model, int(id)) for _, model, id in group[1]]
+        if name == group[0]:
+            yield name, True, references
+            name = next(stored, None)
+        else:
+            yield group[0], False, references
+        group = next(grouped, None)
+
+#EOF
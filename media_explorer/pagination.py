@@ -0,0 +1,126 @@
+import base64, json
+from django.conf import settings
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models import Q
+
+def encode_cursor(sort, backwards, obj):
+    """
+    Opaque cursor pointing just after (or before when backwards) obj in the sort order
+    """
+    field = obj._meta.get_field(sort)
+    value = None if getattr(obj, field.attname) is None else field.value_to_string(obj)
+    data = json.dumps([sort, 1 if backwards else 0, value, obj.pk], separators=(",",":"))
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor, sort, model):
+    """
+    (backwards, sort value, id) of a cursor made by encode_cursor
+    Raises ValueError when the cursor is invalid or was made for another sort column
+    """
+    try:
+        cursor = str(cursor)
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8"))
+        cursor_sort, backwards, value, pk = data
+        if cursor_sort != sort:
+            raise ValueError("The cursor was made for another sort column")
+        if value is not None:
+            value = model._meta.get_field(sort).to_python(value)
+        return bool(backwards), value, int(pk)
+    except ValueError:
+        raise
+    except Exception as e:
+        raise ValueError("Invalid cursor")
+
+def cursor_page(queryset, sort="created_at", direction="desc", cursor=None, limit=None):
+    """
+    Keyset pagination: a page of queryset ordered by sort and id (the tie-breaker)
+    starting after the cursor, so a page costs the same at any depth and
+    rows inserted meanwhile do not shift the pages.
+    Returns {"results":[...], "next":cursor or None, "previous":cursor or None}
+    NULL sort values come after every other value (last when ascending, first when descending) on every database
+    Raises ValueError for an unknown sort column or an invalid cursor
+    """
+    if limit is None:
+        limit = settings.DME_PAGE_SIZE
+
+    model = queryset.model
+    try:
+        field = model._meta.get_field(sort)
+    except FieldDoesNotExist:
+        raise ValueError("Unknown sort column %s" % sort)
+    nullable = False
+    if field.rel or field.primary_key:
+        sort = "id"
+    elif field.null:
+        nullable = True
+
+    backwards = False
+    position = None
+    if cursor:
+        backwards, value, pk = decode_cursor(cursor, sort, model)
+        if value is None and not nullable and sort != "id":
+            raise ValueError("Invalid cursor")
+        position = (value, pk)
+
+    #A previous page is read in the opposite order and turned around
+    descending = (direction.lower() != "asc") != backwards
+
+    #Databases do not agree on where NULLs sort, so the NULL rows are a second segment read by id after
+    #the others (before them when descending) - each segment is a plain seek on its own index
+    segments = [False]
+    if nullable:
+        segments = [True, False] if descending else [False, True]
+    start = 0
+    if position and nullable:
+        start = segments.index(position[0] is None)
+
+    rows = []
+    for null in segments[start:]:
+        segment = _segment(queryset, sort, nullable, null, descending, position if null == segments[start] else None)
+        rows += list(segment[:limit + 1 - len(rows)])
+        if len(rows) > limit:
+            break
+
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backwards:
+        rows.reverse()
+
+    rtn = {}
+    rtn["results"] = rows
+    rtn["next"] = None
+    rtn["previous"] = None
+    if rows:
+        if more or backwards:
+            rtn["next"] = encode_cursor(sort, False, rows[-1])
+        if (more and backwards) or (position and not backwards):
+            rtn["previous"] = encode_cursor(sort, True, rows[0])
+    return rtn
+
+def _segment(queryset, sort, nullable, null, descending, position=None):
+    """
+    The rows of queryset with (null) or without a NULL sort value after position, in the order they are read
+    """
+    prefix = "-" if descending else ""
+    lookup = "lt" if descending else "gt"
+
+    if null:
+        queryset = queryset.filter(**{sort + "__isnull": True})
+        if position:
+            queryset = queryset.filter(**{"id__" + lookup: position[1]})
+        return queryset.order_by(prefix + "id")
+
+    if nullable:
+        queryset = queryset.filter(**{sort + "__isnull": False})
+    if position:
+        value, pk = position
+        if sort == "id":
+            queryset = queryset.filter(**{"id__" + lookup: pk})
+        else:
+            queryset = queryset.filter(Q(**{sort + "__" + lookup: value}) | Q(**{sort: value, "id__" + lookup: pk}))
+
+    if sort == "id":
+        return queryset.order_by(prefix + "id")
+    return queryset.order_by(prefix + sort, prefix + "id")
+
+#EOF
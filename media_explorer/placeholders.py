@@ -0,0 +1,49 @@
+import base64
+from io import BytesIO
+from django.conf import settings
+
+try:
+	from PIL import Image
+except ImportError:
+	import Image
+
+#Number of colors the placeholder is reduced to when looking for the dominant color
+PALETTE_SIZE = 5
+
+def image_placeholder(image):
+    """
+    Low quality placeholder of a PIL image: a tiny JPEG (DME_PLACEHOLDER_WIDTH pixels wide)
+    as a data URI and the dominant color as #rrggbb.
+    Templates show them while the full rendition is loading (see the placeholder_style filter).
+    """
+    width = getattr(settings,"DME_PLACEHOLDER_WIDTH",20)
+    height = max(int(round(image.size[1]*width/float(image.size[0]))), 1)
+
+    if image.format == "JPEG":
+        #Decode at the smallest DCT scale that still covers the placeholder
+        image.draft("RGB", (width, height))
+    if image.mode not in ("RGB", "L"):
+        #Transparent pixels are shown on white
+        rgba = image.convert("RGBA")
+        image = Image.new("RGB", rgba.size, (255, 255, 255))
+        image.paste(rgba, mask=rgba.split()[3])
+    small = image.convert("RGB").resize((width, height), Image.ANTIALIAS)
+
+    buf = BytesIO()
+    small.save(buf, "JPEG", quality=getattr(settings,"DME_PLACEHOLDER_QUALITY",70))
+
+    rtn = {}
+    rtn["placeholder"] = "data:image/jpeg;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+    rtn["dominant_color"] = dominant_color(small)
+    return rtn
+
+def dominant_color(image):
+    """
+    The most common color (as #rrggbb) of a small RGB image reduced to PALETTE_SIZE colors
+    """
+    quantized = image.quantize(colors=PALETTE_SIZE)
+    count, index = max(quantized.getcolors())
+    palette = quantized.getpalette()
+    return "#%02x%02x%02x" % tuple(palette[index*3:index*3 + 3])
+
+#EOF
@@ -0,0 +1,212 @@
+import re, threading
+from django.conf import settings
+from django.db import connection
+from django.utils.module_loading import import_string
+
+#Words are runs of letters and digits (no underscore so a term never holds a LIKE wildcard)
+WORD_RE = re.compile(r"[^\W_]+", re.UNICODE)
+
+#Longest term kept in the index - longer words are cut
+MAX_TERM_LENGTH = 50
+
+#The searched fields of each model and their weight in the rank
+SEARCH_FIELDS = {
+    "Element": [("name",3),("credit",1),("description",1)],
+    "Gallery": [("name",3),("description",1)],
+}
+
+def search_terms(text):
+    """
+    The lowercase words of text (in order, without duplicates)
+    """
+    terms = []
+    for word in WORD_RE.findall(text or u""):
+        term = word.lower()[:MAX_TERM_LENGTH]
+        if term not in terms:
+            terms.append(term)
+    return terms
+
+def indexed_model_name(obj):
+    #Instances loaded with only() or defer() belong to a generated subclass
+    return obj._meta.concrete_model.__name__
+
+class BaseSearchBackend(object):
+    """
+    A search backend filters the Element and Gallery querysets with the explorer filter:
+    every term must match (a term matches the words it starts) and sort=relevance ranks the matches.
+    """
+
+    def filter(self, queryset, query):
+        raise NotImplementedError
+
+    def rank(self, queryset, query):
+        """
+        Order a queryset filtered by filter() by relevance (best match first)
+        """
+        return queryset.order_by("-id")
+
+    def update(self, obj):
+        """
+        Called after an Element or a Gallery is saved
+        """
+        pass
+
+    def remove(self, obj):
+        """
+        Called after an Element or a Gallery is deleted
+        """
+        pass
+
+    def rebuild(self, model):
+        """
+        Index every row of model again (rebuild_search_index command)
+        """
+        pass
+
+class LikeSearchBackend(BaseSearchBackend):
+    """
+    icontains on the searched fields - no index, for small tables
+    """
+
+    def filter(self, queryset, query):
+        from django.db.models import Q
+        for term in search_terms(query):
+            term_query = None
+            for field, weight in SEARCH_FIELDS[queryset.model.__name__]:
+                field_query = Q(**{field + "__icontains": term})
+                term_query = field_query if term_query is None else term_query | field_query
+            queryset = queryset.filter(term_query)
+        return queryset
+
+class IndexSearchBackend(BaseSearchBackend):
+    """
+    Inverted index in the SearchTerm table, kept up to date by the Element and Gallery signals.
+    A term matches the words it starts (term__startswith, a LIKE 'term%' that does not depend on the collation)
+    and the rank is the sum of the weights of the matched words.
+    On PostgreSQL the rebuild_search_index command creates the varchar_pattern_ops index the LIKE uses.
+    """
+
+    def filter(self, queryset, query):
+        from media_explorer.models import SearchTerm
+        model_name = queryset.model.__name__
+        for term in search_terms(query):
+            object_ids = SearchTerm.objects.filter(model_name=model_name, term__startswith=term).values("object_id")
+            queryset = queryset.filter(id__in=object_ids)
+        return queryset
+
+    def rank(self, queryset, query):
+        from media_explorer.models import SearchTerm
+        terms = search_terms(query)
+        if not terms:
+            return super(IndexSearchBackend, self).rank(queryset, query)
+
+        qn = connection.ops.quote_name
+        sql = "SELECT COALESCE(SUM(%s), 0) FROM %s WHERE %s = %%s AND %s = %s.%s AND (%s)" % (
+            qn("weight"), qn(SearchTerm._meta.db_table), qn("model_name"), qn("object_id"),
+            qn(queryset.model._meta.db_table), qn("id"), " OR ".join([qn("term") + " " + connection.operators["startswith"] % "%s"]*len(terms)))
+        params = [queryset.model.__name__]
+        for term in terms:
+            params.append(connection.ops.prep_for_like_query(term) + "%")
+        return queryset.extra(select={"search_rank":sql}, select_params=params).order_by("-search_rank","-id")
+
+    def index_terms(self, obj):
+        """
+        {term: weight} of an Element or a Gallery
+        """
+        terms = {}
+        for field, weight in SEARCH_FIELDS[indexed_model_name(obj)]:
+            for term in search_terms(getattr(obj, field)):
+                terms[term] = terms.get(term, 0) + weight
+        return terms
+
+    def update(self, obj):
+        from media_explorer.models import SearchTerm
+        model_name = indexed_model_name(obj)
+        terms = self.index_terms(obj)
+        indexed = dict(SearchTerm.objects.filter(model_name=model_name, object_id=obj.id).values_list("term","weight"))
+        if indexed == terms:
+            return
+
+        SearchTerm.objects.filter(model_name=model_name, object_id=obj.id).delete()
+        SearchTerm.objects.bulk_create([SearchTerm(model_name=model_name, object_id=obj.id, term=term, weight=weight)
+                                            for term, weight in terms.items()])
+
+    def remove(self, obj):
+        from media_explorer.models import SearchTerm
+        SearchTerm.objects.filter(model_name=indexed_model_name(obj), object_id=obj.id).delete()
+
+    def rebuild(self, model, chunk_size=1000):
+        from media_explorer.models import SearchTerm
+        model_name = model.__name__
+        if connection.vendor == "postgresql":
+            #The (model_name, term) index is not used by LIKE unless the collation is C
+            qn = connection.ops.quote_name
+            table = SearchTerm._meta.db_table
+            cursor = connection.cursor()
+            cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s, %s varchar_pattern_ops)" % (
+                qn(table + "_term_like"), qn(table), qn("model_name"), qn("term")))
+        SearchTerm.objects.filter(model_name=model_name).delete()
+        fields = [field for field, weight in SEARCH_FIELDS[model_name]]
+        last_id = 0
+        while True:
+            objs = list(model.objects.filter(id__gt=last_id).order_by("id").only("id", *fields)[:chunk_size])
+            if not objs:
+                break
+            last_id = objs[-1].id
+            SearchTerm.objects.bulk_create([SearchTerm(model_name=model_name, object_id=obj.id, term=term, weight=weight)
+                                                for obj in objs for term, weight in self.index_terms(obj).items()])
+
+class PostgresSearchBackend(BaseSearchBackend):
+    """
+    PostgreSQL full text search on a weighted tsvector of the searched fields.
+    The rebuild_search_index command creates the GIN expression index the queries use.
+    """
+
+    config = "simple"
+
+    def vector_sql(self, model):
+        qn = connection.ops.quote_name
+        labels = {3:"A", 1:"C"}
+        parts = ["setweight(to_tsvector('%s', COALESCE(%s.%s, '')), '%s')" % (self.config, qn(model._meta.db_table), qn(field), labels.get(weight, "D"))
+                    for field, weight in SEARCH_FIELDS[model.__name__]]
+        return "(" + " || ".join(parts) + ")"
+
+    def tsquery(self, query):
+        #Every term must match the start of a word
+        return " & ".join([term + ":*" for term in search_terms(query)])
+
+    def filter(self, queryset, query):
+        tsquery = self.tsquery(query)
+        if not tsquery:
+            return queryset
+        where = "%s @@ to_tsquery('%s', %%s)" % (self.vector_sql(queryset.model), self.config)
+        return queryset.extra(where=[where], params=[tsquery])
+
+    def rank(self, queryset, query):
+        tsquery = self.tsquery(query)
+        if not tsquery:
+            return super(PostgresSearchBackend, self).rank(queryset, query)
+        sql = "ts_rank(%s, to_tsquery('%s', %%s))" % (self.vector_sql(queryset.model), self.config)
+        return queryset.extra(select={"search_rank":sql}, select_params=[tsquery]).order_by("-search_rank","-id")
+
+    def rebuild(self, model):
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("CREATE INDEX IF NOT EXISTS %s ON %s USING GIN (%s)" % (
+            qn(table + "_search"), qn(table), self.vector_sql(model).replace(qn(table) + ".", "")))
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+def get_search_backend():
+    """
+    The search backend set by DME_SEARCH_BACKEND (a dotted path to a backend class) - one instance per process
+    """
+    path = getattr(settings,"DME_SEARCH_BACKEND",None) or "media_explorer.search.IndexSearchBackend"
+    with _backends_lock:
+        if path not in _backends:
+            _backends[path] = import_string(path)()
+        return _backends[path]
+
+#EOF
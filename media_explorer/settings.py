@@ -17,12 +17,32 @@ MEDIA_ROOT = os.path.join(PROJECT_ROOT, *MEDIA_URL.strip("/").split("/"))
 
 DME_RESIZE = True
 
+#Create the resized images in the process_renditions worker instead of during the upload request
+DME_RESIZE_ASYNC = True
+
+#Number of times a rendition job is tried before it is marked as failed
+DME_RENDITION_JOB_MAX_ATTEMPTS = 3
+
+#Seconds to wait before retrying a failed job (doubled after each attempt)
+DME_RENDITION_JOB_RETRY_DELAY = 60
+
+#Seconds after which a running job is considered abandoned and can be claimed again
+DME_RENDITION_JOB_TIMEOUT = 600
+
 DME_VIDEO_THUMBNAIL_DEFAULT_URL = "/static/img/default_video.gif"
 DME_GALLERY_THUMBNAIL_DEFAULT_URL = "/static/img/default_gallery.gif"
 
 #This will be appended to settings.MEDIA_URL
 DME_RESIZE_DIRECTORY = "resized"
 
+#Storage class the originals are read from and the resized images are written to
+#(None uses DEFAULT_FILE_STORAGE) - use a shared or object store storage when you run more than one web server
+#e.g. "storages.backends.s3boto.S3BotoStorage" or "media_explorer.storage.InMemoryStorage" for tests
+DME_STORAGE = None
+
+#Resized images are encoded in memory up to this many bytes (then in a temporary file) before they are written to the storage
+DME_STORAGE_SPOOL_SIZE = 10*1024*1024
+
 DME_RESIZE_HORIZONTAL_ASPECT_RATIO = "8:5"
 DME_RESIZE_VERTICAL_ASPECT_RATIO = "320:414"
 
@@ -34,8 +54,151 @@ DME_RESIZE_WIDTHS = {
     "thumbnail": 200,
 }
 
+#Create all the sizes during the upload - set to False to only create
+#orig_c and the thumbnail and let the other sizes be created the first time they are requested
+DME_RESIZE_EAGER = True
+
+#Cache-Control max-age (seconds) of the renditions served by the rendition URL
+DME_RENDITION_MAX_AGE = 60*60*24*30
+
+#Seconds a request waits for another request that is creating the same rendition
+DME_SINGLE_FLIGHT_TIMEOUT = 60
+
+#Extra formats created for each size class ("orig_c", "horizontal", "vertical",
+#"non_cropped", "retina_2x") - "default" is used for the size classes not listed
+#e.g. {"default": ["webp"]} or {"default": ["avif", "webp"], "orig_c": []}
+#NOTE: AVIF needs Pillow 11.2+ or the pillow-avif-plugin package
+DME_RESIZE_FORMATS = {}
+
+#Order in which extra formats are picked when the browser accepts them
+DME_RESIZE_FORMAT_PREFERENCE = ["avif", "webp"]
+
+#Encoding options of the resized images for each size class ("orig_c", "horizontal", "vertical",
+#"non_cropped", "retina_2x", "thumbnail") - "default" is used for the options a size class does not set
+#quality: 1-100 (JPEG, WebP, AVIF)
+#progressive, subsampling ("4:4:4", "4:2:2", "4:2:0"): JPEG only
+#optimize: extra encoder pass for a smaller file (JPEG, PNG, GIF, WebP)
+#strip_metadata: remove EXIF and comments (the colour profile is kept)
+#max_bytes / min_psnr: search the quality (down to min_quality) so the file fits in max_bytes
+#and/or looks at least min_psnr dB close to the resized image - each search step encodes the image again
+DME_RESIZE_PROFILES = {
+    "default": {"quality": 85, "progressive": True, "subsampling": "4:2:0", "optimize": True, "strip_metadata": True},
+    "orig_c": {"quality": 90},
+    "retina_2x": {"quality": 75},
+    "thumbnail": {"quality": 80},
+}
+
+#Images with more pixels are refused (uploads, MediaImageField) - None for no limit
+DME_MAX_IMAGE_PIXELS = 100*1000*1000
+
+#Largest decoded bitmap (bytes) held in memory when resizing - None for no limit
+#Larger JPEG originals are decoded at a reduced scale (the sizes that do not fit are not created)
+#other formats that do not fit are refused
+DME_MAX_DECODE_MEMORY = 256*1024*1024
+
+#Decode large JPEG originals at a reduced scale (DCT scaling) when the renditions allow it
+DME_RESIZE_DRAFT = True
+
+#Largest width of the "orig_c" rendition - None for the largest configured size of the image orientation, 0 keeps the full resolution crop
+#NOTE: a full resolution orig_c needs a full resolution decode
+DME_RESIZE_ORIG_C_MAX_WIDTH = None
+
+#Pillow 7.0+ resamples large reductions in two steps (see Image.resize reducing_gap)
+DME_RESIZE_REDUCING_GAP = 3.0
+
+#Each rendition is resampled from the nearest larger image already in memory
+#but never reduced by more than this factor in a single step
+DME_RESIZE_CASCADE_MAX_FACTOR = 2
+
+#Number of rendition chains (orig_c, horizontal, vertical, retina_2x and non_cropped) created at the same time (1 creates them one after another)
+DME_RESIZE_POOL_SIZE = 1
+
+#Use a "thread" or a "process" pool when DME_RESIZE_POOL_SIZE > 1
+DME_RESIZE_POOL = "thread"
+
+#What to do when an uploaded image has the same content as an image we already have
+#None: always create a new element with its own files
+#"share": create a new element that shares the original and resized files of the existing one
+#"reuse": do not create anything - return the existing element
+DME_DEDUPE = None
+
+#Compute a perceptual hash of the uploaded images for the near-duplicate search (api/media/elements/similar)
+DME_PHASH = True
+
+#Default largest number of different hash bits (out of 64) for two images to be similar
+DME_PHASH_DISTANCE = 6
+
+#Delete the files of deleted elements and resized images in background threads (after the commit)
+DME_DELETE_ASYNC = True
+
+#Number of background threads deleting files
+DME_DELETE_WORKERS = 2
+
+#Largest number of files a thread deletes at once (storage.delete_many is used when the storage has it)
+DME_DELETE_BATCH_SIZE = 100
+
+#Number of times a failed delete is tried again and the delay (seconds) before the first retry (doubled after each one)
+DME_DELETE_RETRIES = 3
+DME_DELETE_RETRY_DELAY = 5
+
+#Seconds a process waits at exit for the files still being deleted
+DME_DELETE_EXIT_TIMEOUT = 60
+
+#Dotted path of a function that returns the micawber ProviderRegistry used for the video oEmbed lookups
+#(None uses micawber.bootstrap_basic - "media_explorer.oembed.stub_providers" answers without network requests)
+DME_OEMBED_PROVIDERS = None
+
+#Seconds an oEmbed response is used before it is fetched again (in the background) and seconds a failed lookup is cached
+DME_OEMBED_CACHE_TTL = 60*60*24
+DME_OEMBED_NEGATIVE_TTL = 60*10
+
+#Look the video URLs up in a background thread once the element is saved (the embed code is filled in when the response arrives)
+#False looks a new URL up during the save - for tests and development
+DME_OEMBED_ASYNC = True
+
+#Seconds an oEmbed request waits for a provider
+DME_OEMBED_TIMEOUT = 3
+
+#Show videos as their thumbnail and a play button - the embed code (iframe) is only loaded on click
+DME_VIDEO_FACADE = True
+
+#Store a low quality placeholder (a tiny JPEG data URI) and the dominant color of the uploaded images
+DME_PLACEHOLDER = True
+
+#Width in pixels of the placeholder image
+DME_PLACEHOLDER_WIDTH = 20
+
+#JPEG quality of the placeholder image
+DME_PLACEHOLDER_QUALITY = 70
+
+#Chunked uploads (api/media/uploads): chunks are kept in this storage directory until the upload is finished
+#It must not be shared with other files (e.g. CKEDITOR_UPLOAD_PATH): clean_uploads deletes the chunks left in it
+DME_UPLOAD_DIRECTORY = "dme_uploads"
+
+#Largest chunk accepted (bytes)
+DME_UPLOAD_CHUNK_SIZE = 5*1024*1024
+
+#Largest file accepted (bytes) - None for no limit
+DME_UPLOAD_MAX_SIZE = None
+
+#Seconds after which an unfinished upload is deleted by the clean_uploads command
+DME_UPLOAD_EXPIRY = 60*60*24
+
 DME_PAGE_SIZE = 50
 
+#Search backend of the explorer filter (dotted path): media_explorer.search.IndexSearchBackend (SearchTerm table),
+#media_explorer.search.PostgresSearchBackend (full text search) or media_explorer.search.LikeSearchBackend (no index)
+DME_SEARCH_BACKEND = "media_explorer.search.IndexSearchBackend"
+
+#Seconds the number of filtered elements or galleries is cached for the explorer stats
+DME_COUNT_CACHE_TTL = 30
+
+#Rows each element and gallery counter is split into - concurrent uploads update different rows
+DME_COUNT_SHARDS = 8
+
+#Use the PostgreSQL planner estimate instead of COUNT(*) for filtered counts above this many rows - None to always count
+DME_COUNT_APPROXIMATE_THRESHOLD = None
+
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
     # or allow read-only access for unauthenticated users.
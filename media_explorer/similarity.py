@@ -0,0 +1,215 @@
+import math, threading
+from datetime import timedelta
+from django.utils import timezone
+
+try:
+	from PIL import Image
+except ImportError:
+	import Image
+
+#NumPy is optional - the hash is the same without it, only slower
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+#The hash is made from the lowest HASH_SIZE x HASH_SIZE frequencies of a DCT_SIZE x DCT_SIZE grayscale image
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+def _dct_matrix(n):
+    """
+    Orthonormal DCT-II matrix (rows are frequencies)
+    """
+    rows = []
+    for k in range(n):
+        scale = math.sqrt(1.0/n) if k == 0 else math.sqrt(2.0/n)
+        rows.append([scale*math.cos(math.pi*(2*i + 1)*k/(2.0*n)) for i in range(n)])
+    return rows
+
+_DCT = _dct_matrix(DCT_SIZE)[:HASH_SIZE]
+_DCT_ARRAY = numpy.array(_DCT) if numpy is not None else None
+
+def _low_frequencies(pixels):
+    """
+    The HASH_SIZE x HASH_SIZE lowest frequencies of the 2D DCT of a DCT_SIZE x DCT_SIZE image
+    """
+    if numpy is not None:
+        matrix = numpy.asarray(pixels, dtype=numpy.float64).reshape(DCT_SIZE, DCT_SIZE)
+        return _DCT_ARRAY.dot(matrix).dot(_DCT_ARRAY.T).flatten().tolist()
+
+    rows = [pixels[i*DCT_SIZE:(i + 1)*DCT_SIZE] for i in range(DCT_SIZE)]
+    #DCT of the columns then of the rows
+    partial = [[sum(d[y]*rows[y][x] for y in range(DCT_SIZE)) for x in range(DCT_SIZE)] for d in _DCT]
+    return [sum(d[x]*row[x] for x in range(DCT_SIZE)) for row in partial for d in _DCT]
+
+def image_phash(image):
+    """
+    64 bit perceptual hash (DCT hash) of a PIL image as 16 hex characters
+    Similar images (re-encoded, resized, slightly cropped or retouched) have hashes
+    that differ in a few bits (see hamming_distance)
+    """
+    if image.format == "JPEG":
+        #Decode at the smallest DCT scale - the hash only needs 32x32 pixels
+        image.draft("L", (DCT_SIZE, DCT_SIZE))
+    image = image.convert("L").resize((DCT_SIZE, DCT_SIZE), Image.ANTIALIAS)
+
+    frequencies = _low_frequencies(list(image.getdata()))
+    #The DC term (average brightness) is left out of the median
+    median = sorted(frequencies[1:])[len(frequencies[1:])//2]
+
+    value = 0
+    for frequency in frequencies:
+        value = (value << 1) | (1 if frequency > median else 0)
+    return "%016x" % value
+
+def hamming_distance(a, b):
+    """
+    Number of different bits between two hex hashes
+    """
+    return bin(int(a, 16) ^ int(b, 16)).count("1")
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of 64 bit integers (Hamming distance)
+    A search for the values within distance k only visits the children whose distance
+    to the node is within k of the distance of the searched value - a small part of the tree for a small k.
+    """
+
+    def __init__(self):
+        #[value, ids, {distance: child}]
+        self.root = None
+        self.size = 0
+
+    def add(self, value, id):
+        self.size += 1
+        if self.root is None:
+            self.root = [value, set([id]), {}]
+            return
+
+        node = self.root
+        while True:
+            distance = bin(node[0] ^ value).count("1")
+            if distance == 0:
+                node[1].add(id)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, set([id]), {}]
+                return
+            node = child
+
+    def remove(self, value, id):
+        """
+        Remove id from the node of value - the node stays in the tree (other values are reached through it)
+        """
+        node = self.root
+        while node is not None:
+            distance = bin(node[0] ^ value).count("1")
+            if distance == 0:
+                if id in node[1]:
+                    node[1].discard(id)
+                    self.size -= 1
+                return
+            node = node[2].get(distance)
+
+    def search(self, value, max_distance):
+        """
+        List of (id, distance) within max_distance of value
+        """
+        rtn = []
+        if self.root is None:
+            return rtn
+
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = bin(node[0] ^ value).count("1")
+            if distance <= max_distance:
+                rtn.extend([(id, distance) for id in node[1]])
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    nodes.append(child)
+        return rtn
+
+class SimilarityIndex(object):
+    """
+    In-process BK-tree of the Element perceptual hashes.
+    Elements saved since the last search (in any process) are updated before each search: their old
+    hash is removed and the new one added. The matches are checked against the database, so changed
+    and deleted elements are never returned - the deleted ones found that way are removed from the tree.
+    The tree is built again once more than half of its entries have been removed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.tree = BKTree()
+        #{id: hash} of the elements in the tree
+        self.hashes = {}
+        self.removed = 0
+        self.synced_at = None
+
+    def sync(self):
+        from media_explorer.models import Element
+        now = timezone.now()
+        if self.synced_at:
+            #With a margin for the transactions that were not committed yet
+            rows = Element.objects.filter(updated_at__gte=self.synced_at - timedelta(seconds=60))
+        else:
+            rows = Element.objects.filter(type="image").exclude(phash="").exclude(phash__isnull=True)
+        for id, type, phash in rows.values_list("id","type","phash").iterator():
+            value = int(phash, 16) if type == "image" and phash else None
+            if self.hashes.get(id) != value:
+                self.discard(id)
+                if value is not None:
+                    self.tree.add(value, id)
+                    self.hashes[id] = value
+        self.synced_at = now
+
+    def discard(self, id):
+        if id not in self.hashes:
+            return
+        self.tree.remove(self.hashes.pop(id), id)
+        self.removed += 1
+        if self.removed > len(self.hashes):
+            self.tree = BKTree()
+            for element_id, value in self.hashes.items():
+                self.tree.add(value, element_id)
+            self.removed = 0
+
+    def search(self, phash, max_distance):
+        """
+        List of (element, distance) within max_distance of phash, closest first
+        """
+        from media_explorer.models import Element
+        with self.lock:
+            self.sync()
+            matches = self.tree.search(int(phash, 16), max_distance)
+
+        rtn = []
+        elements = list(Element.objects.filter(id__in=[id for id, distance in matches]))
+        for element in elements:
+            if element.phash:
+                distance = hamming_distance(element.phash, phash)
+                if distance <= max_distance:
+                    rtn.append((element, distance))
+        rtn.sort(key=lambda match: (match[1], match[0].id))
+
+        #The elements that were deleted
+        found = set([element.id for element in elements])
+        with self.lock:
+            for id, distance in matches:
+                if id not in found:
+                    self.discard(id)
+        return rtn
+
+    def reset(self):
+        with self.lock:
+            self.tree = BKTree()
+            self.hashes = {}
+            self.removed = 0
+            self.synced_at = None
+
+similarity_index = SimilarityIndex()
+
+#EOF
@@ -0,0 +1,72 @@
+/* video_facade.js - replace a click-to-load video (media_explorer/video_facade.html) with its embed code */
+
+(function(){
+    "use strict";
+
+    if ( window.dmeVideoFacade )
+    {
+        return;
+    }
+    window.dmeVideoFacade = true;
+
+    function autoplay(iframe)
+    {
+        var src = iframe.getAttribute("src");
+        if ( src && src.indexOf("autoplay=") == -1 )
+        {
+            iframe.setAttribute("src", src + (src.indexOf("?") == -1 ? "?" : "&") + "autoplay=1");
+        }
+    }
+
+    function play(facade)
+    {
+        var template = facade.querySelector(".dme-video-facade-embed");
+        if ( !template )
+        {
+            return;
+        }
+
+        var embed = document.createElement("div");
+        embed.innerHTML = template.innerHTML;
+        //Scripts added with innerHTML do not run - add them again
+        var scripts = embed.querySelectorAll("script");
+        for ( var i = 0; i < scripts.length; i++ )
+        {
+            var script = document.createElement("script");
+            if ( scripts[i].src )
+            {
+                script.src = scripts[i].src;
+            }
+            script.text = scripts[i].text;
+            scripts[i].parentNode.replaceChild(script, scripts[i]);
+        }
+
+        var iframes = embed.querySelectorAll("iframe");
+        for ( var j = 0; j < iframes.length; j++ )
+        {
+            autoplay(iframes[j]);
+        }
+
+        facade.className = facade.className.replace("dme-video-facade", "dme-video-facade-loaded");
+        facade.innerHTML = "";
+        while ( embed.firstChild )
+        {
+            facade.appendChild(embed.firstChild);
+        }
+    }
+
+    //One listener for the page - works for the slides slick clones too
+    document.addEventListener("click", function(event){
+        var target = event.target;
+        while ( target && target !== document )
+        {
+            if ( target.className && (" " + target.className + " ").indexOf(" dme-video-facade-play ") != -1 )
+            {
+                event.preventDefault();
+                play(target.parentNode);
+                return;
+            }
+            target = target.parentNode;
+        }
+    });
+})();
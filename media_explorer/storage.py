@@ -0,0 +1,125 @@
+import posixpath, threading
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import Storage, default_storage, get_storage_class
+from django.utils import timezone
+from django.utils.encoding import filepath_to_uri
+from django.utils.six.moves.urllib.parse import urljoin, unquote
+
+_storages = {}
+_storages_lock = threading.Lock()
+
+def get_storage():
+    """
+    The storage the originals are read from and the resized images are written to.
+    settings.DME_STORAGE is the dotted path of a Django storage class
+    (None uses the DEFAULT_FILE_STORAGE, the same storage as Element.image)
+    """
+    path = getattr(settings,"DME_STORAGE",None)
+    if not path:
+        return default_storage
+
+    with _storages_lock:
+        if path not in _storages:
+            _storages[path] = get_storage_class(path)()
+        return _storages[path]
+
+def storage_name(url, storage=None):
+    """
+    The storage name of a file from its URL (e.g. ResizedImage.image_url)
+    """
+    storage = storage or get_storage()
+    #URLs saved before DME_STORAGE was used are /MEDIA_URL/...
+    for prefix in [storage.url(""), settings.MEDIA_URL, "/" + settings.MEDIA_URL.strip("/") + "/"]:
+        if prefix and url.startswith(prefix):
+            return unquote(url[len(prefix):])
+    return unquote(url.lstrip("/"))
+
+def exists_many(names, storage=None):
+    """
+    The set of names that exist in the storage.
+    Names in the same directory are checked with a single listdir
+    (or with storage.exists_many when the storage has it)
+    """
+    storage = storage or get_storage()
+    names = set(names)
+    if hasattr(storage, "exists_many"):
+        return storage.exists_many(names)
+
+    directories = {}
+    for name in names:
+        directories.setdefault(posixpath.dirname(name), []).append(name)
+
+    rtn = set()
+    for directory, directory_names in directories.items():
+        if len(directory_names) > 1:
+            try:
+                files = set(storage.listdir(directory)[1])
+                rtn.update([name for name in directory_names if posixpath.basename(name) in files])
+                continue
+            except (NotImplementedError, OSError):
+                pass
+        rtn.update([name for name in directory_names if storage.exists(name)])
+    return rtn
+
+class InMemoryStorage(Storage):
+    """
+    Storage that keeps the files in memory - for tests and development only
+    e.g. DEFAULT_FILE_STORAGE = "media_explorer.storage.InMemoryStorage"
+    """
+
+    def __init__(self, base_url=None):
+        self.base_url = base_url if base_url is not None else settings.MEDIA_URL
+        self.files = {}
+        self.modified = {}
+        self.lock = threading.Lock()
+
+    def _open(self, name, mode="rb"):
+        with self.lock:
+            if name not in self.files:
+                raise IOError("No such file: %s" % name)
+            return ContentFile(self.files[name], name=name)
+
+    def _save(self, name, content):
+        data = b"".join(content.chunks())
+        with self.lock:
+            self.files[name] = data
+            self.modified[name] = timezone.now()
+        return name
+
+    def delete(self, name):
+        with self.lock:
+            self.files.pop(name, None)
+            self.modified.pop(name, None)
+
+    def exists(self, name):
+        return name in self.files
+
+    def exists_many(self, names):
+        return set([name for name in names if name in self.files])
+
+    def listdir(self, path):
+        path = path.strip("/")
+        prefix = path + "/" if path else ""
+        directories = set()
+        files = []
+        for name in list(self.files):
+            if not name.startswith(prefix):
+                continue
+            rest = name[len(prefix):]
+            if "/" in rest:
+                directories.add(rest.split("/")[0])
+            else:
+                files.append(rest)
+        return sorted(directories), sorted(files)
+
+    def size(self, name):
+        return len(self.files[name])
+
+    def modified_time(self, name):
+        return self.modified[name]
+
+    def url(self, name):
+        return urljoin(self.base_url, filepath_to_uri(name or ""))
+
+#EOF
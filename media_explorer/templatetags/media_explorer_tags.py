@@ -3,8 +3,12 @@ from django import template
 from django.template import Template, Context, RequestContext
 from django.db.models import Q
 from django.conf import settings
+from django.core.urlresolvers import reverse
 
 from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage
+from media_explorer.helpers import ImageHelper, pick_resized_image
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
 from django.template import Context
 from django.template.loader import get_template
 import traceback
@@ -27,7 +31,7 @@ def get_video(id):
     try:
         t = get_template("media_explorer/video.html")
         video = Element.objects.get(id=id,type="video")
-        c = Context({"video":video})
+        c = Context({"video":video,"facade":getattr(settings,"DME_VIDEO_FACADE",True)})
         return t.render(c)
     except:
         print traceback.format_exc()
@@ -39,7 +43,7 @@ def get_media_gallery(id,template="media_explorer/gallery_slick.html"):
         t = get_template(template)
         gallery = Gallery.objects.get(id=id)
         galleryelements = GalleryElement.objects.filter(gallery=gallery)
-        c = Context({"gallery":gallery,"galleryelements":galleryelements})
+        c = Context({"gallery":gallery,"galleryelements":galleryelements,"facade":getattr(settings,"DME_VIDEO_FACADE",True)})
         return t.render(c)
     except:
         print traceback.format_exc()
@@ -54,15 +58,33 @@ def has_size(element, comma_separated_sizes):
         for size in args:
             if ResizedImage.objects.filter(image=element,size=size).exists():
                 return True
+        if get_on_demand_url(element, args):
+            return True
     except:
         print traceback.format_exc()
 
     return False
 
+def get_on_demand_url(element, sizes):
+    """
+    Return the rendition URL of the first size that can be created on demand
+    (only when DME_RESIZE_EAGER is False)
+    """
+    if getattr(settings,"DME_RESIZE_EAGER",True):
+        return None
+
+    planned_sizes = ImageHelper().planned_sizes(element)
+    for size in sizes:
+        if size in planned_sizes:
+            return reverse("media-explorer-rendition", args=[element.id, size])
+    return None
+
 def get_image_url_from_size(id, *args):
     """
     The command may be {% get_image_url_from_size 123 "image|video|gallery" "800x500" "420x230" %}
     Or it could be  {% get_image_url_from_size 123 "800x500" "420x230" %}
+    The URL has the format of the original so the page does not depend on the browser -
+    put it in a <picture> after {% get_image_sources %} for the extra formats
     """
     try:
         if args[0] == "gallery":
@@ -79,16 +101,73 @@ def get_image_url_from_size(id, *args):
         element = Element.objects.get(id=id)
         try:
             if not ResizedImage.objects.filter(image=element,size__in=args).exists():
-                return element.image_url
+                return get_on_demand_url(element, args) or element.image_url
             for size in args:
-                if ResizedImage.objects.filter(image=element,size=size).exists():
-                    return ResizedImage.objects.get(image=element,size=size).image_url
+                ri = pick_resized_image(ResizedImage.objects.filter(image=element,size=size).order_by("id"))
+                if ri:
+                    return ri.image_url
         except:
             print traceback.format_exc()
         return element.image_url
     except:
         print traceback.format_exc()
 
+def get_rendition_url(id, *args):
+    """
+    The rendition view URL of the first size of an image that has it: {% get_rendition_url 123 "800x500" %}
+    The view picks the format from the Accept header (with Vary: Accept) - for the places a <picture> can not be used
+    """
+    try:
+        element = Element.objects.get(id=id,type="image")
+        planned_sizes = ImageHelper().planned_sizes(element)
+        existing_sizes = set(ResizedImage.objects.filter(image=element,size__in=args).values_list("size",flat=True))
+        for size in args:
+            if size in existing_sizes or size in planned_sizes:
+                return reverse("media-explorer-rendition", args=[element.id, size])
+    except:
+        print traceback.format_exc()
+
+    return get_image_url_from_size(id, *args)
+
+def get_image_sources(id, *args):
+    """
+    The <source> tags of the extra formats (webp, avif) of the first size found
+    Use it in a <picture> before the <img>: {% get_image_sources 123 "800x500" "420x230" %}
+    """
+    try:
+        for size in args:
+            resized_images = list(ResizedImage.objects.filter(image_id=id,size=size).order_by("id"))
+            if not resized_images:
+                continue
+
+            html = ""
+            for format in getattr(settings,"DME_RESIZE_FORMAT_PREFERENCE",["avif","webp"]):
+                for ri in resized_images[1:]:
+                    if ri.format == format:
+                        html += '<source type="image/%s" srcset="%s">' % (format, escape(ri.image_url))
+            return mark_safe(html)
+    except:
+        print traceback.format_exc()
+
+    return ""
+
+
+def placeholder_style(element):
+    """
+    Inline style that shows the placeholder of an image until it is loaded
+    e.g. <img src="..." style="{{ image|placeholder_style }}">
+    """
+    try:
+        style = ""
+        if element.dominant_color:
+            style += "background-color:%s;" % element.dominant_color
+        if element.placeholder:
+            style += "background-image:url(%s);background-size:cover;" % element.placeholder
+        return style
+    except:
+        print traceback.format_exc()
+
+    return ""
 
 def show_short_code(html):
     try:
@@ -124,7 +203,10 @@ def show_short_code(html):
 
 register.filter('show_short_code', show_short_code)
 register.filter('has_size', has_size)
+register.filter('placeholder_style', placeholder_style)
 register.simple_tag()(get_media_gallery)
 register.simple_tag()(get_video)
 register.simple_tag()(get_inline_image)
 register.simple_tag()(get_image_url_from_size)
+register.simple_tag()(get_rendition_url)
+register.simple_tag()(get_image_sources)
@@ -0,0 +1,136 @@
+from __future__ import unicode_literals
+import json
+from django.test import TestCase, Client, override_settings
+from django.core.urlresolvers import reverse
+from django.core.cache import cache
+from django.core.management import call_command
+from media_explorer.models import Element, Gallery, MediaCount
+from media_explorer.counts import read_counter
+
+@override_settings(DME_PAGE_SIZE=2, DME_OEMBED_PROVIDERS="media_explorer.oembed.stub_providers")
+class CountTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for i in range(3):
+            Element.objects.create(name="test_count_%s" % i, video_url="https://example.com/%s" % i)
+
+    def get(self, url, params):
+        c = Client()
+        response = c.get(reverse(url), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode("utf-8"))
+
+    def test_total_counters(self):
+        """
+        Test the element stats without a filter
+        Condition: Elements are created and deleted after the counter is made
+        Result: The counter follows and is read without counting the table
+        """
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 3)
+        Element.objects.create(name="test_count_new", video_url="https://example.com/new")
+        Element.objects.filter(name="test_count_0").delete()
+        Element.objects.filter(name="test_count_1").first().delete()
+
+        self.assertEqual(read_counter("Element:video"), 2)
+        with self.assertNumQueries(1):
+            data = self.get("api-stats-elements", {"type":"video"})
+        self.assertEqual(data["total_entries"], 2)
+        self.assertEqual(data["total_pages"], 1)
+        self.assertEqual(self.get("api-stats-elements", {})["total_entries"], 2)
+
+    def test_missing_counters(self):
+        """
+        Test the stats when the counters do not exist
+        Condition: The counters are deleted (they are made after migrate)
+        Result: The stats are counted without making the counters
+        Result: update_counts makes them again
+        """
+        MediaCount.objects.all().delete()
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 3)
+        self.assertFalse(MediaCount.objects.exists())
+
+        call_command("update_counts", stdout=open("/dev/null", "w"))
+        self.assertEqual(read_counter("Element:video"), 3)
+        self.assertEqual(read_counter("Gallery"), 0)
+
+    def test_type_change(self):
+        """
+        Test the per-type counters when an element changes type
+        Condition: A video URL is given to an element without one
+        Result: The element is moved from the image counter to the video counter
+        """
+        element = Element.objects.create(name="test_count_image", type="image")
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 3)
+        self.assertEqual(self.get("api-stats-elements", {"type":"image"})["total_entries"], 1)
+
+        element = Element.objects.get(id=element.id)
+        element.video_url = "https://example.com/image"
+        element.save()
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 4)
+        self.assertEqual(self.get("api-stats-elements", {"type":"image"})["total_entries"], 0)
+        self.assertEqual(self.get("api-stats-elements", {})["total_entries"], 4)
+
+    def test_filtered_count_cache(self):
+        """
+        Test the stats of a filter
+        Condition: The same filter is counted twice
+        Result: The second count comes from the cache
+        """
+        self.assertEqual(self.get("api-stats-elements", {"filter":"test_count_1"})["total_entries"], 1)
+        with self.assertNumQueries(0):
+            data = self.get("api-stats-elements", {"filter":"test_count_1"})
+        self.assertEqual(data["total_entries"], 1)
+
+    def test_list_with_counts(self):
+        """
+        Test counts=1 on the lists
+        Condition: A page of elements and a page of galleries are requested with counts=1
+        Result: The page comes with the same numbers as the stats
+        """
+        data = self.get("api-media-elements", {"counts":1, "page":1})
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["total_entries"], 3)
+        self.assertEqual(data["total_pages"], 2)
+
+        data = self.get("api-media-elements", {"counts":1, "cursor":""})
+        self.assertEqual(len(data["results"]), 2)
+        self.assertEqual(data["total_entries"], 3)
+
+        Gallery.objects.create(name="test_count")
+        data = self.get("api-media-galleries", {"counts":1})
+        self.assertEqual(data["total_entries"], self.get("api-stats-galleries", {})["total_entries"])
+        self.assertEqual(len(data["results"]), 1)
+
+    def test_update_counts(self):
+        """
+        Test the update_counts command
+        Condition: An element changes type with queryset.update() (no signal)
+        Result: The counters are counted again
+        """
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 3)
+        Element.objects.filter(name="test_count_0").update(type="image")
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 3)
+        call_command("update_counts", stdout=open("/dev/null", "w"))
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 2)
+        self.assertEqual(read_counter("Element:image"), 1)
+        self.assertEqual(read_counter("Element"), 3)
+
+    @override_settings(DME_COUNT_SHARDS=4)
+    def test_sharded_counters(self):
+        """
+        Test the counter shards
+        Condition: The counters are made with 4 shards, then DME_COUNT_SHARDS is raised to 16
+        Result: The increments are spread over the shards and none is lost
+        """
+        MediaCount.objects.all().delete()
+        call_command("update_counts", stdout=open("/dev/null", "w"))
+        self.assertEqual(MediaCount.objects.filter(key="Element:video").count(), 4)
+        for i in range(20):
+            Element.objects.create(name="test_count_shard_%s" % i, video_url="https://example.com/shard/%s" % i)
+        self.assertTrue(MediaCount.objects.filter(key="Element:video").exclude(count=0).count() > 1)
+
+        with self.settings(DME_COUNT_SHARDS=16):
+            for i in range(10):
+                Element.objects.create(name="test_count_more_shards_%s" % i, video_url="https://example.com/more/%s" % i)
+        self.assertEqual(self.get("api-stats-elements", {"type":"video"})["total_entries"], 33)
@@ -0,0 +1,111 @@
+from __future__ import unicode_literals
+import os, json
+from django.test import TestCase, TransactionTestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.storage import default_storage
+from media_explorer.models import Element, ResizedImage
+from media_explorer.storage import storage_name
+from media_explorer.deletions import file_deleter
+
+@override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_DELETE_ASYNC=False)
+class DedupeTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def upload_image(self, name):
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            response = c.post(reverse("api-media-elements"), {'name':name,'image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return Element.objects.get(id=json.loads(response.content.decode("utf-8"))["id"])
+
+    def test_upload_stores_content_hash(self):
+        """
+        Test image upload records the content hash
+        Condition: DME_DEDUPE is not set
+        Result: Each upload gets its own file with the same content_hash
+        """
+        first = self.upload_image("test_hash_1")
+        second = self.upload_image("test_hash_2")
+        self.assertEqual(len(first.content_hash), 64)
+        self.assertEqual(first.content_hash, second.content_hash)
+        self.assertNotEqual(first.image.name, second.image.name)
+
+    @override_settings(DME_DEDUPE="share")
+    def test_duplicate_shares_files(self):
+        """
+        Test uploading the same image twice
+        Condition: DME_DEDUPE is "share"
+        Result: A new element that points to the same original and resized files
+        Result: Deleting one element keeps the files of the other
+        """
+        first = self.upload_image("test_share_1")
+        second = self.upload_image("test_share_2")
+
+        self.assertNotEqual(first.id, second.id)
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(first.thumbnail_image_url, second.thumbnail_image_url)
+        first_urls = list(ResizedImage.objects.filter(image=first).order_by("id").values_list("size","image_url"))
+        second_urls = list(ResizedImage.objects.filter(image=second).order_by("id").values_list("size","image_url"))
+        self.assertTrue(len(first_urls) > 0)
+        self.assertEqual(first_urls, second_urls)
+
+        first.delete()
+        self.assertTrue(os.path.isfile(second.image.path))
+        for size, image_url in second_urls:
+            self.assertTrue(default_storage.exists(storage_name(image_url)))
+
+    @override_settings(DME_DEDUPE="reuse")
+    def test_duplicate_reuses_element(self):
+        """
+        Test uploading the same image twice
+        Condition: DME_DEDUPE is "reuse"
+        Result: The existing element is returned and no new element is created
+        """
+        first = self.upload_image("test_reuse_1")
+        second = self.upload_image("test_reuse_2")
+        self.assertEqual(first.id, second.id)
+        self.assertEqual(Element.objects.count(), 1)
+
+@override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_DELETE_ASYNC=False, DME_DEDUPE="reuse")
+class DedupeFieldTests(TransactionTestCase):
+
+    def test_media_image_field_reuses_file(self):
+        """
+        Test saving a model with a MediaImageField to an image we already have
+        Condition: DME_DEDUPE is "reuse" and the new file has the same content as an element
+        Result: The model points to the file of the element and the new copy is deleted
+        Result: No element is created
+        """
+        from django.core.files.base import ContentFile
+        from media_explorer.fields import MediaImageField
+        from media_explorer.helpers import file_content_hash
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg', "rb") as fp:
+            data = fp.read()
+        first = Element.objects.create(name="test_field_reuse", image=ContentFile(data, "test_field_reuse.jpg"))
+        Element.objects.filter(id=first.id).update(content_hash=file_content_hash(first.image))
+        self.assertEqual(Element.objects.get(id=first.id).status, "ready")
+
+        #A model that keeps its image in a MediaImageField (Element.image stands in for it here)
+        second = Element.objects.create(name="test_field_copy", type="video", video_url="https://example.com/copy")
+        new_name = default_storage.save("images/test_field_copy.jpg", ContentFile(data))
+        Element.objects.filter(id=second.id).update(image=new_name)
+        second.__dict__["image"] = new_name
+
+        field = MediaImageField(upload_to="images/")
+        field.set_attributes_from_name("image")
+        field.new_upload = True
+        field.on_post_save_callback(second)
+
+        self.assertEqual(Element.objects.get(id=second.id).image.name, first.image.name)
+        self.assertEqual(Element.objects.count(), 2)
+        self.assertTrue(file_deleter.wait(10))
+        self.assertFalse(default_storage.exists(new_name))
+        self.assertTrue(default_storage.exists(first.image.name))
@@ -0,0 +1,186 @@
+from __future__ import unicode_literals
+from django.test import TransactionTestCase, override_settings
+from django.db import transaction
+from django.core.files.base import ContentFile
+from media_explorer.models import Element, ResizedImage
+from unittest import skipIf, skipUnless
+from media_explorer.deletions import FileDeleter, commit_hooks
+from media_explorer.storage import InMemoryStorage
+
+class FlakyStorage(InMemoryStorage):
+    """
+    Storage whose first deletes fail
+    """
+
+    def __init__(self, failures):
+        super(FlakyStorage, self).__init__()
+        self.failures = failures
+
+    def delete(self, name):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("Storage unavailable")
+        super(FlakyStorage, self).delete(name)
+
+class BatchStorage(InMemoryStorage):
+    """
+    Storage that deletes many files at once
+    """
+
+    def __init__(self):
+        super(BatchStorage, self).__init__()
+        self.batches = []
+
+    def delete_many(self, names):
+        self.batches.append(list(names))
+        for name in names:
+            self.delete(name)
+
+class DeletionTests(TransactionTestCase):
+    #The files are deleted when the transaction commits
+
+    def save(self, storage, *names):
+        for name in names:
+            storage.save(name, ContentFile(b"data"))
+
+    @override_settings(DME_DELETE_ASYNC=False)
+    def test_referenced_files_are_kept(self):
+        """
+        Test deleting a file that is still used
+        Condition: Another ResizedImage row has the same URL
+        Result: Only the file nothing refers to is deleted
+        """
+        storage = InMemoryStorage()
+        self.save(storage, "resized/a.jpg", "resized/b.jpg")
+        element = Element.objects.create(name="test_deletions", image_url="/media/images/a.jpg")
+        ResizedImage.objects.create(image=element, size="800x500", image_url="/media/resized/a.jpg")
+
+        deleter = FileDeleter()
+        deleter.delete(storage, "resized/a.jpg", [("ResizedImage","image_url","/media/resized/a.jpg")])
+        deleter.delete(storage, "resized/b.jpg", [("ResizedImage","image_url","/media/resized/b.jpg")])
+        self.assertTrue(storage.exists("resized/a.jpg"))
+        self.assertFalse(storage.exists("resized/b.jpg"))
+
+    @override_settings(DME_DELETE_ASYNC=False, DME_DELETE_RETRIES=3)
+    def test_retries(self):
+        """
+        Test failed deletes
+        Condition: The storage fails 2 times then 4 times
+        Result: The first file is deleted on the third attempt, the second one is given up after 4 attempts
+        """
+        storage = FlakyStorage(2)
+        self.save(storage, "resized/a.jpg", "resized/b.jpg")
+
+        deleter = FileDeleter()
+        deleter.delete(storage, "resized/a.jpg")
+        self.assertFalse(storage.exists("resized/a.jpg"))
+
+        storage.failures = 4
+        deleter.delete(storage, "resized/b.jpg")
+        self.assertTrue(storage.exists("resized/b.jpg"))
+        self.assertEqual(storage.failures, 0)
+
+    @override_settings(DME_DELETE_ASYNC=True, DME_DELETE_WORKERS=1)
+    def test_background_batches(self):
+        """
+        Test background deletes
+        Condition: DME_DELETE_ASYNC is True and the storage has delete_many
+        Result: The files are deleted by the background thread with delete_many
+        """
+        storage = BatchStorage()
+        names = ["resized/%s.jpg" % i for i in range(20)]
+        self.save(storage, *names)
+
+        deleter = FileDeleter()
+        for name in names:
+            deleter.delete(storage, name)
+        deleter.wait()
+        self.assertEqual(storage.files, {})
+        self.assertEqual(sorted(sum(storage.batches, [])), sorted(names))
+
+    @skipUnless(commit_hooks(), "Needs transaction.on_commit or django-transaction-hooks")
+    @override_settings(DME_DELETE_ASYNC=False)
+    def test_rolled_back_deletes(self):
+        """
+        Test deletes in a transaction
+        Condition: One transaction is rolled back, a savepoint of another one is rolled back and the rest commits
+        Result: Only the files deleted in the committed part are deleted, after the commit
+        """
+        storage = InMemoryStorage()
+        self.save(storage, "resized/a.jpg", "resized/b.jpg", "resized/c.jpg")
+        deleter = FileDeleter()
+
+        try:
+            with transaction.atomic():
+                deleter.delete(storage, "resized/a.jpg")
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertTrue(storage.exists("resized/a.jpg"))
+
+        with transaction.atomic():
+            deleter.delete(storage, "resized/b.jpg")
+            try:
+                with transaction.atomic():
+                    deleter.delete(storage, "resized/c.jpg")
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertTrue(storage.exists("resized/b.jpg"))
+        self.assertFalse(storage.exists("resized/b.jpg"))
+        self.assertTrue(storage.exists("resized/c.jpg"))
+
+    @override_settings(DME_DELETE_ASYNC=True, DME_DELETE_WORKERS=1, DME_DELETE_RETRIES=3, DME_DELETE_RETRY_DELAY=0.05)
+    def test_wait_for_retries(self):
+        """
+        Test waiting for background deletes
+        Condition: The storage fails 2 times so the file is retried after a delay
+        Result: wait() returns once the retry deleted the file
+        """
+        storage = FlakyStorage(2)
+        self.save(storage, "resized/a.jpg")
+
+        deleter = FileDeleter()
+        deleter.delete(storage, "resized/a.jpg")
+        self.assertTrue(deleter.wait(10))
+        self.assertFalse(storage.exists("resized/a.jpg"))
+        self.assertEqual(deleter.timers, set())
+
+    @skipIf(commit_hooks(), "Only without commit hooks")
+    @override_settings(DME_DELETE_ASYNC=False)
+    def test_deletes_without_commit_hooks(self):
+        """
+        Test deletes in a transaction without transaction.on_commit or django-transaction-hooks
+        Condition: A file is deleted in a transaction
+        Result: The file is deleted right away and the connection is left as it is
+        """
+        from django.db import connection
+        storage = InMemoryStorage()
+        self.save(storage, "resized/a.jpg")
+        commit = connection.commit
+
+        with transaction.atomic():
+            FileDeleter().delete(storage, "resized/a.jpg")
+            self.assertFalse(storage.exists("resized/a.jpg"))
+        self.assertEqual(connection.commit, commit)
+
+    @override_settings(DME_DELETE_ASYNC=True)
+    def test_files_written_again_before_the_delete(self):
+        """
+        Test a file that is used again while it waits to be deleted
+        Condition: A new ResizedImage row refers to a queued file before the batch is deleted
+        Result: The file is kept
+        """
+        storage = InMemoryStorage()
+        self.save(storage, "resized/a.jpg", "resized/b.jpg")
+        deleter = FileDeleter()
+        #The batch is deleted here instead of in a background thread
+        deleter.start = lambda: None
+        deleter.delete(storage, "resized/a.jpg", [("ResizedImage","image_url","/media/resized/a.jpg")])
+        deleter.delete(storage, "resized/b.jpg", [("ResizedImage","image_url","/media/resized/b.jpg")])
+
+        element = Element.objects.create(name="test_deletions", image_url="/media/images/a.jpg")
+        ResizedImage.objects.create(image=element, size="800x500", image_url="/media/resized/a.jpg")
+        deleter.process([deleter.queue.get_nowait() for i in range(deleter.queue.qsize())])
+        self.assertTrue(storage.exists("resized/a.jpg"))
+        self.assertFalse(storage.exists("resized/b.jpg"))
@@ -1,8 +1,14 @@
 from __future__ import unicode_literals
-import os
+import os, re, json
 from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils.six import StringIO
+from unittest import skipUnless
+from PIL import ImageOps
 from media_explorer.models import Element, ResizedImage
 
 class ElementTests(TestCase):
@@ -77,6 +83,107 @@ class ElementTests(TestCase):
         count2 = ResizedImage.objects.filter(image__type="image",image__name="test_image_upload_with_no_resize",image__image_url__icontains="Oxfam-Cambodia").count()
         self.assertEqual(count2, 0)
 
+    @override_settings(DME_RESIZE=False)
+    def test_image_upload_dimensions_without_resize(self):
+        """
+        Test image dimensions with no resize
+        Condition: DME_RESIZE is False
+        Result: Element has the dimensions of the image (read from its header)
+        Result: backfill_dimensions fills the dimensions of elements that do not have them
+        """
+        url = reverse("api-media-elements")
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/Oxfam-Cambodia.jpg') as fp:
+            response = c.post(url, {'name':'test_image_upload_dimensions','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_image_upload_dimensions")
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+
+        #Legacy row
+        Element.objects.filter(id=element.id).update(image_width=0, image_height=0)
+        out = StringIO()
+        call_command("backfill_dimensions", stdout=out)
+        self.assertTrue("1 updated, 0 failed" in out.getvalue())
+
+        element = Element.objects.get(id=element.id)
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+
+    def test_probe_image_orientation(self):
+        """
+        Test the image header probe
+        Condition: JPEG with EXIF orientation 6
+        Result: Format, dimensions and orientation are read
+        """
+        from io import BytesIO
+        from PIL import Image
+        from media_explorer.helpers import probe_image
+
+        image = Image.new("RGB", (300, 200))
+        buf = BytesIO()
+        if hasattr(Image, "Exif"):
+            exif = Image.Exif()
+            exif[0x0112] = 6
+            image.save(buf, "JPEG", exif=exif.tobytes())
+        else:
+            image.save(buf, "JPEG")
+        buf.seek(0)
+
+        probe = probe_image(buf)
+        self.assertTrue(probe["success"])
+        self.assertEqual((probe["format"], probe["width"], probe["height"]), ("jpeg", 300, 200))
+        if hasattr(Image, "Exif"):
+            self.assertEqual(probe["orientation"], 6)
+
+    @skipUnless(hasattr(ImageOps, "exif_transpose"), "Needs Pillow 6.0+ to write and apply the EXIF orientation")
+    @override_settings(DME_RESIZE=True)
+    def test_image_upload_with_orientation(self):
+        """
+        Test a JPEG turned by its EXIF orientation
+        Condition: A 1200x800 JPEG with orientation 6 is uploaded and the renditions are made
+        Condition: backfill_dimensions is run with --all
+        Result: The element is 800x1200 (as shown) both times
+        Result: The renditions are portrait images without the orientation tag
+        """
+        from io import BytesIO
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from media_explorer.helpers import exif_orientation
+        from media_explorer.storage import get_storage, storage_name
+
+        image = Image.new("RGB", (1200, 800))
+        exif = Image.Exif()
+        exif[0x0112] = 6
+        buf = BytesIO()
+        image.save(buf, "JPEG", exif=exif.tobytes())
+
+        c = Client()
+        c.login(username="admin",password="password")
+        upload = SimpleUploadedFile("test_orientation.jpg", buf.getvalue(), content_type="image/jpeg")
+        response = c.post(reverse("api-media-elements"), {'name':'test_image_upload_orientation','image':upload},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_image_upload_orientation")
+        self.assertEqual((element.image_width, element.image_height), (800, 1200))
+
+        call_command("process_renditions", once=True, stdout=StringIO())
+        element = Element.objects.get(id=element.id)
+        self.assertEqual((element.image_width, element.image_height), (800, 1200))
+        resized = ResizedImage.objects.get(image=element, size="orig_c")
+        self.assertTrue(resized.image_height > resized.image_width)
+        storage = get_storage()
+        rendition = Image.open(storage.open(storage_name(resized.image_url, storage)))
+        self.assertEqual(rendition.size, (resized.image_width, resized.image_height))
+        self.assertEqual(exif_orientation(rendition), 1)
+
+        Element.objects.filter(id=element.id).update(image_width=1200, image_height=800)
+        call_command("backfill_dimensions", all=True, stdout=StringIO())
+        element = Element.objects.get(id=element.id)
+        self.assertEqual((element.image_width, element.image_height), (800, 1200))
+
     @override_settings(DME_RESIZE=True)
     def test_image_upload_with_resize(self):
         """
@@ -84,6 +191,7 @@ class ElementTests(TestCase):
         Condition: User is logged in and authorized
         Condition: Post has an image
         Condition: Resize image
+        Condition: Rendition worker has processed the queue
         Result: Success
         Result: Element count should equal 1
         Result: ResizedImage count should be more than 0
@@ -97,6 +205,8 @@ class ElementTests(TestCase):
             response = c.post(url, {'name':'test_image_upload_with_resize','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
         self.assertEqual(response.status_code, 200)
 
+        call_command("process_renditions", once=True, stdout=StringIO())
+
         #Check the DB to make sure element is present
         count1 = Element.objects.filter(type="image",name="test_image_upload_with_resize",image_url__icontains="Oxfam-Cambodia").count()
         self.assertEqual(count1, 1)
@@ -105,6 +215,59 @@ class ElementTests(TestCase):
         count2 = ResizedImage.objects.filter(image__type="image",image__name="test_image_upload_with_resize",image__image_url__icontains="Oxfam-Cambodia").count()
         self.assertTrue(count2>0)
 
+    @override_settings(DME_RESIZE=True)
+    def test_image_upload_writes_element_once(self):
+        """
+        Test the number of element writes of an upload
+        Condition: Post has an image
+        Condition: Resize image in the rendition worker
+        Result: The element is written with a single INSERT and no UPDATE
+        Result: Dimensions, file name and thumbnail are set
+        """
+        url = reverse("api-media-elements")
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/Oxfam-Cambodia.jpg', 'rb') as fp:
+            with CaptureQueriesContext(connection) as queries:
+                response = c.post(url, {'name':'test_image_upload_writes_element_once','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        writes = [q["sql"] for q in queries.captured_queries if re.search(r'(INSERT INTO|UPDATE) "media_explorer_element"', q["sql"])]
+        self.assertEqual(len(writes), 1)
+        self.assertTrue("INSERT INTO" in writes[0])
+
+        element = Element.objects.get(name="test_image_upload_writes_element_once")
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+        self.assertEqual(element.file_name, os.path.basename(element.image_url))
+        self.assertEqual(element.thumbnail_image_url, element.image_url)
+        self.assertEqual(element.status, "processing")
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False)
+    def test_image_upload_thumbnail_is_kept(self):
+        """
+        Test the thumbnail of a resized image
+        Condition: Resize image in the request
+        Condition: The element is saved again
+        Result: The thumbnail is the resized thumbnail, not the original
+        """
+        url = reverse("api-media-elements")
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/Oxfam-Cambodia.jpg', 'rb') as fp:
+            response = c.post(url, {'name':'test_image_upload_thumbnail_is_kept','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_image_upload_thumbnail_is_kept")
+        self.assertTrue(".thumbnail." in element.thumbnail_image_url)
+        self.assertEqual(json.loads(response.content)["thumbnail_image_url"], element.thumbnail_image_url)
+
+        element.description = "Changed"
+        element.save()
+        self.assertTrue(".thumbnail." in Element.objects.get(id=element.id).thumbnail_image_url)
 
     def test_youtube_video_addition(self):
         """
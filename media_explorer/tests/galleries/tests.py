@@ -3,6 +3,8 @@ import os
 from django.test import TestCase, Client, override_settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
+from django.conf import settings
+from django.db.models import signals
 from media_explorer.models import Element, Gallery, GalleryElement
 
 class GalleryTests(TestCase):
@@ -123,3 +125,85 @@ class GalleryTests(TestCase):
 
 
 
+
+    def test_gallery_thumbnail_with_nested_saves(self):
+        """
+        Test the gallery thumbnail when a gallery is saved while another one is being saved
+        (what happens when two threads save galleries at the same time)
+        Condition: A pre_save receiver creates a gallery each time a gallery is saved
+        Result: Every gallery gets a thumbnail
+        Result: The first gallery gets the thumbnail of its first element
+        """
+        element = Element.objects.create(name="test_nested_saves", video_url="https://example.com/video", manual_embed_code=True, thumbnail_image_url="/media/thumbnail.jpg")
+        created = []
+
+        def create_gallery(sender, instance, **kwargs):
+            if instance.name == "test_nested_saves" and len(created) < 2:
+                created.append(Gallery.objects.create(name="test_nested_saves-%s" % len(created)))
+
+        signals.pre_save.connect(create_gallery, sender=Gallery)
+        try:
+            gallery = Gallery.objects.create(name="test_nested_saves")
+            GalleryElement.objects.create(gallery=gallery, element=element, sort_by=0)
+            gallery.save()
+        finally:
+            signals.pre_save.disconnect(create_gallery, sender=Gallery)
+
+        self.assertEqual(Gallery.objects.get(id=gallery.id).thumbnail_image_url, "/media/thumbnail.jpg")
+        for other in created:
+            self.assertEqual(Gallery.objects.get(id=other.id).thumbnail_image_url, settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL)
+
+    def test_gallery_cover(self):
+        """
+        Test the gallery cover
+        Condition: Elements are added, reordered and removed, and the cover element gets a new thumbnail
+        Result: The cover is always the first element and the thumbnail follows it
+        Result: An empty gallery gets the default thumbnail
+        """
+        first = Element.objects.create(name="test_cover_1", video_url="https://example.com/1", manual_embed_code=True, thumbnail_image_url="/media/1.jpg")
+        second = Element.objects.create(name="test_cover_2", video_url="https://example.com/2", manual_embed_code=True, thumbnail_image_url="/media/2.jpg")
+        gallery = Gallery.objects.create(name="test_cover")
+        self.assertEqual(gallery.thumbnail_image_url, settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL)
+
+        ge1 = GalleryElement.objects.create(gallery=gallery, element=first, sort_by=0)
+        ge2 = GalleryElement.objects.create(gallery=gallery, element=second, sort_by=1)
+        gallery = Gallery.objects.get(id=gallery.id)
+        self.assertEqual((gallery.cover_element, gallery.thumbnail_image_url), (first, "/media/1.jpg"))
+
+        #Reorder
+        ge1.sort_by = 2
+        ge1.save()
+        gallery = Gallery.objects.get(id=gallery.id)
+        self.assertEqual((gallery.cover_element, gallery.thumbnail_image_url), (second, "/media/2.jpg"))
+
+        #The thumbnail of the cover element changes
+        second.thumbnail_image_url = "/media/2-new.jpg"
+        second.save()
+        self.assertEqual(Gallery.objects.get(id=gallery.id).thumbnail_image_url, "/media/2-new.jpg")
+
+        #Saving the gallery keeps the cover
+        gallery.save()
+        self.assertEqual(Gallery.objects.get(id=gallery.id).thumbnail_image_url, "/media/2-new.jpg")
+
+        #Remove the cover element
+        second.delete()
+        gallery = Gallery.objects.get(id=gallery.id)
+        self.assertEqual((gallery.cover_element, gallery.thumbnail_image_url), (first, "/media/1.jpg"))
+
+        ge1.delete()
+        gallery = Gallery.objects.get(id=gallery.id)
+        self.assertEqual((gallery.cover_element, gallery.thumbnail_image_url), (None, settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL))
+
+    def test_gallery_with_explicit_pk(self):
+        """
+        Test saving a new gallery with its pk set (e.g. from fixtures)
+        Condition: Gallery(id=...) is saved, then saved again
+        Result: The gallery is created with the default thumbnail and then updated
+        """
+        gallery = Gallery(id=1000, name="test_explicit_pk")
+        gallery.save()
+        self.assertEqual(Gallery.objects.get(id=1000).thumbnail_image_url, settings.DME_GALLERY_THUMBNAIL_DEFAULT_URL)
+
+        gallery.name = "test_explicit_pk_renamed"
+        gallery.save()
+        self.assertEqual(Gallery.objects.get(id=1000).name, "test_explicit_pk_renamed")
@@ -0,0 +1,119 @@
+from __future__ import unicode_literals
+import micawber
+from django.conf import settings
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.core.cache import cache
+from media_explorer.models import Element
+from media_explorer.oembed import StubProvider, oembed_resolver
+
+class CountingProvider(StubProvider):
+    """
+    Stub provider that counts its requests
+    """
+    requests = []
+
+    def request(self, url, **extra_params):
+        CountingProvider.requests.append(url)
+        data = super(CountingProvider, self).request(url, **extra_params)
+        data["html"] += "<!-- %s -->" % len(CountingProvider.requests)
+        return data
+
+def counting_providers():
+    #Only example.com can be embedded
+    providers = micawber.ProviderRegistry()
+    providers.register(r"https?://example\.com/\S+", CountingProvider())
+    return providers
+
+@override_settings(DME_OEMBED_PROVIDERS="media_explorer.tests.oembed.tests.counting_providers", DME_OEMBED_ASYNC=False)
+class OEmbedTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        CountingProvider.requests = []
+
+    def test_lookups_are_cached(self):
+        """
+        Test the oEmbed lookups of video elements
+        Condition: A video is saved again, another element has the same URL, then the URL changes
+        Result: The providers are only asked for each new URL
+        """
+        video = Element.objects.create(name="test_oembed", video_url="https://example.com/1")
+        self.assertEqual(video.type, "video")
+        self.assertTrue(video.video_embed.startswith('<iframe src="https://example.com/1"'))
+        self.assertEqual(CountingProvider.requests, ["https://example.com/1"])
+
+        video = Element.objects.get(id=video.id)
+        video.description = "Changed"
+        video.save()
+        Element.objects.create(name="test_oembed_copy", video_url="https://example.com/1")
+        self.assertEqual(CountingProvider.requests, ["https://example.com/1"])
+
+        video.video_url = "https://example.com/2"
+        video.save()
+        self.assertEqual(CountingProvider.requests, ["https://example.com/1","https://example.com/2"])
+        self.assertTrue(video.video_embed.startswith('<iframe src="https://example.com/2"'))
+
+    def test_failed_lookups_are_cached(self):
+        """
+        Test the negative cache
+        Condition: A URL no provider can embed is looked up twice
+        Result: None is cached - the registry is only asked once
+        """
+        self.assertEqual(oembed_resolver.get("https://example.org/1"), None)
+        entry = cache.get(oembed_resolver.key("https://example.org/1"))
+        self.assertEqual(entry["data"], None)
+        self.assertEqual(oembed_resolver.get("https://example.org/1"), None)
+        self.assertEqual(cache.get(oembed_resolver.key("https://example.org/1")), entry)
+
+    def test_stale_lookups_are_refreshed(self):
+        """
+        Test the refresh of stale responses
+        Condition: The cached response of a URL is stale
+        Result: The stale response is returned and the elements with the URL get the new response
+        """
+        video = Element.objects.create(name="test_oembed_stale", video_url="https://example.com/1")
+        key = oembed_resolver.key("https://example.com/1")
+        entry = cache.get(key)
+        entry["expires_at"] = 0
+        cache.set(key, entry)
+
+        self.assertEqual(oembed_resolver.get("https://example.com/1")["html"], video.video_embed)
+        self.assertEqual(len(CountingProvider.requests), 2)
+        self.assertTrue(Element.objects.get(id=video.id).video_embed.endswith("<!-- 2 -->"))
+
+@override_settings(DME_OEMBED_PROVIDERS="media_explorer.tests.oembed.tests.counting_providers", DME_OEMBED_ASYNC=True)
+class OEmbedAsyncTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        CountingProvider.requests = []
+
+    def test_save_does_not_wait_for_lookup(self):
+        """
+        Test saving a video with a URL that was not looked up yet
+        Condition: DME_OEMBED_ASYNC is True
+        Result: The element is saved with the default thumbnail and no embed code
+        Result: The lookup is started once the transaction commits (right away without commit hooks) and fills in the embed code
+        """
+        from django.db import transaction
+        from media_explorer.oembed import update_video_elements
+        from media_explorer.deletions import commit_hooks
+
+        lookups = []
+        oembed_resolver.refresh = lookups.append
+        try:
+            with transaction.atomic():
+                video = Element.objects.create(name="test_oembed_async", video_url="https://example.com/async")
+                if commit_hooks():
+                    self.assertEqual(lookups, [])
+        finally:
+            del oembed_resolver.refresh
+        self.assertEqual(lookups, ["https://example.com/async"])
+        self.assertEqual(CountingProvider.requests, [])
+        self.assertEqual(video.video_embed, None)
+        self.assertEqual(video.thumbnail_image_url, settings.DME_VIDEO_THUMBNAIL_DEFAULT_URL)
+
+        #What the background lookup does
+        update_video_elements(lookups[0], oembed_resolver.fetch(lookups[0]))
+        video = Element.objects.get(id=video.id)
+        self.assertTrue(video.video_embed.startswith('<iframe src="https://example.com/async"'))
@@ -0,0 +1,103 @@
+from __future__ import unicode_literals
+import os
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+from django.utils.six import StringIO
+from media_explorer.models import Element, ResizedImage
+from media_explorer.orphans import external_sort
+from media_explorer.storage import storage_name
+
+@override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DEFAULT_FILE_STORAGE="media_explorer.storage.InMemoryStorage")
+class OrphanTests(TestCase):
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def test_external_sort(self):
+        """
+        Test the external sort
+        Condition: More lines than fit in a run, with duplicates
+        Result: The unique lines in order
+        """
+        lines = ["images/%s.jpg" % (i*7 % 25) for i in range(50)] + ["resized/\u00e9t\u00e9.jpg"]
+        self.assertEqual(list(external_sort(iter(lines), run_size=4)), sorted(set(lines)))
+        self.assertEqual(list(external_sort(iter([]))), [])
+
+    def test_clean_files(self):
+        """
+        Test the orphaned file collector
+        Condition: An orphan in each directory and a resized image file that was deleted
+        Result: --dry-run only reports them
+        Result: The orphans and the ResizedImage row of the missing file are deleted, the other files are kept
+        """
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg', 'rb') as fp:
+            response = c.post(reverse("api-media-elements"), {'name':'test_orphans','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        element = Element.objects.get(name="test_orphans")
+
+        default_storage.save("images/orphan.jpg", ContentFile(b"orphan"))
+        default_storage.save("resized/orphan_800x500.jpg", ContentFile(b"orphan"))
+        missing = ResizedImage.objects.filter(image=element).order_by("id")[1]
+        default_storage.delete(storage_name(missing.image_url))
+        resized_count = ResizedImage.objects.filter(image=element).count()
+
+        out = StringIO()
+        call_command("clean_files", dry_run=True, stdout=out, stderr=StringIO())
+        self.assertTrue("images: 2 files, 1 orphans (0 deleted" in out.getvalue())
+        self.assertTrue("1 missing files (0 of elements)" in out.getvalue())
+        self.assertTrue(default_storage.exists("images/orphan.jpg"))
+        self.assertEqual(ResizedImage.objects.filter(image=element).count(), resized_count)
+
+        #Orphans younger than --min-age are kept
+        call_command("clean_files", stdout=StringIO(), stderr=StringIO())
+        self.assertTrue(default_storage.exists("resized/orphan_800x500.jpg"))
+
+        call_command("clean_files", min_age=0, stdout=StringIO(), stderr=StringIO())
+        self.assertFalse(default_storage.exists("images/orphan.jpg"))
+        self.assertFalse(default_storage.exists("resized/orphan_800x500.jpg"))
+        self.assertTrue(default_storage.exists(element.image.name))
+        self.assertFalse(ResizedImage.objects.filter(id=missing.id).exists())
+        for ri in ResizedImage.objects.filter(image=element):
+            self.assertTrue(default_storage.exists(storage_name(ri.image_url)))
+
+    def test_rendition_written_during_scan(self):
+        """
+        Test clean_files while renditions are written
+        Condition: Two renditions are written after the directory is listed and before the rows are read
+        Condition: One row is new, the other one is an old row whose file was written again
+        Result: Neither row is deleted as missing
+        """
+        from datetime import timedelta
+        from django.utils import timezone
+        from media_explorer import orphans
+
+        element = Element.objects.create(name="test_orphans_scan", type="image")
+        old = ResizedImage.objects.create(image=element, size="old", image_url=default_storage.url("resized/scan_old.jpg"))
+        ResizedImage.objects.filter(id=old.id).update(created_at=timezone.now() - timedelta(days=1))
+        rows = []
+
+        def storage_files(storage, directory):
+            for name in listed_files(storage, directory):
+                yield name
+            if directory.strip("/") == "resized":
+                default_storage.save("resized/scan_old.jpg", ContentFile(b"rendition"))
+                rows.append(ResizedImage.objects.create(image=element, size="new", image_url=default_storage.url("resized/scan_new.jpg")))
+                default_storage.save("resized/scan_new.jpg", ContentFile(b"rendition"))
+
+        listed_files = orphans.storage_files
+        orphans.storage_files = storage_files
+        try:
+            call_command("clean_files", min_age=0, stdout=StringIO(), stderr=StringIO())
+        finally:
+            orphans.storage_files = listed_files
+
+        self.assertTrue(ResizedImage.objects.filter(id=old.id).exists())
+        self.assertTrue(ResizedImage.objects.filter(id=rows[0].id).exists())
@@ -0,0 +1,143 @@
+from __future__ import unicode_literals
+import json
+from datetime import timedelta
+from django.test import TestCase, Client, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.urlresolvers import reverse
+from django.utils import timezone
+from media_explorer.models import Element, Gallery
+
+@override_settings(DME_PAGE_SIZE=3, DME_OEMBED_PROVIDERS="media_explorer.oembed.stub_providers")
+class CursorPaginationTests(TestCase):
+
+    def setUp(self):
+        #Some elements share created_at so the id tie-breaker is needed
+        now = timezone.now()
+        for i in range(8):
+            element = Element.objects.create(name="test_page_%s" % i, video_url="https://example.com/%s" % i, type="video")
+            Element.objects.filter(id=element.id).update(created_at=now - timedelta(minutes=i//2))
+        self.expected = list(Element.objects.order_by("-created_at","-id").values_list("id", flat=True))
+
+    def get_page(self, cursor="", **params):
+        params["cursor"] = cursor
+        c = Client()
+        response = c.get(reverse("api-media-elements"), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode("utf-8"))
+
+    def test_cursor_pages(self):
+        """
+        Test walking the element list with cursors
+        Condition: The next cursor is followed to the end and the previous cursor back
+        Result: Every element is listed once in created_at/id order
+        Result: The previous cursor returns the page before
+        """
+        pages = [self.get_page()]
+        self.assertEqual(pages[0]["previous"], None)
+        while pages[-1]["next"]:
+            pages.append(self.get_page(pages[-1]["next"]))
+
+        ids = [item["id"] for page in pages for item in page["results"]]
+        self.assertEqual(ids, self.expected)
+        self.assertEqual([len(page["results"]) for page in pages], [3, 3, 2])
+
+        previous = self.get_page(pages[2]["previous"])
+        self.assertEqual(previous["results"], pages[1]["results"])
+        first = self.get_page(previous["previous"])
+        self.assertEqual(first["results"], pages[0]["results"])
+        self.assertEqual(first["previous"], None)
+        self.assertEqual(first["next"], pages[0]["next"])
+
+    def test_cursor_pages_with_inserts(self):
+        """
+        Test the next page after new elements are added
+        Condition: Elements are created between two page requests
+        Result: The next page starts after the last element of the first page
+        """
+        first = self.get_page(sort="name", direction="asc")
+        Element.objects.create(name="test_page_0a", video_url="https://example.com/0a", type="video")
+        second = self.get_page(first["next"], sort="name", direction="asc")
+        self.assertEqual([item["name"] for item in first["results"]], ["test_page_0", "test_page_1", "test_page_2"])
+        self.assertEqual([item["name"] for item in second["results"]], ["test_page_3", "test_page_4", "test_page_5"])
+
+    def test_cursor_pages_are_index_seeks(self):
+        """
+        Test the queries of the default sort (created_at can be NULL)
+        Condition: The second page is requested
+        Result: The rows are ordered by the sort column and id only (no CASE the index can not serve)
+        """
+        cursor = self.get_page()["next"]
+        with CaptureQueriesContext(connection) as queries:
+            self.get_page(cursor)
+        selects = [query["sql"] for query in queries.captured_queries if "ORDER BY" in query["sql"]]
+        self.assertTrue(selects)
+        for sql in selects:
+            self.assertFalse("CASE" in sql.upper())
+
+    def test_invalid_cursor(self):
+        """
+        Test an invalid cursor
+        Condition: The cursor is not one we made or was made for another sort column
+        Result: Fail with 400 error
+        """
+        c = Client()
+        url = reverse("api-media-elements")
+        response = c.get(url, {"cursor":"garbage"}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
+        cursor = self.get_page()["next"]
+        response = c.get(url, {"cursor":cursor,"sort":"name"}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
+    def test_offset_pages(self):
+        """
+        Test the page parameter
+        Condition: No cursor parameter
+        Result: A list of elements like before
+        """
+        c = Client()
+        response = c.get(reverse("api-media-elements"), {"page":2}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual([item["id"] for item in data], self.expected[3:6])
+
+    def test_gallery_cursor_pages(self):
+        """
+        Test walking the gallery list with cursors
+        Condition: The next cursor is followed to the end
+        Result: Every gallery is listed once
+        """
+        for i in range(5):
+            Gallery.objects.create(name="test_page_%s" % i)
+        c = Client()
+        url = reverse("api-media-galleries")
+        ids = []
+        cursor = ""
+        while cursor is not None:
+            response = c.get(url, {"cursor":cursor}, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            data = json.loads(response.content.decode("utf-8"))
+            ids += [item["id"] for item in data["results"]]
+            cursor = data["next"]
+        self.assertEqual(ids, list(Gallery.objects.order_by("-created_at","-id").values_list("id", flat=True)))
+
+    def test_cursor_pages_with_null_sort_values(self):
+        """
+        Test walking the element list sorted by a column with NULL values
+        Condition: Some elements have no name and the list is sorted by name both ways
+        Result: Every element is listed once, the NULL names after the others (first when descending)
+        Result: The previous cursor of the last page returns the page before
+        """
+        for i in range(4):
+            element = Element.objects.create(name="test_page_null_%s" % i, video_url="https://example.com/null/%s" % i, type="video")
+            Element.objects.filter(id=element.id).update(name=None)
+        named = list(Element.objects.exclude(name=None).order_by("name","id").values_list("id", flat=True))
+        unnamed = list(Element.objects.filter(name=None).order_by("id").values_list("id", flat=True))
+
+        for direction, expected in (("asc", named + unnamed), ("desc", list(reversed(named + unnamed)))):
+            pages = [self.get_page(sort="name", direction=direction)]
+            while pages[-1]["next"]:
+                pages.append(self.get_page(pages[-1]["next"], sort="name", direction=direction))
+            self.assertEqual([item["id"] for page in pages for item in page["results"]], expected)
+
+            previous = self.get_page(pages[-1]["previous"], sort="name", direction=direction)
+            self.assertEqual(previous["results"], pages[-2]["results"])
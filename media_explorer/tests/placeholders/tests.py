@@ -0,0 +1,108 @@
+from __future__ import unicode_literals
+import os, json, base64, re
+from io import BytesIO
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.template import Template, Context
+from media_explorer.models import Element
+from media_explorer.placeholders import image_placeholder
+
+try:
+	from PIL import Image
+except ImportError:
+	import Image
+
+@override_settings(DME_RESIZE=False)
+class PlaceholderTests(TestCase):
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        self.image_path = test_path + '/../elements/Oxfam-Cambodia.jpg'
+
+    def upload(self, name, data, file_name="image.jpg"):
+        c = Client()
+        c.login(username="admin",password="password")
+        image = SimpleUploadedFile(file_name, data, content_type="image/jpeg")
+        response = c.post(reverse("api-media-elements"), {'name':name,'image':image},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return Element.objects.get(name=name)
+
+    def test_placeholder(self):
+        """
+        Test the placeholder of an uploaded image
+        Condition: Upload the test image
+        Result: The element has a 20 pixel wide JPEG data URI and a dominant color
+        Result: Both are returned by the API
+        """
+        with open(self.image_path, "rb") as fp:
+            element = self.upload("test_placeholder", fp.read(), "Oxfam-Cambodia.jpg")
+
+        prefix = "data:image/jpeg;base64,"
+        self.assertTrue(element.placeholder.startswith(prefix))
+        placeholder = Image.open(BytesIO(base64.b64decode(element.placeholder[len(prefix):])))
+        self.assertEqual(placeholder.size, (20, 12))
+        self.assertTrue(len(element.placeholder) < 2000)
+        self.assertTrue(re.match(r"^#[0-9a-f]{6}$", element.dominant_color))
+
+        c = Client()
+        c.login(username="admin",password="password")
+        data = json.loads(c.get(reverse("api-media-elements")).content)
+        self.assertEqual(data[0]["placeholder"], element.placeholder)
+        self.assertEqual(data[0]["dominant_color"], element.dominant_color)
+
+    def test_dominant_color(self):
+        """
+        Test the dominant color
+        Condition: A PNG that is mostly red with a transparent band
+        Result: The dominant color is red
+        Result: The placeholder_style filter shows the color and the image
+        """
+        image = Image.new("RGBA", (300, 200), (255, 0, 0, 255))
+        image.paste((0, 0, 255, 0), (0, 0, 300, 40))
+        buf = BytesIO()
+        image.save(buf, "PNG")
+        buf.seek(0)
+
+        rtn = image_placeholder(Image.open(buf))
+        self.assertEqual(rtn["dominant_color"], "#ff0000")
+
+        element = Element(placeholder=rtn["placeholder"], dominant_color=rtn["dominant_color"])
+        html = Template("{% load media_explorer_tags %}{{ element|placeholder_style }}").render(Context({"element":element}))
+        self.assertTrue("background-color:#ff0000;" in html)
+        self.assertTrue("background-image:url(%s)" % rtn["placeholder"] in html)
+
+    @override_settings(DME_PLACEHOLDER=False)
+    def test_placeholder_disabled(self):
+        """
+        Test DME_PLACEHOLDER
+        Condition: DME_PLACEHOLDER is False
+        Result: No placeholder is stored
+        """
+        with open(self.image_path, "rb") as fp:
+            element = self.upload("test_placeholder_disabled", fp.read(), "Oxfam-Cambodia.jpg")
+        self.assertEqual(element.placeholder, None)
+        self.assertEqual(element.dominant_color, None)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_placeholder_is_set_by_the_rendition_job(self):
+        """
+        Test the placeholder of an image resized in the background
+        Condition: The element is saved and its rendition job is run afterwards
+        Result: The placeholder is empty until the job has made the thumbnail, then it is made from it
+        """
+        from media_explorer.jobs import claim_job, process_job
+
+        with open(self.image_path, "rb") as fp:
+            element = self.upload("test_placeholder_job", fp.read(), "Oxfam-Cambodia.jpg")
+        self.assertEqual(element.placeholder, None)
+
+        process_job(claim_job("test-worker"))
+        element = Element.objects.get(id=element.id)
+        prefix = "data:image/jpeg;base64,"
+        placeholder = Image.open(BytesIO(base64.b64decode(element.placeholder[len(prefix):])))
+        self.assertEqual(placeholder.size, (20, 12))
+        self.assertTrue(re.match(r"^#[0-9a-f]{6}$", element.dominant_color))
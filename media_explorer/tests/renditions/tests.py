@@ -0,0 +1,596 @@
+from __future__ import unicode_literals
+import os
+from io import BytesIO
+from django.conf import settings
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.utils.six import StringIO
+from media_explorer.models import Element, ResizedImage, RenditionJob
+from media_explorer.jobs import claim_job, process_job
+from media_explorer.storage import storage_name
+
+class RenditionJobTests(TestCase):
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def upload_image(self, name):
+        url = reverse("api-media-elements")
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            response = c.post(url, {'name':name,'image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return Element.objects.get(name=name)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_upload_queues_rendition_job(self):
+        """
+        Test image upload queues a rendition job
+        Condition: Post has an image
+        Result: Element status is processing
+        Result: One pending RenditionJob and no ResizedImage yet
+        """
+        element = self.upload_image("test_upload_queues_rendition_job")
+        self.assertEqual(element.status, "processing")
+        self.assertEqual(RenditionJob.objects.filter(element=element,status="pending").count(), 1)
+        self.assertEqual(ResizedImage.objects.filter(image=element).count(), 0)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_worker_processes_job(self):
+        """
+        Test the process_renditions command
+        Condition: A rendition job is pending
+        Result: Job is done, element is ready and has resized images
+        """
+        element = self.upload_image("test_worker_processes_job")
+        call_command("process_renditions", once=True, stdout=StringIO())
+
+        element = Element.objects.get(id=element.id)
+        self.assertEqual(element.status, "ready")
+        self.assertTrue("resized" in element.thumbnail_image_url)
+        self.assertEqual(RenditionJob.objects.get(element=element).status, "done")
+        self.assertTrue(ResizedImage.objects.filter(image=element).count() > 0)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_job_can_only_be_claimed_once(self):
+        """
+        Test two workers claiming jobs
+        Condition: One job is pending
+        Result: Only the first worker gets the job
+        """
+        self.upload_image("test_job_can_only_be_claimed_once")
+        self.assertTrue(claim_job("worker-1") is not None)
+        self.assertTrue(claim_job("worker-2") is None)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_image_replaced_while_job_runs(self):
+        """
+        Test an image replaced while its rendition job is running
+        Condition: The job is claimed, then the element gets a new image
+        Result: A new job is queued and the element stays processing when the first job is done
+        Result: The element is ready once the new job is done
+        """
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        element = self.upload_image("test_image_replaced_while_job_runs")
+        first = claim_job("worker-1")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg', 'rb') as fp:
+            element.image = SimpleUploadedFile("replaced.jpg", fp.read(), content_type="image/jpeg")
+        element.save()
+        self.assertEqual(RenditionJob.objects.filter(element=element,status="pending").count(), 1)
+
+        process_job(first)
+        self.assertEqual(Element.objects.get(id=element.id).status, "processing")
+
+        process_job(claim_job("worker-1"))
+        element = Element.objects.get(id=element.id)
+        self.assertEqual(element.status, "ready")
+        self.assertTrue("replaced" in element.thumbnail_image_url)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True, DME_RENDITION_JOB_RETRY_DELAY=0)
+    def test_failed_job_is_retried_then_marked_failed(self):
+        """
+        Test a job whose image file is missing
+        Condition: Image file was removed before the worker ran
+        Result: Job is retried until max_attempts and then marked as failed
+        """
+        element = self.upload_image("test_failed_job_is_retried_then_marked_failed")
+        os.remove(element.image.path)
+
+        job = RenditionJob.objects.get(element=element)
+        for attempt in range(job.max_attempts):
+            job = claim_job("worker-1")
+            self.assertEqual(job.attempts, attempt+1)
+            process_job(job)
+
+        job = RenditionJob.objects.get(element=element)
+        self.assertEqual(job.status, "failed")
+        self.assertTrue(job.last_error)
+        self.assertEqual(Element.objects.get(id=element.id).status, "failed")
+
+class ParallelRenditionTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def resize(self, name):
+        url = reverse("api-media-elements")
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            c.post(url, {'name':name,'image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        element = Element.objects.get(name=name)
+        return list(ResizedImage.objects.filter(image=element).order_by("id").values_list("size","image_width","image_height"))
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False)
+    def test_pool_records_same_renditions_in_same_order(self):
+        """
+        Test resizing with a thread and a process pool
+        Condition: DME_RESIZE_POOL_SIZE is 4
+        Result: The same ResizedImage rows are recorded in the same order as the serial resize
+        """
+        serial = self.resize("test_pool_serial")
+        self.assertTrue(len(serial) > 0)
+
+        with self.settings(DME_RESIZE_POOL_SIZE=4, DME_RESIZE_POOL="thread"):
+            self.assertEqual(self.resize("test_pool_thread"), serial)
+
+        with self.settings(DME_RESIZE_POOL_SIZE=4, DME_RESIZE_POOL="process"):
+            self.assertEqual(self.resize("test_pool_process"), serial)
+
+class CascadeTests(TestCase):
+
+    @override_settings(DME_RESIZE_REDUCING_GAP=None)
+    def test_cascade_source_never_reduces_more_than_max_factor(self):
+        """
+        Test the source picked for a rendition
+        Condition: The only image in memory is 16 times larger than the rendition
+        Result: Intermediate steps are added so the last step is at most 2x
+        """
+        from PIL import Image
+        from media_explorer.helpers import ImageHelper
+
+        images = [Image.new("RGB", (3200, 2000))]
+        source = ImageHelper()._cascade_source(images, 200, 125, 2.0)
+
+        self.assertEqual(source.size, (400, 250))
+        for larger, smaller in zip(images, images[1:]):
+            self.assertTrue(larger.size[0] <= 2*smaller.size[0])
+
+        #A larger image already in memory is reused
+        self.assertTrue(ImageHelper()._cascade_source(images, 380, 230, 2.0) is source)
+
+    def test_images_are_released_when_no_longer_needed(self):
+        """
+        Test the memory kept while the renditions are made
+        Condition: Three renditions of an original, made serially and in a thread pool
+        Result: Every rendition is saved and the original is closed once its chains are made
+        """
+        from PIL import Image
+        from media_explorer.helpers import ImageHelper
+
+        helper = ImageHelper()
+        for pool_size in [1, 2]:
+            original = Image.new("RGB", (1200, 800))
+            renditions = [helper._rendition("default", "original", "%sx%s" % (w, h), w, h, "test_release/", "release_%s_%s.jpg" % (pool_size, w))
+                            for w, h in [(100, 60), (800, 500), (400, 250)]]
+            with self.settings(DME_RESIZE_POOL_SIZE=pool_size, DME_RESIZE_POOL="thread"):
+                results = helper._render({"original": original}, "JPEG", renditions)
+            self.assertEqual([result["success"] for result in results], [True, True, True])
+            self.assertRaises(ValueError, original.load)
+
+    def test_chains_are_made_in_parallel(self):
+        """
+        Test the rendition chains with a thread pool
+        Condition: Renditions of three size classes and DME_RESIZE_POOL_SIZE is 3
+        Result: The chains are resampled in more than one thread
+        Result: Every rendition is saved
+        """
+        import threading, time
+        from PIL import Image
+        from media_explorer import helpers
+
+        helper = helpers.ImageHelper()
+        original = Image.new("RGB", (1200, 800))
+        renditions = [helper._rendition(size_class, "original", "%s_%s" % (size_class, w), w, h, "test_chains/", "chains_%s_%s.jpg" % (size_class, w))
+                        for size_class, w, h in [("horizontal", 800, 500), ("horizontal", 400, 250), ("vertical", 300, 400), ("non_cropped", 600, 400)]]
+
+        threads = set()
+        fit = helpers._fit
+        def recording_fit(image, width, height):
+            threads.add(threading.current_thread().ident)
+            time.sleep(0.05)
+            return fit(image, width, height)
+
+        helpers._fit = recording_fit
+        try:
+            with self.settings(DME_RESIZE_POOL_SIZE=3, DME_RESIZE_POOL="thread"):
+                results = helper._render({"original": original}, "JPEG", renditions)
+        finally:
+            helpers._fit = fit
+        self.assertEqual([result["success"] for result in results], [True, True, True, True])
+        self.assertTrue(len(threads) > 1)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_RESIZE_ORIG_C_MAX_WIDTH=400, DME_RESIZE_WIDTHS={
+        "horizontal": [400,200],
+        "vertical": [200],
+        "non_cropped": [400],
+        "retina_2x": [],
+        "thumbnail": 100,
+    })
+    def test_large_jpeg_is_decoded_at_reduced_scale(self):
+        """
+        Test resizing a JPEG that is much larger than its largest rendition
+        Condition: Original is 3200x2000 and the largest rendition is 400 wide
+        Result: The original is decoded at 1/8 scale
+        Result: Element keeps the original dimensions and renditions have the configured sizes
+        """
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from media_explorer.helpers import ImageHelper
+
+        buf = BytesIO()
+        Image.new("RGB", (3200, 2000), (200, 40, 40)).save(buf, "JPEG")
+
+        User.objects.create_superuser("admin","admin@example.com","password")
+        c = Client()
+        c.login(username="admin",password="password")
+        image = SimpleUploadedFile("large.jpg", buf.getvalue(), content_type="image/jpeg")
+        c.post(reverse("api-media-elements"), {'name':'test_large_jpeg','image':image},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+        element = Element.objects.get(name="test_large_jpeg")
+        self.assertEqual((element.image_width, element.image_height), (3200, 2000))
+
+        sizes = dict((ri.size, (ri.image_width, ri.image_height)) for ri in ResizedImage.objects.filter(image=element))
+        self.assertEqual(sizes["orig_c"], (400, 250))
+        self.assertEqual(sizes["400x250"], (400, 250))
+        self.assertEqual(sizes["200x125"], (200, 125))
+        self.assertEqual(sizes["400nc"], (400, 250))
+
+        image = Image.open(element.image.path)
+        ImageHelper()._draft(image, 400/3200.0)
+        self.assertEqual(image.size, (400, 250))
+
+    @override_settings(DME_RESIZE_ORIG_C_MAX_WIDTH=None, DME_RESIZE_WIDTHS={
+        "horizontal": [300,200],
+        "vertical": [200],
+        "non_cropped": [400],
+        "retina_2x": [200],
+        "thumbnail": 100,
+    })
+    def test_orig_c_is_capped_to_largest_size(self):
+        """
+        Test the orig_c width when DME_RESIZE_ORIG_C_MAX_WIDTH is not set
+        Condition: Original is 3200x2000 and the largest cropped size is 200@2x (400 wide)
+        Result: orig_c is 400 wide so the original can be decoded at a reduced scale for it
+        Result: With DME_RESIZE_ORIG_C_MAX_WIDTH = 0 orig_c keeps the full resolution crop
+        """
+        from media_explorer.helpers import ImageHelper
+
+        plan = ImageHelper().plan(3200, 2000, "/media/images/large.jpg", "JPEG")
+        self.assertEqual((plan["orig_c"]["image_width"], plan["orig_c"]["image_height"]), (400, 250))
+
+        with self.settings(DME_RESIZE_ORIG_C_MAX_WIDTH=0):
+            plan = ImageHelper().plan(3200, 2000, "/media/images/large.jpg", "JPEG")
+        self.assertEqual(plan["orig_c"]["image_width"], 3200)
+
+class OnDemandRenditionTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_RESIZE_EAGER=False)
+    def test_rendition_is_created_on_first_request(self):
+        """
+        Test the rendition URL
+        Condition: DME_RESIZE_EAGER is False
+        Result: Only orig_c is created during the upload
+        Result: The first request creates the rendition and later requests reuse it
+        Result: Sizes that are not configured return 404
+        """
+        c = Client()
+        c.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            c.post(reverse("api-media-elements"), {'name':'test_on_demand','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        element = Element.objects.get(name="test_on_demand")
+        self.assertEqual(list(ResizedImage.objects.filter(image=element).values_list("size",flat=True)), ["orig_c"])
+
+        url = reverse("media-explorer-rendition", args=[element.id, "800x500"])
+        response = Client().get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertEqual(ResizedImage.objects.filter(image=element,size="800x500").count(), 1)
+
+        response = Client().get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ResizedImage.objects.filter(image=element,size="800x500").count(), 1)
+
+        response = Client().get(reverse("media-explorer-rendition", args=[element.id, "123x45"]))
+        self.assertEqual(response.status_code, 404)
+
+class RenditionFormatTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_RESIZE_FORMATS={"default": ["webp", "not-a-format"], "orig_c": []})
+    def test_extra_formats_are_recorded_and_negotiated(self):
+        """
+        Test extra rendition formats
+        Condition: DME_RESIZE_FORMATS adds webp to every size but orig_c
+        Result: Each size has a jpeg and a webp ResizedImage (unknown formats are skipped)
+        Result: The page gets the jpeg URL with a webp <source> whatever the Accept header (the slick gallery lazy loads the jpeg)
+        Result: The rendition view serves webp only when the browser accepts it (not with q=0)
+        """
+        from django.template import Template, Context
+        from django.test.client import RequestFactory
+        from media_explorer.models import Gallery, GalleryElement
+
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            c.post(reverse("api-media-elements"), {'name':'test_formats','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        element = Element.objects.get(name="test_formats")
+
+        self.assertEqual(list(ResizedImage.objects.filter(image=element,size="orig_c").values_list("format",flat=True)), ["jpeg"])
+        formats = list(ResizedImage.objects.filter(image=element,size="800x500").order_by("id").values_list("format",flat=True))
+        self.assertEqual(formats, ["jpeg","webp"])
+        webp = ResizedImage.objects.get(image=element,size="800x500",format="webp")
+        self.assertTrue(webp.image_url.endswith(".webp"))
+
+        #The page does not depend on the Accept header - the browser picks the format from the <picture>
+        t = Template('{% load media_explorer_tags %}{% get_image_url_from_size id "800x500" %}')
+        request = RequestFactory().get("/", HTTP_ACCEPT="image/webp,image/*")
+        self.assertTrue(t.render(Context({"id":element.id,"request":request})).endswith(".jpg"))
+        t = Template('{% load media_explorer_tags %}{% get_image_sources id "800x500" %}')
+        self.assertIn('type="image/webp" srcset="%s"' % webp.image_url, t.render(Context({"id":element.id})))
+        gallery = Gallery.objects.create(name="test_formats")
+        GalleryElement.objects.create(gallery=gallery,element=element)
+        #The slick gallery keeps its data-lazy loading (of the original format)
+        html = Template('{% load media_explorer_tags %}{% get_media_gallery id %}').render(Context({"id":gallery.id}))
+        jpeg = ResizedImage.objects.get(image=element,size="800x500",format="jpeg")
+        self.assertIn('data-lazy="%s"' % jpeg.image_url, html)
+        self.assertNotIn("<source", html)
+
+        url = reverse("media-explorer-rendition", args=[element.id, "800x500"])
+        response = Client().get(url, HTTP_ACCEPT="image/webp")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        response = Client().get(url, HTTP_ACCEPT="image/*, image/webp;q=0")
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+
+class EncodingProfileTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def rendition_path(self, name):
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            c.post(reverse("api-media-elements"), {'name':name,'image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        element = Element.objects.get(name=name)
+        ri = ResizedImage.objects.get(image=element,size="800x500")
+        return default_storage.path(storage_name(ri.image_url))
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False)
+    def test_profile_makes_smaller_progressive_files(self):
+        """
+        Test the default encoding profile
+        Condition: Same image resized with the default profile and with quality=100
+        Result: The default profile file is progressive and at least 3 times smaller
+        """
+        from PIL import Image
+        path = self.rendition_path("test_default_profile")
+        profile_size = os.path.getsize(path)
+        self.assertTrue(Image.open(path).info.get("progressive"))
+
+        with self.settings(DME_RESIZE_PROFILES={"default": {"quality": 100, "progressive": False, "optimize": False, "strip_metadata": False}}):
+            full_size = os.path.getsize(self.rendition_path("test_quality_100"))
+
+        self.assertTrue(full_size >= 3*profile_size)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_RESIZE_PROFILES={"default": {"quality": 95, "max_bytes": 30000}})
+    def test_quality_is_searched_to_fit_byte_budget(self):
+        """
+        Test the byte budget quality search
+        Condition: Profile has max_bytes = 30000
+        Result: The resized file fits in the budget
+        """
+        self.assertTrue(os.path.getsize(self.rendition_path("test_max_bytes")) <= 30000)
+
+    def test_quality_is_searched_for_psnr_floor(self):
+        """
+        Test the PSNR quality search
+        Condition: Profile has min_psnr
+        Result: A quality lower than the profile quality that still reaches min_psnr is picked
+        """
+        from PIL import Image
+        from media_explorer.helpers import _save_options, _search_quality, _encode, _psnr
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        image = Image.open(test_path + '/../elements/Oxfam-Cambodia.jpg').resize((400, 250))
+        profile = {"quality": 95, "min_psnr": 32}
+        options = _save_options(image, "JPEG", profile)
+        quality = _search_quality(image, "JPEG", options, profile)
+
+        self.assertTrue(40 <= quality < 95)
+        self.assertTrue(_psnr(image, _encode(image, "JPEG", dict(options, quality=quality))) >= 32)
+
+class RebuildRenditionsTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False)
+    def test_rebuild_missing_sizes_with_checkpoint(self):
+        """
+        Test the rebuild_renditions command
+        Condition: A width is added to DME_RESIZE_WIDTHS after the upload
+        Result: The new size is created and the other sizes are not duplicated
+        Result: The checkpoint records the last id and a second run has nothing left to do
+        """
+        import tempfile, shutil
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        for name in ["test_rebuild_1", "test_rebuild_2"]:
+            with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+                c.post(reverse("api-media-elements"), {'name':name,'image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        elements = list(Element.objects.filter(name__startswith="test_rebuild").order_by("id"))
+        count = ResizedImage.objects.filter(image=elements[0]).count()
+
+        widths = dict(settings.DME_RESIZE_WIDTHS)
+        widths["horizontal"] = widths["horizontal"] + [400]
+
+        tmp_dir = tempfile.mkdtemp()
+        checkpoint = os.path.join(tmp_dir, "checkpoint")
+        try:
+            with self.settings(DME_RESIZE_WIDTHS=widths):
+                out = StringIO()
+                call_command("rebuild_renditions", only_missing=True, chunk_size=1, checkpoint=checkpoint, stdout=out)
+                self.assertTrue("2 rebuilt, 0 failed" in out.getvalue())
+
+                for element in elements:
+                    self.assertEqual(ResizedImage.objects.filter(image=element,size="400x250").count(), 1)
+                    self.assertEqual(ResizedImage.objects.filter(image=element).count(), count + 1)
+                    self.assertEqual(Element.objects.get(id=element.id).status, "ready")
+
+                with open(checkpoint) as fp:
+                    self.assertEqual(int(fp.read()), elements[-1].id)
+
+                out = StringIO()
+                call_command("rebuild_renditions", checkpoint=checkpoint, stdout=out)
+                self.assertTrue("0 element(s) to check" in out.getvalue())
+
+                out = StringIO()
+                call_command("rebuild_renditions", only_missing=True, stdout=out)
+                self.assertTrue("0 rebuilt" in out.getvalue())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False)
+    def test_rebuild_with_queue(self):
+        """
+        Test rebuild_renditions --queue
+        Condition: A ready element is queued for a rebuild
+        Result: The element is processing with a pending job until the worker is done, then ready
+        """
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            c.post(reverse("api-media-elements"), {'name':'test_rebuild_queue','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        element = Element.objects.get(name="test_rebuild_queue")
+        self.assertEqual(element.status, "ready")
+
+        out = StringIO()
+        call_command("rebuild_renditions", queue=True, stdout=out)
+        self.assertTrue("1 queued" in out.getvalue())
+        self.assertEqual(Element.objects.get(id=element.id).status, "processing")
+        self.assertEqual(RenditionJob.objects.filter(element=element,status="pending").count(), 1)
+
+        call_command("process_renditions", once=True, stdout=StringIO())
+        self.assertEqual(Element.objects.get(id=element.id).status, "ready")
+
+class ImageBudgetTests(TestCase):
+
+    def setUp(self):
+        User.objects.create_superuser("admin","admin@example.com","password")
+        self.client = Client()
+        self.client.login(username="admin",password="password")
+
+    def png(self, width, height):
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        buf = BytesIO()
+        Image.new("RGB", (width, height)).save(buf, "PNG")
+        return SimpleUploadedFile("large.png", buf.getvalue(), content_type="image/png")
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_MAX_DECODE_MEMORY=1220*762*3//3)
+    def test_large_jpeg_is_decoded_within_memory_budget(self):
+        """
+        Test resizing a JPEG that does not fit in DME_MAX_DECODE_MEMORY
+        Condition: Decoding the full image needs 3 times the budget
+        Result: The image is decoded at half scale - orig_c is half the size
+        Result: Sizes larger than the decoded image are not created
+        """
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            response = self.client.post(reverse("api-media-elements"), {'name':'test_jpeg_budget','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_jpeg_budget")
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+
+        sizes = dict((ri.size, ri.image_width) for ri in ResizedImage.objects.filter(image=element))
+        self.assertEqual(sizes["orig_c"], 610)
+        self.assertTrue("610x381" in sizes)
+        self.assertFalse("800x500" in sizes)
+        self.assertFalse("1220nc" in sizes)
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_MAX_IMAGE_PIXELS=1000*1000, DME_MAX_DECODE_MEMORY=500*500*3)
+    def test_oversized_images_are_refused(self):
+        """
+        Test uploading images over the budget
+        Condition: PNG larger than DME_MAX_DECODE_MEMORY, PNG larger than DME_MAX_IMAGE_PIXELS
+        Result: The API and MediaImageField.clean refuse them with a clear message
+        Result: No element is created
+        """
+        from django.db.models.fields.files import FieldFile
+        from django.forms import ValidationError as FormValidationError
+        from media_explorer.fields import MediaImageField
+
+        response = self.client.post(reverse("api-media-elements"), {'name':'test_png_budget','image':self.png(600, 600)},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue("MB allowed" in response.content.decode("utf-8"))
+
+        response = self.client.post(reverse("api-media-elements"), {'name':'test_pixels_budget','image':self.png(1200, 1000)},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+        self.assertTrue("megapixels" in response.content.decode("utf-8"))
+        self.assertFalse(Element.objects.filter(name__in=["test_png_budget","test_pixels_budget"]).exists())
+
+        field = MediaImageField(upload_to="images/")
+        value = FieldFile(None, field, "large.png")
+        value._file = self.png(600, 600)
+        self.assertRaises(FormValidationError, field.clean, value, None)
+
+        value._file = self.png(400, 400)
+        self.assertEqual(field.clean(value, None), value)
+
+    def test_unreadable_images_are_refused(self):
+        """
+        Test uploading a file that is not an image and an image over Pillow's bomb limit
+        Condition: A text file named .png, a PNG over twice Image.MAX_IMAGE_PIXELS
+        Result: Both are refused with 400 error and no element is created
+        """
+        from PIL import Image
+        from django.core.files.uploadedfile import SimpleUploadedFile
+
+        text = SimpleUploadedFile("broken.png", b"not an image", content_type="image/png")
+        response = self.client.post(reverse("api-media-elements"), {'name':'test_not_image','image':text},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 400)
+
+        if hasattr(Image, "DecompressionBombError"):
+            max_pixels = Image.MAX_IMAGE_PIXELS
+            Image.MAX_IMAGE_PIXELS = 100*100
+            try:
+                response = self.client.post(reverse("api-media-elements"), {'name':'test_bomb','image':self.png(300, 300)},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+            finally:
+                Image.MAX_IMAGE_PIXELS = max_pixels
+            self.assertEqual(response.status_code, 400)
+        self.assertFalse(Element.objects.filter(name__in=["test_not_image","test_bomb"]).exists())
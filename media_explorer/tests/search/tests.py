@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+import json
+from django.test import TestCase, Client, override_settings
+from django.core.urlresolvers import reverse
+from django.core.management import call_command
+from media_explorer.models import Element, Gallery, SearchTerm
+from media_explorer.search import search_terms
+
+@override_settings(DME_OEMBED_PROVIDERS="media_explorer.oembed.stub_providers")
+class SearchTests(TestCase):
+
+    def setUp(self):
+        self.flood = Element.objects.create(name="Flood in Cambodia", credit="Oxfam", description="Families after the flood", video_url="https://example.com/1")
+        self.cambodia = Element.objects.create(name="Market", credit="Oxfam", description="A market in Cambodia", video_url="https://example.com/2")
+        self.other = Element.objects.create(name="Drought", credit="Someone else", video_url="https://example.com/3")
+
+    def search(self, params, url="api-media-elements"):
+        c = Client()
+        response = c.get(reverse(url), params, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content.decode("utf-8"))
+
+    def test_search_terms(self):
+        """
+        Test splitting a filter into terms
+        Condition: Mixed case, punctuation, underscores and repeated words
+        Result: Lowercase words without duplicates
+        """
+        self.assertEqual(search_terms("Flood, FLOOD in_Cambodia! \u00c9t\u00e9"), ["flood", "in", "cambodia", "\u00e9t\u00e9"])
+
+    def test_all_terms_must_match(self):
+        """
+        Test a filter with several terms
+        Condition: The terms are in different fields of some elements
+        Result: Only the elements matching every term (or the start of a word) are listed and counted
+        """
+        data = self.search({"filter":"oxf cambodia"})
+        self.assertEqual(sorted([item["id"] for item in data]), sorted([self.flood.id, self.cambodia.id]))
+
+        data = self.search({"filter":"flood oxfam"})
+        self.assertEqual([item["id"] for item in data], [self.flood.id])
+
+        stats = self.search({"filter":"flood oxfam"}, "api-stats-elements")
+        self.assertEqual(stats["total_entries"], 1)
+
+        self.assertEqual(self.search({"filter":"flood drought"}), [])
+
+    def test_prefix_match(self):
+        """
+        Test the prefix match of the index backend
+        Condition: A filter and a relevance sort on the start of a word (ASCII and accented)
+        Result: The words are matched with LIKE 'term%' (the same under every collation)
+        Result: Only the words starting with the term match
+        """
+        from media_explorer.search import IndexSearchBackend
+        backend = IndexSearchBackend()
+        queryset = backend.rank(backend.filter(Element.objects.all(), "flo"), "flo")
+        sql, params = queryset.query.sql_with_params()
+        self.assertTrue(" LIKE " in sql.upper())
+        self.assertEqual([element.id for element in queryset], [self.flood.id])
+        self.assertEqual(self.search({"filter":"flooe"}), [])
+
+        self.other.description = "\u00c9t\u00e9 sec"
+        self.other.save()
+        self.assertEqual([item["id"] for item in self.search({"filter":"\u00e9t", "sort":"relevance"})], [self.other.id])
+        self.assertEqual(self.search({"filter":"\u00e9te"}), [])
+
+    def test_relevance(self):
+        """
+        Test sort=relevance
+        Condition: A term is in the name of one element and the description of another
+        Result: The element with the term in its name comes first
+        """
+        data = self.search({"filter":"cambodia", "sort":"relevance"})
+        self.assertEqual([item["id"] for item in data], [self.flood.id, self.cambodia.id])
+
+    def test_index_follows_changes(self):
+        """
+        Test the search index after elements are changed and deleted
+        Condition: An element is renamed and another one is deleted
+        Result: The elements are found by their new words only and the deleted one is gone from the index
+        """
+        self.other.name = "Harvest"
+        self.other.save()
+        self.assertEqual(self.search({"filter":"drought"}), [])
+        self.assertEqual([item["id"] for item in self.search({"filter":"harvest"})], [self.other.id])
+
+        self.flood.delete()
+        self.assertFalse(SearchTerm.objects.filter(model_name="Element", object_id=self.flood.id).exists())
+
+    def test_gallery_search(self):
+        """
+        Test the gallery filter
+        Condition: Two galleries, one matching both terms
+        Result: Only that gallery is listed and counted
+        """
+        gallery = Gallery.objects.create(name="Cambodia floods", description="Photos from Oxfam")
+        Gallery.objects.create(name="Cambodia markets")
+        data = self.search({"filter":"cambodia oxfam"}, "api-media-galleries")
+        self.assertEqual([item["id"] for item in data], [gallery.id])
+        stats = self.search({"filter":"cambodia oxfam"}, "api-stats-galleries")
+        self.assertEqual(stats["total_entries"], 1)
+
+    def test_rebuild_search_index(self):
+        """
+        Test the rebuild_search_index command
+        Condition: The index is empty
+        Result: The elements are found again
+        """
+        SearchTerm.objects.all().delete()
+        call_command("rebuild_search_index", stdout=open("/dev/null", "w"))
+        data = self.search({"filter":"flood"})
+        self.assertEqual([item["id"] for item in data], [self.flood.id])
+
+    @override_settings(DME_SEARCH_BACKEND="media_explorer.search.LikeSearchBackend")
+    def test_like_backend(self):
+        """
+        Test the LikeSearchBackend
+        Condition: A filter with two terms
+        Result: Only the elements matching both terms are listed
+        """
+        data = self.search({"filter":"market oxfam"})
+        self.assertEqual([item["id"] for item in data], [self.cambodia.id])
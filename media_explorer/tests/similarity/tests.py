@@ -0,0 +1,154 @@
+from __future__ import unicode_literals
+import os, json, random
+from datetime import timedelta
+from io import BytesIO
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from media_explorer.models import Element
+from media_explorer.jobs import claim_job, process_job
+from media_explorer import similarity
+from media_explorer.similarity import BKTree, image_phash, hamming_distance, similarity_index
+
+try:
+	from PIL import Image
+except ImportError:
+	import Image
+
+@override_settings(DME_RESIZE=False)
+class SimilarityTests(TestCase):
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+        similarity_index.reset()
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        self.image_path = test_path + '/../elements/Oxfam-Cambodia.jpg'
+
+    def upload(self, name, data, file_name="image.jpg"):
+        c = Client()
+        c.login(username="admin",password="password")
+        image = SimpleUploadedFile(file_name, data, content_type="image/jpeg")
+        response = c.post(reverse("api-media-elements"), {'name':name,'image':image},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+        return Element.objects.get(name=name)
+
+    def variant(self):
+        """
+        The test image cropped a little, made smaller and saved at a low quality
+        """
+        image = Image.open(self.image_path)
+        image = image.crop((10, 10, image.size[0] - 10, image.size[1] - 10)).resize((600, 372), Image.ANTIALIAS)
+        buf = BytesIO()
+        image.save(buf, "JPEG", quality=40)
+        return buf.getvalue()
+
+    def test_bktree_matches_linear_search(self):
+        """
+        Test the BK-tree search
+        Condition: 2000 random hashes
+        Result: Same matches as comparing every hash
+        """
+        rnd = random.Random(1)
+        values = [rnd.getrandbits(64) for i in range(2000)]
+        #Some values close to each other
+        values += [values[0] ^ (1 << bit) for bit in range(0, 64, 7)]
+
+        tree = BKTree()
+        for id, value in enumerate(values):
+            tree.add(value, id)
+
+        for max_distance in [0, 4, 10]:
+            expected = sorted((id, bin(value ^ values[0]).count("1")) for id, value in enumerate(values) if bin(value ^ values[0]).count("1") <= max_distance)
+            self.assertEqual(sorted(tree.search(values[0], max_distance)), expected)
+
+    def test_index_follows_changed_hashes(self):
+        """
+        Test the similarity index after hashes change and elements are deleted
+        Condition: An element gets a new hash, another one is deleted
+        Result: The old hash and the deleted element are removed from the tree and the tree is built again
+        """
+        first = Element.objects.create(name="test_index_first", type="image", phash="0000000000000000")
+        second = Element.objects.create(name="test_index_second", type="image", phash="00000000000000ff")
+        self.assertEqual([element.id for element, distance in similarity_index.search("0000000000000000", 8)], [first.id, second.id])
+
+        Element.objects.filter(id=first.id).update(phash="ffffffffffffffff", updated_at=first.updated_at + timedelta(seconds=1))
+        self.assertEqual([element.id for element, distance in similarity_index.search("0000000000000000", 8)], [second.id])
+        self.assertEqual(similarity_index.hashes[first.id], 2**64 - 1)
+        self.assertEqual(sorted(id for id, distance in similarity_index.tree.search(0, 64)), [first.id, second.id])
+
+        second.delete()
+        self.assertEqual(similarity_index.search("00000000000000ff", 8), [])
+        self.assertEqual(similarity_index.tree.search(0, 64), [(first.id, 64)])
+        self.assertEqual(similarity_index.tree.size, 1)
+
+    def test_phash_without_numpy(self):
+        """
+        Test the perceptual hash without NumPy
+        Condition: numpy is not installed
+        Result: The hash is the same
+        """
+        expected = image_phash(Image.open(self.image_path))
+        numpy = similarity.numpy
+        similarity.numpy = None
+        try:
+            self.assertEqual(image_phash(Image.open(self.image_path)), expected)
+        finally:
+            similarity.numpy = numpy
+
+    def test_similar_elements(self):
+        """
+        Test the near-duplicate search
+        Condition: A re-cropped, smaller and re-encoded copy and an unrelated image are uploaded
+        Result: The copy is found from the element, from its hash and from a posted image
+        Result: The unrelated image is not found
+        """
+        with open(self.image_path, "rb") as fp:
+            original = self.upload("test_similar_original", fp.read(), "Oxfam-Cambodia.jpg")
+        copy = self.upload("test_similar_copy", self.variant())
+
+        other_image = Image.new("RGB", (256, 256), (255, 255, 255))
+        other_image.paste((0, 0, 0), (0, 0, 128, 256))
+        buf = BytesIO()
+        other_image.save(buf, "JPEG")
+        other = self.upload("test_similar_other", buf.getvalue())
+
+        self.assertEqual(len(original.phash), 16)
+        self.assertTrue(hamming_distance(original.phash, copy.phash) <= 6)
+
+        c = Client()
+        url = reverse("api-media-elements-similar")
+        data = json.loads(c.get(url, {"element_id":original.id}).content)
+        self.assertEqual([item["id"] for item in data], [copy.id])
+        self.assertEqual(data[0]["distance"], hamming_distance(original.phash, copy.phash))
+
+        data = json.loads(c.get(url, {"phash":original.phash,"distance":0}).content)
+        self.assertEqual([item["id"] for item in data], [original.id])
+
+        c.login(username="admin",password="password")
+        with open(self.image_path, "rb") as fp:
+            data = json.loads(c.post(url, {"image":fp}).content)
+        ids = [item["id"] for item in data]
+        self.assertTrue(original.id in ids and copy.id in ids)
+        self.assertFalse(other.id in ids)
+
+        #Deleted elements are not returned
+        copy.delete()
+        data = json.loads(c.get(url, {"element_id":original.id}).content)
+        self.assertEqual(data, [])
+
+    @override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=True)
+    def test_phash_is_set_by_the_rendition_job(self):
+        """
+        Test the hash of an image resized in the background
+        Condition: The element is saved and its rendition job is run afterwards
+        Result: The hash is empty until the job has decoded the image, then it is the hash of the original
+        """
+        with open(self.image_path, "rb") as fp:
+            element = self.upload("test_phash_job", fp.read(), "Oxfam-Cambodia.jpg")
+        self.assertEqual(element.phash, None)
+
+        process_job(claim_job("test-worker"))
+        element = Element.objects.get(id=element.id)
+        self.assertTrue(hamming_distance(element.phash, image_phash(Image.open(self.image_path))) <= 2)
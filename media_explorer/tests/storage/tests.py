@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+import os
+from django.test import TransactionTestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.storage import default_storage
+from media_explorer.models import Element, ResizedImage
+from media_explorer.storage import storage_name, exists_many
+from media_explorer.deletions import file_deleter
+
+@override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_DELETE_ASYNC=False, DEFAULT_FILE_STORAGE="media_explorer.storage.InMemoryStorage")
+class StorageTests(TransactionTestCase):
+    #The files are deleted when the transaction commits
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+
+    def test_renditions_use_storage(self):
+        """
+        Test resizing with an in-memory storage
+        Condition: DEFAULT_FILE_STORAGE is InMemoryStorage
+        Result: Original and resized images are written to the storage and not to the disk
+        Result: The rendition URL streams the file from the storage
+        Result: Deleting the element deletes the files from the storage
+        """
+        c = Client()
+        c.login(username="admin",password="password")
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg') as fp:
+            response = c.post(reverse("api-media-elements"), {'name':'test_storage','image':fp},HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_storage")
+        self.assertTrue(default_storage.exists(element.image.name))
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+
+        names = [storage_name(url) for url in ResizedImage.objects.filter(image=element).values_list("image_url",flat=True)]
+        self.assertTrue(len(names) > 1)
+        self.assertEqual(exists_many(names), set(names))
+        self.assertTrue(set([os.path.basename(name) for name in names]) <= set(default_storage.listdir("resized")[1]))
+
+        ri = ResizedImage.objects.get(image=element,size="800x500")
+        self.assertFalse(os.path.exists(ri.image_url))
+        response = Client().get(reverse("media-explorer-rendition", args=[element.id, "800x500"]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b"".join(response.streaming_content), default_storage.open(storage_name(ri.image_url)).read())
+
+        element.delete()
+        file_deleter.wait()
+        self.assertEqual(exists_many(names + [element.image.name]), set())
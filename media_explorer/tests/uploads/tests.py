@@ -0,0 +1,114 @@
+from __future__ import unicode_literals
+import os, json
+from django.test import TestCase, Client, override_settings
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.storage import default_storage
+from media_explorer.models import Element, ResizedImage, Upload
+from media_explorer.uploads import chunk_directory
+
+@override_settings(DME_RESIZE=True, DME_RESIZE_ASYNC=False, DME_UPLOAD_CHUNK_SIZE=200000)
+class ChunkedUploadTests(TestCase):
+
+    def setUp(self):
+        #Create test users
+        User.objects.create_superuser("admin","admin@example.com","password")
+        self.client = Client()
+        self.client.login(username="admin",password="password")
+
+        test_path = os.path.dirname(os.path.abspath(__file__))
+        with open(test_path + '/../elements/Oxfam-Cambodia.jpg', 'rb') as fp:
+            self.data = fp.read()
+
+    def send_chunk(self, token, offset, size):
+        chunk = SimpleUploadedFile("chunk", self.data[offset:offset+size], content_type="application/octet-stream")
+        return self.client.post(reverse("api-media-upload-chunks", args=[token]), {"offset":offset,"chunk":chunk})
+
+    def test_chunked_upload_creates_element(self):
+        """
+        Test a chunked upload
+        Condition: The image is sent in chunks - one of them twice and one at a wrong offset
+        Result: The retransmitted chunk is accepted, the wrong offset gets a 409 with the offset to resume from
+        Result: Finishing creates the element with its resized images and deletes the chunks
+        """
+        response = self.client.post(reverse("api-media-uploads"), {"file_name":"Oxfam-Cambodia.jpg","size":len(self.data),"name":"test_chunked"})
+        self.assertEqual(response.status_code, 201)
+        token = json.loads(response.content)["token"]
+
+        response = self.send_chunk(token, 0, 150000)
+        self.assertEqual(json.loads(response.content)["offset"], 150000)
+
+        #Retransmit after a dropped response
+        response = self.send_chunk(token, 0, 150000)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["offset"], 150000)
+
+        response = self.send_chunk(token, 160000, 1000)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(json.loads(response.content)["offset"], 150000)
+
+        #Finishing early fails
+        response = self.client.post(reverse("api-media-upload-finish", args=[token]))
+        self.assertEqual(response.status_code, 400)
+
+        #Resume from the offset of the upload
+        offset = json.loads(self.client.get(reverse("api-media-upload", args=[token])).content)["offset"]
+        while offset < len(self.data):
+            response = self.send_chunk(token, offset, 150000)
+            self.assertEqual(response.status_code, 200)
+            offset = json.loads(response.content)["offset"]
+
+        response = self.client.post(reverse("api-media-upload-finish", args=[token]))
+        self.assertEqual(response.status_code, 200)
+
+        element = Element.objects.get(name="test_chunked")
+        self.assertEqual(json.loads(response.content)["id"], element.id)
+        self.assertEqual(element.image.read(), self.data)
+        self.assertEqual((element.image_width, element.image_height), (1220, 762))
+        self.assertTrue(ResizedImage.objects.filter(image=element).count() > 0)
+
+        upload = Upload.objects.get(token=token)
+        self.assertEqual(upload.status, "complete")
+        self.assertEqual(upload.element_id, element.id)
+        self.assertEqual(default_storage.listdir(chunk_directory(upload))[1], [])
+
+    def test_chunk_larger_than_chunk_size_is_refused(self):
+        """
+        Test sending a chunk that is too large
+        Condition: Chunk is larger than DME_UPLOAD_CHUNK_SIZE
+        Result: 409 and the offset does not move
+        """
+        response = self.client.post(reverse("api-media-uploads"), {"file_name":"Oxfam-Cambodia.jpg","size":len(self.data)})
+        token = json.loads(response.content)["token"]
+
+        response = self.send_chunk(token, 0, 200001)
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(Upload.objects.get(token=token).offset, 0)
+
+    def test_finish_twice(self):
+        """
+        Test finishing an upload twice
+        Condition: A finish is retried while the first one is running, then after it is done
+        Result: The retry during the finish gets a 409, the one after gets the same element
+        Result: A single element is created
+        """
+        response = self.client.post(reverse("api-media-uploads"), {"file_name":"Oxfam-Cambodia.jpg","size":len(self.data),"name":"test_finish_twice"})
+        token = json.loads(response.content)["token"]
+        offset = 0
+        while offset < len(self.data):
+            offset = json.loads(self.send_chunk(token, offset, 150000).content)["offset"]
+
+        #The first finish has claimed the upload
+        Upload.objects.filter(token=token).update(status="finishing")
+        response = self.client.post(reverse("api-media-upload-finish", args=[token]))
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(Element.objects.filter(name="test_finish_twice").exists())
+
+        Upload.objects.filter(token=token).update(status="uploading")
+        first = self.client.post(reverse("api-media-upload-finish", args=[token]))
+        second = self.client.post(reverse("api-media-upload-finish", args=[token]))
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(json.loads(first.content)["id"], json.loads(second.content)["id"])
+        self.assertEqual(Element.objects.filter(name="test_finish_twice").count(), 1)
@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from media_explorer.models import Element, Gallery, GalleryElement
+from media_explorer.templatetags.media_explorer_tags import get_video, get_media_gallery
+
+@override_settings(DME_OEMBED_PROVIDERS="media_explorer.oembed.stub_providers", DME_OEMBED_ASYNC=False)
+class VideoFacadeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.video = Element.objects.create(name="test_facade", video_url="https://example.com/video")
+        self.video = Element.objects.get(id=self.video.id)
+
+    def test_video_facade(self):
+        """
+        Test the click-to-load video
+        Condition: DME_VIDEO_FACADE is True
+        Result: The thumbnail and a play button are shown
+        Result: The embed code is only in a <template> (and <noscript>)
+        """
+        html = get_video(self.video.id)
+        self.assertTrue('class="dme-video-facade-play"' in html)
+        self.assertTrue('<img src="%s"' % self.video.thumbnail_image_url in html)
+        self.assertTrue('<template class="dme-video-facade-embed"><iframe src="https://example.com/video"' in html)
+        self.assertEqual(html.count("<iframe"), 2)
+        self.assertTrue(html.index("<template") < html.index("<iframe"))
+
+    def test_gallery_video_facade(self):
+        """
+        Test the videos of a gallery
+        Condition: DME_VIDEO_FACADE is True
+        Result: No iframe is loaded with the page
+        """
+        gallery = Gallery.objects.create(name="test_facade")
+        GalleryElement.objects.create(gallery=gallery, element=self.video, sort_by=0)
+        html = get_media_gallery(gallery.id)
+        self.assertTrue("video_facade.js" in html)
+        self.assertTrue('class="dme-video-facade-play"' in html)
+        self.assertFalse("<iframe" in html.replace(html[html.index("<template"):html.index("</noscript>")], ""))
+
+    @override_settings(DME_VIDEO_FACADE=False)
+    def test_video_without_facade(self):
+        """
+        Test the video embed code
+        Condition: DME_VIDEO_FACADE is False
+        Result: The embed code is shown as it is
+        """
+        html = get_video(self.video.id)
+        self.assertFalse("dme-video-facade" in html)
+        self.assertTrue('<div class="cmpnt-video"><iframe src="https://example.com/video"' in html)
@@ -0,0 +1,128 @@
+import posixpath, tempfile, uuid
+from datetime import timedelta
+from django.conf import settings
+from django.core.files import File
+from django.utils import timezone
+from media_explorer.models import Upload
+from media_explorer.storage import get_storage
+
+def start_upload(file_name, size, user=None, element=None, name=None, credit=None, description=None):
+    upload = Upload()
+    upload.token = uuid.uuid4().hex
+    upload.file_name = posixpath.basename(file_name.replace("\\", "/"))
+    upload.size = size
+    upload.user = user
+    upload.element = element
+    upload.name = name
+    upload.credit = credit
+    upload.description = description
+    upload.save()
+    return upload
+
+def chunk_directory(upload):
+    return posixpath.join(getattr(settings,"DME_UPLOAD_DIRECTORY","dme_uploads").strip("/"), upload.token)
+
+def chunk_name(upload, offset):
+    #Zero padded so the names sort by offset
+    return posixpath.join(chunk_directory(upload), "%015d" % offset)
+
+def save_chunk(upload, offset, chunk):
+    """
+    Write a chunk (a Django File, e.g. request.FILES["chunk"]) at offset.
+    Returns a dict with success, message and offset (the number of bytes received so far).
+    A chunk that was already received (a retransmit) is accepted without writing it again.
+    """
+    rtn = {}
+    rtn["success"] = False
+    rtn["message"] = ""
+    rtn["offset"] = upload.offset
+
+    if upload.status != "uploading":
+        rtn["message"] = "The upload is already finished"
+        return rtn
+
+    if offset + chunk.size <= upload.offset:
+        rtn["success"] = True
+        return rtn
+
+    if offset != upload.offset:
+        rtn["message"] = "Expected a chunk at offset %s" % upload.offset
+        return rtn
+
+    if chunk.size > getattr(settings,"DME_UPLOAD_CHUNK_SIZE",5*1024*1024):
+        rtn["message"] = "Chunks can not be larger than %s bytes" % getattr(settings,"DME_UPLOAD_CHUNK_SIZE",5*1024*1024)
+        return rtn
+
+    if not chunk.size or offset + chunk.size > upload.size:
+        rtn["message"] = "The chunk does not fit in the upload size"
+        return rtn
+
+    storage = get_storage()
+    name = chunk_name(upload, offset)
+    if storage.exists(name):
+        storage.delete(name)
+    saved_name = storage.save(name, chunk)
+
+    #Only one request can move the offset forward - another one may have sent the same chunk
+    updated = Upload.objects.filter(id=upload.id,offset=offset,status="uploading").update(
+        offset=offset + chunk.size,
+        updated_at=timezone.now(),
+    )
+    if not updated:
+        if saved_name != name:
+            storage.delete(saved_name)
+        upload = Upload.objects.get(id=upload.id)
+        rtn["offset"] = upload.offset
+        rtn["message"] = "Expected a chunk at offset %s" % upload.offset
+        return rtn
+
+    rtn["success"] = True
+    rtn["offset"] = offset + chunk.size
+    return rtn
+
+def assemble_upload(upload):
+    """
+    Join the chunks in a temporary file (in memory up to DME_STORAGE_SPOOL_SIZE bytes)
+    Returns a Django File - close it when you are done with it
+    """
+    storage = get_storage()
+    tmp = tempfile.SpooledTemporaryFile(max_size=getattr(settings,"DME_STORAGE_SPOOL_SIZE",10*1024*1024))
+
+    offset = 0
+    for name in sorted(storage.listdir(chunk_directory(upload))[1]):
+        if int(name) != offset:
+            tmp.close()
+            raise ValueError("Chunk at offset %s is missing" % offset)
+        chunk = storage.open(posixpath.join(chunk_directory(upload), name), "rb")
+        try:
+            for data in chunk.chunks():
+                tmp.write(data)
+                offset += len(data)
+        finally:
+            chunk.close()
+
+    if offset != upload.size:
+        tmp.close()
+        raise ValueError("Received %s of %s bytes" % (offset, upload.size))
+
+    tmp.seek(0)
+    return File(tmp, name=upload.file_name)
+
+def delete_chunks(upload):
+    storage = get_storage()
+    try:
+        names = storage.listdir(chunk_directory(upload))[1]
+    except OSError:
+        return
+    for name in names:
+        storage.delete(posixpath.join(chunk_directory(upload), name))
+
+def expired_uploads():
+    """
+    Unfinished uploads that were not touched for DME_UPLOAD_EXPIRY seconds
+    (including the ones whose finish never completed)
+    """
+    expiry = timezone.now() - timedelta(seconds=getattr(settings,"DME_UPLOAD_EXPIRY",60*60*24))
+    return Upload.objects.filter(status__in=["uploading","finishing"],updated_at__lt=expiry)
+
+#EOF
@@ -1,93 +1,69 @@
-import math, json
-from django.http import HttpResponse
+import json, mimetypes
+from wsgiref.util import FileWrapper
+from django.http import HttpResponse, StreamingHttpResponse, Http404
+from django.shortcuts import get_object_or_404
+from django.utils.cache import patch_cache_control, patch_vary_headers
 from django.views.generic import View
-from media_explorer.models import Element, Gallery, GalleryElement
+from media_explorer.models import Element, Gallery, GalleryElement, ResizedImage
+from media_explorer.helpers import ImageHelper, SingleFlight, pick_resized_image, filter_elements, filter_galleries
+from media_explorer.storage import get_storage, storage_name, exists_many
+from media_explorer.counts import explorer_stats
 from django.conf import settings
-from django.db.models import Q
 
 class ElementStatsView(View):
 
     def get(self, request, *args, **kwargs):
-        #NOTE: Code below must match ElementList.get_queryset
-        #TODO - move to helper so you don't maintain same code twice
-        data = {}
-        query = None
-        and_query = None
-        or_query = None
-        type = request.GET.get('type', None)
-        filter = request.GET.get('filter', None)
-
-        data["page_size"] = settings.DME_PAGE_SIZE
-
-        try:
-            if type:
-                and_query = Q(type=type)
-        except Exception as e:
-            pass
-
-        if filter:
-            try:
-                filter_list = filter.split(" ")
-                or_query = Q(name__icontains=filter_list[0]) | Q(description__icontains=filter_list[0]) | Q(credit__icontains=filter_list[0])
-                for term in filter_list[1:]:
-                    or_query.add((Q(name__icontains=term) | Q(description__icontains=term) | Q(credit__icontains=term)), or_query.connector)
-            except Exception as e:
-                pass
-
-        if and_query:
-            query = and_query
-
-        if or_query:
-            if query:
-                query.add(or_query,Q.AND)
-            else:
-                query = or_query
-
-        if query:
-            data["total_entries"] = Element.objects.filter(query).count()
-        else:
-            data["total_entries"] = Element.objects.all().count()
-
-        data["total_pages"] = int(math.ceil(float(data["total_entries"])/data["page_size"]))
-
+        #NOTE: The elements are filtered like ElementList.get_queryset (see helpers.filter_elements)
+        data = explorer_stats(filter_elements(request.GET), request.GET)
         return HttpResponse(json.dumps(data),content_type="application/json")
 
 class GalleryStatsView(View):
     def get(self, request, *args, **kwargs):
-        #NOTE: Code below must match GalleryList.get_queryset
-        #TODO - move to helper so you don't maintain same code twice
-        data = {}
-        query = None
-        and_query = None
-        or_query = None
-        filter = request.GET.get('filter', None)
-
-        data["page_size"] = settings.DME_PAGE_SIZE
-
-        if filter:
-            try:
-                filter_list = filter.split(" ")
-                or_query = Q(name__icontains=filter_list[0]) | Q(description__icontains=filter_list[0])
-                for term in filter_list[1:]:
-                    or_query.add((Q(name__icontains=term) | Q(description__icontains=term)), or_query.connector)
-            except Exception as e:
-                pass
-
-        if and_query:
-            query = and_query
-
-        if or_query:
-            if query:
-                query.add(or_query,Q.AND)
-            else:
-                query = or_query
-
-        if query:
-            data["total_entries"] = Gallery.objects.filter(query).count()
-        else:
-            data["total_entries"] = Gallery.objects.all().count()
-
-        data["total_pages"] = int(math.ceil(float(data["total_entries"])/data["page_size"]))
-
+        #NOTE: The galleries are filtered like GalleryList.get_queryset (see helpers.filter_galleries)
+        data = explorer_stats(filter_galleries(request.GET), request.GET)
         return HttpResponse(json.dumps(data),content_type="application/json")
 
+
+mimetypes.add_type("image/webp", ".webp")
+mimetypes.add_type("image/avif", ".avif")
+
+class RenditionView(View):
+    """
+    Serve a rendition of an image - it is created the first time it is requested
+    and served from the resize directory after that.
+    """
+
+    def get_resized_image(self, element, size):
+        storage = get_storage()
+        resized_images = list(ResizedImage.objects.filter(image=element,size=size).order_by("id"))
+        names = [storage_name(ri.image_url, storage) for ri in resized_images]
+        if set(names) - exists_many(names, storage):
+            #A file is gone - create the size again
+            ResizedImage.objects.filter(image=element,size=size).delete()
+            return None
+        return pick_resized_image(resized_images, self.request.META.get("HTTP_ACCEPT", ""))
+
+    def get(self, request, pk, size, *args, **kwargs):
+        element = get_object_or_404(Element, id=pk, type="image")
+
+        ri = self.get_resized_image(element, size)
+        if not ri:
+            #Concurrent first requests wait for the one that creates the rendition
+            with SingleFlight("rendition-%s-%s" % (element.id, size)):
+                ri = self.get_resized_image(element, size)
+                if not ri:
+                    rtn = ImageHelper().render_size(element, size)
+                    if not rtn["success"]:
+                        raise Http404(rtn["message"])
+                    ri = self.get_resized_image(element, size)
+                    if not ri:
+                        raise Http404("Size %s could not be created" % size)
+
+        storage = get_storage()
+        name = storage_name(ri.image_url, storage)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        response = StreamingHttpResponse(FileWrapper(storage.open(name, "rb")), content_type=content_type)
+        response["Content-Length"] = storage.size(name)
+        patch_cache_control(response, public=True, max_age=getattr(settings,"DME_RENDITION_MAX_AGE",2592000))
+        patch_vary_headers(response, ["Accept"])
+        return response